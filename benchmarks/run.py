@@ -0,0 +1,373 @@
+"""
+Benchmarks for intent registration and matching at realistic scale.
+
+Synthetic skill sets are generated from a fixed seed, scaling the number of
+intents, the (bracket|expansion) depth of the intent lines, the number of
+entity slots per line and the size of the entities. Every scenario and fuzz
+setting runs in a fresh process, so startup time and peak memory are measured
+in isolation.
+
+APIs missing from the benchmarked commit (execution backends, batches,
+snapshots) are detected, the scenarios and metrics needing them are skipped,
+so older commits can be benchmarked for comparison.
+
+    python benchmarks/run.py --preset quick --output before.json
+    python benchmarks/run.py --preset quick --output after.json
+    python benchmarks/run.py --compare before.json after.json
+
+Results are written as JSON, one record per scenario, backend and fuzz
+setting, so runs from different commits can be diffed.
+"""
+import argparse
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+# benchmark the working tree, not an installed padacioso
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PRESETS = {
+    "quick": {"intents": [10, 100], "depth": [1], "slots": [1],
+              "entity_size": [100], "backends": ["inline"],
+              "queries": 100},
+    "default": {"intents": [10, 100, 1000], "depth": [0, 2], "slots": [0, 1],
+                "entity_size": [100], "backends": ["inline", "thread"],
+                "queries": 200},
+    "full": {"intents": [10, 100, 1000], "depth": [0, 2, 4],
+             "slots": [0, 1, 2], "entity_size": [10, 1000],
+             "backends": ["inline", "thread", "process"], "queries": 500},
+}
+# metrics where a higher value is better, see compare
+HIGHER_IS_BETTER = {"throughput", "batch_throughput"}
+LINES_PER_INTENT = 4
+WORDS = ["play", "stop", "turn", "set", "show", "tell", "what", "is", "the",
+         "a", "my", "on", "off", "to", "for", "in", "me", "about", "next",
+         "light", "music", "timer", "alarm", "weather", "news", "volume",
+         "song", "kitchen", "today", "tomorrow", "please", "now", "some",
+         "time", "up", "down", "open", "close", "door", "window", "call",
+         "mom", "start", "pause", "resume", "find", "search", "read", "book"]
+
+
+def generate_skills(n_intents: int, depth: int, slots: int,
+                    entity_size: int, seed: int = 0) -> Tuple[dict, dict]:
+    """
+    Generate a synthetic skill set
+    @param n_intents: number of intents
+    @param depth: number of (a|b) groups and [optional] words per line
+    @param slots: number of {entity} slots per line
+    @param entity_size: number of values of each entity
+    @param seed: random seed
+    @return: intent name -> lines, entity name -> values
+    """
+    rng = random.Random(seed)
+    intents, entities = {}, {}
+    for idx in range(n_intents):
+        name = f"skill{idx % 25}:intent{idx}"
+        # a unique word per intent, so every intent is reachable
+        anchor = f"w{idx}"
+        lines = []
+        for _ in range(LINES_PER_INTENT):
+            parts = [anchor] + rng.sample(WORDS, 4)
+            for _ in range(depth):
+                if rng.random() < 0.5:
+                    parts.insert(rng.randrange(len(parts) + 1),
+                                 "(" + "|".join(rng.sample(WORDS, 3)) + ")")
+                else:
+                    parts.insert(rng.randrange(len(parts) + 1),
+                                 f"[{rng.choice(WORDS)}]")
+            for s in range(slots):
+                entity = f"entity{(idx + s) % 20}"
+                parts.insert(rng.randrange(1, len(parts) + 1),
+                             "{" + entity + "}")
+                if entity not in entities:
+                    entities[entity] = [
+                        f"{rng.choice(WORDS)} value{v}"
+                        for v in range(entity_size)]
+            lines.append(" ".join(parts))
+        intents[name] = lines
+    return intents, entities
+
+
+def generate_queries(intents: dict, entities: dict, n_queries: int,
+                     seed: int = 0) -> List[str]:
+    """
+    Generate utterances, mostly realizations of the intent lines with a
+    fraction of near misses and unrelated utterances
+    @return: list of utterances
+    """
+    from padacioso.bracket_expansion import expand_parentheses
+    rng = random.Random(seed)
+    names = list(intents)
+    queries = []
+    for idx in range(n_queries):
+        kind = idx % 10
+        if kind == 9:  # unrelated
+            queries.append(" ".join(rng.sample(WORDS, 6)))
+            continue
+        line = rng.choice(intents[rng.choice(names)])
+        utt = rng.choice(expand_parentheses(line))
+        for entity, values in entities.items():
+            utt = utt.replace("{" + entity + "}", rng.choice(values))
+        if kind == 8:  # near miss, one word replaced
+            words = utt.split()
+            words[rng.randrange(len(words))] = rng.choice(WORDS)
+            utt = " ".join(words)
+        queries.append(utt)
+    return queries
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    idx = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[idx]
+
+
+def _supports_backends(container_cls) -> bool:
+    return "backend" in inspect.signature(container_cls).parameters
+
+
+def _run_scenario(scenario: dict, fuzz: bool, queue):
+    """
+    Benchmark one scenario, runs in a fresh process
+    """
+    start = time.perf_counter()
+    from padacioso import IntentContainer
+    from padacioso.bracket_expansion import expand_parentheses
+    import_time = time.perf_counter() - start
+    if scenario["backend"] != "inline" and \
+            not _supports_backends(IntentContainer):
+        queue.put(None)
+        return
+    # logging every unmatched query would dominate the latencies
+    from padacioso import LOG
+    if hasattr(LOG, "set_level"):
+        LOG.set_level("WARNING")
+    else:
+        LOG.setLevel("WARNING")
+
+    intents, entities = generate_skills(scenario["intents"],
+                                        scenario["depth"], scenario["slots"],
+                                        scenario["entity_size"])
+    queries = generate_queries(intents, entities, scenario["queries"])
+    start = time.perf_counter()
+    n_templates = sum(len(expand_parentheses(l))
+                      for lines in intents.values() for l in lines)
+    metrics = {"import_time": import_time,
+               "expand_time": time.perf_counter() - start}
+
+    if _supports_backends(IntentContainer):
+        container = IntentContainer(fuzz=fuzz, backend=scenario["backend"],
+                                    n_workers=scenario["workers"])
+    else:
+        container = IntentContainer(fuzz=fuzz)
+    start = time.perf_counter()
+    for name, values in entities.items():
+        container.add_entity(name, values)
+    for name, lines in intents.items():
+        container.add_intent(name, lines)
+    register_time = time.perf_counter() - start
+    # first query starts the backend workers, if any
+    start = time.perf_counter()
+    container.calc_intent(queries[0])
+    first_query = time.perf_counter() - start
+    # workers load their state on their first call, untimed
+    for query in queries[:scenario["workers"]]:
+        container.calc_intent(query)
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        container.calc_intent(query)
+        latencies.append(time.perf_counter() - start)
+    metrics.update({
+        "register_time": register_time,
+        "first_query_time": first_query,
+        "cold_start": import_time + register_time + first_query,
+        "p50": statistics.median(latencies),
+        "p99": _percentile(latencies, 99),
+        "mean": statistics.fmean(latencies),
+        "throughput": len(queries) / sum(latencies),
+    })
+    if hasattr(container, "calc_intents_batch"):
+        start = time.perf_counter()
+        container.calc_intents_batch(queries, top_k=1)
+        metrics["batch_throughput"] = len(queries) / \
+            (time.perf_counter() - start)
+    if not fuzz and hasattr(container, "save"):
+        # restarting from a snapshot instead of registering again
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "snapshot.json")
+            container.save(path)
+            start = time.perf_counter()
+            loaded = IntentContainer.load(path)
+            loaded.calc_intent(queries[0])
+            metrics["warm_start"] = import_time + \
+                time.perf_counter() - start
+            loaded.close()
+    if hasattr(container, "close"):
+        container.close()
+
+    # ru_maxrss is in KiB on linux, bytes on macos
+    unit = 1 if sys.platform == "darwin" else 1024
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    metrics["peak_rss_mb"] = rss / 2 ** 20
+    # largest worker process, for the process backend
+    workers_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    metrics["worker_peak_rss_mb"] = workers_rss / 2 ** 20
+    queue.put({"fuzz": fuzz, "templates": n_templates, "metrics": metrics})
+
+
+def run(scenario: dict) -> List[dict]:
+    """
+    Run a scenario in a fresh process per fuzz setting
+    @param scenario: dict with intents, depth, slots, entity_size, backend,
+        workers and queries
+    @return: one record per fuzz setting, none if the benchmarked commit
+        does not support the scenario backend
+    """
+    ctx = multiprocessing.get_context("spawn")
+    records = []
+    for fuzz in (False, True):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run_scenario,
+                           args=(scenario, fuzz, queue))
+        proc.start()
+        record = queue.get()
+        proc.join()
+        if record is None:
+            print(f"skipping the {scenario['backend']} backend, not "
+                  f"available in this commit", file=sys.stderr)
+            break
+        record.update(scenario)
+        records.append(record)
+    return records
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _key(record: dict) -> tuple:
+    return (record["intents"], record["depth"], record["slots"],
+            record["entity_size"], record["backend"], record["fuzz"])
+
+
+def compare(before: dict, after: dict, threshold: float = 0.1) -> int:
+    """
+    Print the relative change of every metric between two runs
+    @param before: baseline results
+    @param after: new results
+    @param threshold: relative change reported as a regression
+    @return: number of regressions
+    """
+    baseline = {_key(r): r["metrics"] for r in before["results"]}
+    regressions = 0
+    for record in after["results"]:
+        old = baseline.get(_key(record))
+        if old is None:
+            continue
+        name = "intents={} depth={} slots={} entities={} {} fuzz={}".format(
+            *_key(record))
+        print(name)
+        for metric, value in record["metrics"].items():
+            if not old.get(metric):
+                continue
+            change = (value - old[metric]) / old[metric]
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"  {metric:<18} {old[metric]:>12.6g} -> {value:>12.6g} "
+                  f"({change:+.1%}){flag}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--preset", choices=PRESETS, default="default")
+    parser.add_argument("--intents", type=int, nargs="+")
+    parser.add_argument("--depth", type=int, nargs="+")
+    parser.add_argument("--slots", type=int, nargs="+")
+    parser.add_argument("--entity-size", type=int, nargs="+")
+    parser.add_argument("--backends", nargs="+")
+    parser.add_argument("--queries", type=int)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change flagged as a regression")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        runs = []
+        for path in args.compare:
+            with open(path) as f:
+                runs.append(json.load(f))
+        return 1 if compare(*runs, threshold=args.threshold) else 0
+
+    config: Dict = dict(PRESETS[args.preset])
+    for option in ("intents", "depth", "slots", "entity_size", "backends",
+                   "queries"):
+        if getattr(args, option) is not None:
+            config[option] = getattr(args, option)
+
+    results = []
+    for n, depth, slots, size, backend in itertools.product(
+            config["intents"], config["depth"], config["slots"],
+            config["entity_size"], config["backends"]):
+        scenario = {"intents": n, "depth": depth, "slots": slots,
+                    "entity_size": size, "backend": backend,
+                    "workers": args.workers, "queries": config["queries"]}
+        for record in run(scenario):
+            results.append(record)
+            m = record["metrics"]
+            print(f"intents={n} depth={depth} slots={slots} entities={size} "
+                  f"{backend} fuzz={record['fuzz']}: "
+                  f"register {m['register_time']:.3f}s "
+                  f"p50 {m['p50'] * 1000:.2f}ms p99 {m['p99'] * 1000:.2f}ms "
+                  f"{m['throughput']:.0f} q/s rss {m['peak_rss_mb']:.0f}MB",
+                  file=sys.stderr)
+
+    from padacioso.version import VERSION_MAJOR, VERSION_MINOR, \
+        VERSION_BUILD, VERSION_ALPHA
+    output = {"meta": {"commit": _git_commit(),
+                       "padacioso": f"{VERSION_MAJOR}.{VERSION_MINOR}."
+                                    f"{VERSION_BUILD}a{VERSION_ALPHA}",
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "cpus": os.cpu_count(),
+                       "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "config": config},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
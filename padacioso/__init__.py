@@ -1,42 +1,129 @@
-import concurrent.futures
-from typing import List, Iterator, Optional
+import asyncio
+import heapq
+import re
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+from itertools import count
+from typing import AsyncIterator, Dict, Hashable, Iterable, List, \
+    Iterator, Mapping, Optional, Set
 
 import simplematch
 
-from padacioso.bracket_expansion import expand_parentheses, normalize_example
+from padacioso.automaton import GAP, TemplateAutomaton, _fold, \
+    tokenize_template
+from padacioso.backends import get_backend
+from padacioso.entities import EntitySamples
+from padacioso.filters import ContextFilter, KeywordAutomaton
+from padacioso.instrumentation import Observer, Trace
+from padacioso.bracket_expansion import expand_parentheses, normalize_example, \
+    iter_expand_parentheses, count_expansions, is_bracketed
+from padacioso.matchers import SHARED_MATCHERS, EntityMatcher, \
+    NullMatcher, Template, matcher_memory_usage, new_matcher, \
+    validate_template, vocabulary_regex
+from padacioso.prefilter import TokenIndex, query_tokens
+from padacioso.similarity import get_similarity_backend
+from padacioso.snapshot import read_snapshot, source_hash, write_snapshot
 
 try:
     from ovos_utils.log import LOG
-    from ovos_utils.parse import fuzzy_match  # uses rapidfuzz for performance
 except ImportError:
     import logging
 
     LOG = logging.getLogger('padacioso')
 
-    from difflib import SequenceMatcher
 
-
-    def fuzzy_match(x, against):
-        """Perform a 'fuzzy' comparison between two strings.
-        Returns:
-            float: match percentage -- 1.0 for perfect match,
-                   down to 0.0 for no match at all.
-        """
-        return SequenceMatcher(None, x, against).ratio()
+# match stages, in ranking order, see IntentContainer._rank_key
+_LITERAL, _REGEX, _FUZZY = 0, 1, 2
+# owner holding the templates kept by IntentContainer.replace_intent
+_REPLACING = object()
 
 
 class IntentContainer:
-    def __init__(self, fuzz=False, n_workers=4):
+    def __init__(self, fuzz=False, n_workers=4, backend="inline",
+                 expansion_budget=512, similarity="difflib",
+                 constrain_entities=False, warm_up=False):
+        """
+        @param fuzz: if True, fall back to fuzzy matching
+        @param n_workers: number of workers for the thread/process backends
+        @param backend: where matching runs, one of "inline", "thread"
+            or "process"
+        @param expansion_budget: intent lines expanding to more templates
+            than this are compiled into a single regex instead
+        @param similarity: fuzzy scoring metric, "difflib" or "indel", see
+            padacioso.similarity
+        @param constrain_entities: if True, `{entity}` slots of registered
+            entities first try to match only the entity values, before
+            falling back to capturing any text
+        @param warm_up: if True, every registration schedules `warm_up` in
+            the background, in the worker processes too
+        """
         self.intent_samples, self.entity_samples = {}, {}
         # self.intents, self.entities = {}, {}
         self.fuzz = fuzz
+        self.constrain_entities = constrain_entities
+        # template -> slot name -> regex of the entity values, see
+        # _compile_constrained
+        self._constrained = {}
+        # slot name -> templates with that slot
+        self._slot_templates = {}
+        # entity name -> regex of its values
+        self._vocabularies = {}
         self.workers = n_workers
-        self._cased_matchers = {}
-        self._uncased_matchers = {}
+        self.expansion_budget = expansion_budget
+        self._similarity = get_similarity_backend(similarity)
+        self._backend = get_backend(backend, self, n_workers)
+        # template -> matcher, shared with other containers, see
+        # padacioso.matchers
+        self._matchers = SHARED_MATCHERS
+        # (template, case_sensitive) -> references held in self._matchers,
+        # released when the container is garbage collected
+        self._matcher_refs = Counter()
+        weakref.finalize(self, self._matchers.release_all,
+                         self._matcher_refs)
+        # template -> Template record, with the intents using it
+        self._templates: Dict[str, Template] = {}
+        # serializes the lazy compilation of matchers, see _matcher
+        self._compile_lock = threading.Lock()
+        self.auto_warm_up = warm_up
+        # intent name -> times it was matched, orders the warm up
+        self._hits = Counter()
+        self._warm_up_thread: Optional[threading.Thread] = None
+        # set when templates are added while warming up, or to stop
+        self._warm_up_pending = False
+        self._warm_up_stop = threading.Event()
+        # intent name -> registration sequence number, used to break ties
+        self._intent_order = {}
+        self._intent_seq = count()
+        # intent name -> hash of the lines it was registered from
+        self._intent_sources = {}
+        # key -> pending asyncio future, see _track
+        self._pending = {}
+        # bumped on every change that can alter match results, lets callers
+        # tell if cached results are stale
+        self.generation = 0
+        self._automaton = TemplateAutomaton()
+        # template -> compiled fuzzed variants, see _get_fuzzy_matchers
+        self._fuzzy_matchers = {}
+        # case folded sentence -> templates without slots or wildcards
+        self._literals = {}
+        # unexpanded (one|of) templates, see BracketMatcher
+        self._bracketed = set()
+        self._token_index = TokenIndex()
+        self._prefilter_counts = dict.fromkeys(
+            ("queries", "exact_hits", "exact_skips",
+             "fuzzy_hits", "fuzzy_skips"), 0)
         self.available_contexts = {}
         self.required_contexts = {}
         self.excluded_keywords = {}
         self.excluded_contexts = {}
+        # compiled from the above, see _filter
+        self._keyword_filter = KeywordAutomaton()
+        self._context_filter = ContextFilter()
+        # instrumentation, see add_observer
+        self._observers: List[Observer] = []
 
         if "word" not in simplematch.types:
             LOG.debug(f"Registering `word` type")
@@ -50,6 +137,9 @@ class IntentContainer:
         @param sample: Utterance example to mutate
         @return: list of fuzzy string alternatives to `sample`
         """
+        if is_bracketed(sample):
+            # words can not be replaced without breaking the groups
+            return [f"* {sample}", f"{sample} *"]
         fuzzed = []
         words = sample.split(" ")
         for idx in range(0, len(words)):
@@ -60,6 +150,110 @@ class IntentContainer:
             fuzzed.append(" ".join(new_words))
         return fuzzed + [f"* {sample}", f"{sample} *"]
 
+    @staticmethod
+    def _new_matcher(template: str, case_sensitive: bool) -> \
+            simplematch.Matcher:
+        """
+        Compile a matcher for an expanded (or bracketed) template
+        """
+        return new_matcher(template, case_sensitive)
+
+    def _acquire_matcher(self, template: str,
+                         case_sensitive: bool) -> simplematch.Matcher:
+        """
+        Get a shared matcher, holding a reference to it
+        """
+        matcher = self._matchers.acquire(template, case_sensitive)
+        self._matcher_refs[(template, case_sensitive)] += 1
+        return matcher
+
+    def _matcher(self, template: Template, case_sensitive: bool,
+                 constrained: bool = False) -> simplematch.Matcher:
+        """
+        Get the matcher of a template, compiling it on first use. Case
+        insensitive matchers are only needed when a case sensitive match
+        fails, and reuse the regex of the case sensitive one
+        @param constrained: get the EntityMatcher restricting the slots to
+            the values of registered entities instead, see
+            `_compile_constrained`
+        """
+        attr = ("entity_" if constrained else "") + \
+            ("cased" if case_sensitive else "uncased")
+        matcher = getattr(template, attr)
+        if matcher is None:
+            with self._compile_lock:
+                matcher = getattr(template, attr)
+                if matcher is not None:
+                    return matcher
+                vocabulary = self._constrained.get(template.text)
+                if constrained and vocabulary is None:
+                    # entities removed meanwhile
+                    return NullMatcher()
+                if self._templates.get(template.text) is not template:
+                    # removed meanwhile, do not leak a shared reference
+                    if constrained:
+                        return NullMatcher()
+                    return self._new_matcher(template.text, case_sensitive)
+                try:
+                    if constrained:
+                        # specific to the entities of this container, so
+                        # not shared
+                        matcher = EntityMatcher(template.text, vocabulary,
+                                                case_sensitive)
+                    else:
+                        matcher = self._acquire_matcher(template.text,
+                                                        case_sensitive)
+                except Exception as e:
+                    # only this template stops matching
+                    LOG.error(f"failed to compile '{template.text}': {e}")
+                    matcher = NullMatcher()
+                    if not constrained:
+                        template.cased = template.uncased = matcher
+                setattr(template, attr, matcher)
+        return matcher
+
+    @property
+    def _cased_matchers(self) -> Mapping[str, simplematch.Matcher]:
+        """
+        template -> case sensitive matcher, compiled on access
+        """
+        return _MatcherView(self, True)
+
+    @property
+    def _uncased_matchers(self) -> Mapping[str, simplematch.Matcher]:
+        """
+        template -> case insensitive matcher, compiled on access
+        """
+        return _MatcherView(self, False)
+
+    def _release_matcher(self, template: str, case_sensitive: bool):
+        """
+        Drop a reference taken by `_acquire_matcher`
+        """
+        key = (template, case_sensitive)
+        if self._matcher_refs[key] > 0:
+            self._matcher_refs[key] -= 1
+            if not self._matcher_refs[key]:
+                del self._matcher_refs[key]
+            self._matchers.release(template, case_sensitive)
+
+    def _expand(self, line: str) -> Iterator[str]:
+        """
+        Expand a single intent line, unless it exceeds the expansion budget
+        @param line: intent example with (one|of) and [optional] syntax
+        @return: yields templates
+        """
+        line = normalize_example(line)
+        if self.expansion_budget:
+            count = count_expansions(line)
+            if count > self.expansion_budget:
+                LOG.warning(f"'{line}' expands to {count} templates, over "
+                            f"the budget of {self.expansion_budget}. "
+                            f"Compiling it as a single regex instead")
+                yield line.strip()
+                return
+        yield from iter_expand_parentheses(line)
+
     def add_intent(self, name: str, lines: List[str]):
         """
         Add an intent with examples.
@@ -69,17 +263,128 @@ class IntentContainer:
         if name in self.intent_samples:
             raise RuntimeError(f"Attempted to re-register existing intent: "
                                f"{name}")
-        expanded = []
-        for l in lines:
-            expanded += expand_parentheses(normalize_example(l))
-        regexes = list(set(expanded))
+        self._add_expanded_intent(name, self._expand_lines(lines))
+        self._intent_sources[name] = source_hash(lines)
+        self.generation += 1
+        self._backend.sync("add_intent", name, lines)
+        self._schedule_warm_up()
+
+    def add_intents(self, intents: Dict[str, List[str]]):
+        """
+        Add several intents at once, eg. all the intents of a skill. Caches
+        and worker processes are updated once for the whole batch
+        @param intents: intent name -> list of intent regexes
+        """
+        existing = [name for name in intents if name in self.intent_samples]
+        if existing:
+            raise RuntimeError(f"Attempted to re-register existing intents: "
+                               f"{existing}")
+        if not intents:
+            return
+        # expand everything first, a bad line leaves the container untouched
+        expanded = {name: self._expand_lines(lines)
+                    for name, lines in intents.items()}
+        for name, regexes in expanded.items():
+            self._add_expanded_intent(name, regexes)
+            self._intent_sources[name] = source_hash(intents[name])
+        self.generation += 1
+        self._backend.sync("add_intents", intents)
+        self._schedule_warm_up()
+
+    def replace_intent(self, name: str, lines: List[str]) -> bool:
+        """
+        Replace the examples of an intent in place, keeping its registration
+        order (see `calc_intent`) and the matchers of unchanged templates.
+        Adds the intent if it is not registered
+        @param name: name of intent to replace
+        @param lines: list of intent regexes
+        @return: False if the intent already had these examples
+        """
+        source = source_hash(lines)
+        if name not in self.intent_samples:
+            self.add_intent(name, lines)
+            return True
+        if self._intent_sources.get(name) == source:
+            return False
+        order = self._intent_order[name]
+        regexes = self._expand_lines(lines)
+        # keep the templates (and matchers) reused by the new examples
+        kept = [self._templates[r] for r in
+                set(regexes).intersection(self.intent_samples[name])]
+        for template in kept:
+            template.owners.add(_REPLACING)
+        self._discard_intent(name)
+        self._add_expanded_intent(name, regexes)
+        for template in kept:
+            template.owners.discard(_REPLACING)
+        self._intent_order[name] = order
+        self._intent_sources[name] = source
+        self.generation += 1
+        self._backend.sync("replace_intent", name, lines)
+        self._schedule_warm_up()
+        return True
+
+    def _expand_lines(self, lines: List[str]) -> List[str]:
+        """
+        @param lines: list of intent regexes
+        @return: expanded templates, most specific first
+        """
+        regexes = list({r for l in lines for r in self._expand(l)})
         regexes.sort(key=len, reverse=True)
+        for r in regexes:
+            validate_template(r)
+        return regexes
+
+    def _restore_intent(self, name: str, regexes: List[str],
+                        source: Optional[str] = None):
+        """
+        Add an intent from the expanded templates stored in a snapshot
+        @param name: name of intent to add
+        @param regexes: list of expanded intent regexes, most specific first
+        @param source: hash of the lines the templates were expanded from
+        """
+        if name in self.intent_samples:
+            raise RuntimeError(f"Attempted to re-register existing intent: "
+                               f"{name}")
+        for r in regexes:
+            validate_template(r)
+        self._add_expanded_intent(name, regexes)
+        if source:
+            self._intent_sources[name] = source
+        self.generation += 1
+        self._backend.sync("_restore_intent", name, regexes, source)
+        self._schedule_warm_up()
+
+    def _add_expanded_intent(self, name: str, regexes: List[str]):
+        """
+        Register an intent from already expanded samples
+        @param name: name of intent to add
+        @param regexes: list of expanded intent regexes, most specific first
+        """
+        # templates repeat across intents and containers, keep one copy
+        regexes = [sys.intern(r) for r in regexes]
         self.intent_samples[name] = regexes
+        self._intent_order[name] = next(self._intent_seq)
         for r in regexes:
-            self._cased_matchers[r] = \
-                simplematch.Matcher(r, case_sensitive=True)
-            self._uncased_matchers[r] = \
-                simplematch.Matcher(r, case_sensitive=False)
+            template = self._templates.get(r)
+            if template is None:
+                # matchers are compiled on first use (or by warm_up), one
+                # per template, shared by all intents using it
+                template = self._templates[r] = Template(r, _is_literal(r))
+                if is_bracketed(r):
+                    self._bracketed.add(r)
+                elif template.literal:
+                    self._literals.setdefault(_fold(r), set()).add(r)
+                    self._token_index.add(r)
+                else:
+                    self._automaton.add(r)
+                    self._token_index.add(r)
+                    if self.constrain_entities:
+                        for slot in _slot_names(r):
+                            self._slot_templates.setdefault(
+                                slot, set()).add(r)
+                        self._compile_constrained(r)
+            template.owners.add(name)
 
     def remove_intent(self, name: str):
         """
@@ -87,27 +392,195 @@ class IntentContainer:
         @param name: name of intent to remove
         """
         if name in self.intent_samples:
-            regexes = self.intent_samples.pop(name)
-            for rx in regexes:
-                if rx in self._cased_matchers:
-                    self._cased_matchers.pop(rx)
-                if rx in self._uncased_matchers:
-                    self._uncased_matchers.pop(rx)
+            self._discard_intent(name)
+            self._hits.pop(name, None)
+            self.generation += 1
+            self._backend.sync("remove_intent", name)
+
+    def _discard_intent(self, name: str):
+        """
+        Unregister an intent, releasing the templates no other intent uses
+        """
+        regexes = self.intent_samples.pop(name)
+        self._intent_sources.pop(name, None)
+        self._intent_order.pop(name, None)
+        for rx in regexes:
+            template = self._templates.get(rx)
+            if template is None:
+                continue
+            template.owners.discard(name)
+            if not template.owners:
+                # last intent using the template
+                with self._compile_lock:
+                    del self._templates[rx]
+                    if template.cased is not None:
+                        self._release_matcher(rx, True)
+                    if template.uncased is not None:
+                        self._release_matcher(rx, False)
+                    for s, _ in self._fuzzy_matchers.pop(rx, []):
+                        self._release_matcher(s, False)
+                self._automaton.remove(rx)
+                self._token_index.remove(rx)
+                self._bracketed.discard(rx)
+                self._discard_literal(rx)
+                self._constrained.pop(rx, None)
+                self._discard_slots(rx)
+
+    def _discard_slots(self, template: str):
+        for slot in _slot_names(template):
+            templates = self._slot_templates.get(slot)
+            if templates is not None:
+                templates.discard(template)
+                if not templates:
+                    del self._slot_templates[slot]
+
+    def _compile_constrained(self, template: str):
+        """
+        Restrict the slots of a template to the values of registered
+        entities, if any. The regex of each entity is built once and shared
+        by its templates, their matchers are compiled on first use, see
+        `_matcher`
+        @param template: expanded intent template
+        """
+        vocabulary = {}
+        for slot in _slot_names(template):
+            if slot in self.entity_samples:
+                if slot not in self._vocabularies:
+                    self._vocabularies[slot] = vocabulary_regex(
+                        self.entity_samples[slot])
+                vocabulary[slot] = self._vocabularies[slot]
+        with self._compile_lock:
+            if vocabulary:
+                self._constrained[template] = vocabulary
+            else:
+                self._constrained.pop(template, None)
+            record = self._templates.get(template)
+            if record is not None:
+                # outdated, compiled again on the next use
+                record.entity_cased = record.entity_uncased = None
+
+    def _entity_changed(self, *names: str):
+        """
+        Recompile the constrained matchers of the templates using entities
+        """
+        templates = set()
+        for name in names:
+            self._vocabularies.pop(name, None)
+            templates.update(self._slot_templates.get(name, ()))
+        for template in templates:
+            self._compile_constrained(template)
+
+    def _discard_literal(self, template: str):
+        key = _fold(template)
+        literals = self._literals.get(key)
+        if literals is not None:
+            literals.discard(template)
+            if not literals:
+                del self._literals[key]
 
     def add_entity(self, name: str, lines: List[str]):
         """
-        Add an entity with examples.
+        Add an entity with examples. Adding an existing entity merges the
+        new examples into it.
         @param name: name of entity to add
         @param lines: list of entity examples
         """
-        if name in self.entity_samples:
-            raise RuntimeError(f"Attempted to re-register existing entity: "
-                               f"{name}")
         name = name.lower()
+        if not self._merge_entity(name, lines):
+            return  # nothing new
+        self._entity_changed(name)
+        self.generation += 1
+        self._backend.sync("add_entity", name, lines)
+
+    def add_entities(self, entities: Dict[str, List[str]]):
+        """
+        Add several entities at once, see `add_entity`. Templates using the
+        entities are recompiled once for the whole batch
+        @param entities: entity name -> list of entity examples
+        """
+        changed = [name.lower() for name, lines in entities.items()
+                   if self._merge_entity(name.lower(), lines)]
+        if not changed:
+            return  # nothing new
+        self._entity_changed(*changed)
+        self.generation += 1
+        self._backend.sync("add_entities", entities)
+
+    def _merge_entity(self, name: str, lines: List[str]) -> bool:
+        """
+        Merge examples into an entity, creating it if needed
+        @return: True if the entity changed
+        """
         expanded = []
         for l in lines:
             expanded += expand_parentheses(l)
-        self.entity_samples[name] = expanded
+        if name in self.entity_samples:
+            return bool(self.entity_samples[name].update(expanded))
+        self.entity_samples[name] = EntitySamples(expanded)
+        return True
+
+    def intent_memory_usage(self) -> Dict[str, int]:
+        """
+        Approximate memory used by each intent, its expanded templates and
+        their compiled matchers (fuzzy variants included). Templates shared
+        by several intents are split evenly between them
+        @return: intent name -> size in bytes
+        """
+        usage = {}
+        for name, regexes in self.intent_samples.items():
+            size = sys.getsizeof(regexes)
+            for r in regexes:
+                template = self._templates[r]
+                size += self._template_memory_usage(template) // \
+                    max(len(template.owners), 1)
+            usage[name] = size
+        return usage
+
+    def _template_memory_usage(self, template: Template) -> int:
+        """
+        Approximate memory used by a template record and its matchers
+        """
+        size = sys.getsizeof(template) + sys.getsizeof(template.text) + \
+            sys.getsizeof(template.owners)
+        for matcher in (template.cased, template.uncased,
+                        template.entity_cased, template.entity_uncased):
+            if matcher is not None:
+                size += matcher_memory_usage(matcher)
+        for s, matcher in self._fuzzy_matchers.get(template.text, ()):
+            size += sys.getsizeof(s) + matcher_memory_usage(matcher)
+        return size
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Approximate memory footprint of the container. Matchers shared with
+        other containers are fully counted in each of them
+        @return: dict of sizes in bytes: "templates" (template records and
+            their compiled matchers), "intents" (expanded template lists),
+            "indexes" (automaton, prefilter and literal lookup), "entities"
+            and "total"
+        """
+        usage = {
+            "templates": sum(self._template_memory_usage(t)
+                             for t in self._templates.values()),
+            "intents": sys.getsizeof(self.intent_samples) + sum(
+                sys.getsizeof(regexes)
+                for regexes in self.intent_samples.values()),
+            "indexes": self._automaton.memory_usage() +
+            self._token_index.memory_usage() +
+            sys.getsizeof(self._literals) + sum(
+                sys.getsizeof(v) for v in self._literals.values()),
+            "entities": sum(self.entity_memory_usage().values())
+        }
+        usage["total"] = sum(usage.values())
+        return usage
+
+    def entity_memory_usage(self) -> Dict[str, int]:
+        """
+        Approximate memory used by each entity
+        @return: entity name -> size in bytes
+        """
+        return {name: samples.memory_usage()
+                for name, samples in self.entity_samples.items()}
 
     def remove_entity(self, name: str):
         """
@@ -117,81 +590,292 @@ class IntentContainer:
         name = name.lower()
         if name in self.entity_samples:
             del self.entity_samples[name]
+            self._entity_changed(name)
+            self.generation += 1
+            self._backend.sync("remove_entity", name)
 
-    def _filter(self, query: str):
+    def _filter(self, query: str) -> Set[str]:
         # filter intents based on context/excluded keywords
-        excluded_intents = []
-        for intent_name, samples in self.excluded_keywords.items():
-            if any(s in query for s in samples):
-                excluded_intents.append(intent_name)
-        for intent_name, contexts in self.required_contexts.items():
-            if intent_name not in self.available_contexts:
-                excluded_intents.append(intent_name)
-            elif any(context not in self.available_contexts[intent_name]
-                     for context in contexts):
-                excluded_intents.append(intent_name)
-        for intent_name, contexts in self.excluded_contexts.items():
-            if intent_name not in self.available_contexts:
-                continue
-            if any(context in self.available_contexts[intent_name]
-                   for context in contexts):
-                excluded_intents.append(intent_name)
+        start = time.perf_counter() if self._observers else None
+        excluded_intents = self._keyword_filter.scan(query)
+        excluded_intents |= self._context_filter.excluded
+        if start is not None:
+            self._emit_timing("filter", time.perf_counter() - start)
         return excluded_intents
 
-    def _match(self, query, intent_name, regexes):
+    def _match_exact(self, query, intent_name, regexes, candidates=None):
+        """
+        Match a query against the templates of an intent, the first
+        template that matches (most specific first) decides the confidence
+        @param query: input to evaluate for an intent match
+        @param intent_name: name of the intent being evaluated
+        @param regexes: templates of the intent
+        @param candidates: if set, templates not in here are known not to
+            match and are skipped
+        @return: dict intent match (or None)
+        """
+        found = self._find_exact(query, intent_name, regexes, candidates)
+        if found is not None:
+            return found[0]
+
+    def _find_exact(self, query, intent_name, regexes, candidates=None,
+                    trace: Optional[Trace] = None):
+        """
+        Same as `_match_exact`, also returning the template that matched
+        @param trace: if set, counters are recorded in it
+        @return: tuple of (dict intent match, template) or None
+        """
+        folded = None
         for r in regexes:
+            if candidates is not None and r not in candidates:
+                continue
+            if trace is not None:
+                trace.count("templates_tried")
+            template = self._templates[r]
+            if template.literal:
+                # plain sentences are compared without running any regex
+                if r == query:
+                    return {"entities": {}, "conf": 1 - 0,
+                            "name": intent_name}, r
+                if folded is None:
+                    folded = _fold(query)
+                if _fold(r) == folded:
+                    # penalize case mismatch
+                    return {"entities": {}, "conf": 1 - 0.05,
+                            "name": intent_name}, r
+                continue
             penalty = 0
             if "*" in r:
                 # penalize wildcards
                 penalty = 0.15
-            if r not in self._cased_matchers:
-                LOG.warning(f"{r} not initialized")
-                self._cased_matchers[r] = \
-                    simplematch.Matcher(r, case_sensitive=True)
-            entities = self._cased_matchers[r].match(query)
+            # slots restricted to entity values, tried first
+            constrained = r in self._constrained
+            entities = None
+            if constrained:
+                matcher = template.entity_cased or \
+                    self._matcher(template, True, constrained=True)
+                entities = matcher.match(query)
+            if entities is None:
+                matcher = template.cased or self._matcher(template, True)
+                entities = matcher.match(query)
+            if trace is not None:
+                trace.count("regex_executions", 1 + constrained)
             if entities is not None:
-                for k, v in entities.items():
-                    if k not in self.entity_samples:
-                        # penalize unregistered entities
-                        penalty += 0.04
-                    elif str(v) not in self.entity_samples[k]:
-                        # penalize parsed entity value not in samples
-                        penalty += 0.1
+                penalty = self._entity_penalty(entities, penalty, 0.04,
+                                               trace)
                 return {"entities": entities or {},
                         "conf": 1 - penalty,
-                        "name": intent_name}
+                        "name": intent_name}, r
 
-            if r not in self._uncased_matchers:
-                LOG.warning(f"{r} not initialized")
-                self._uncased_matchers[r] = \
-                    simplematch.Matcher(r, case_sensitive=False)
-            entities = self._uncased_matchers[r].match(query)
+            entities = None
+            if constrained:
+                matcher = template.entity_uncased or \
+                    self._matcher(template, False, constrained=True)
+                entities = matcher.match(query)
+            if entities is None:
+                # only compiled once a query needs it
+                matcher = template.uncased or self._matcher(template, False)
+                entities = matcher.match(query)
+            if trace is not None:
+                trace.count("regex_executions", 1 + constrained)
             if entities is not None:
                 # penalize case mismatch
                 penalty += 0.05
-                for k, v in entities.items():
-                    if k not in self.entity_samples:
-                        # penalize unregistered entities
-                        penalty += 0.05
-                    elif str(v) not in self.entity_samples[k]:
-                        # penalize parsed entity value not in samples
-                        penalty += 0.1
+                penalty = self._entity_penalty(entities, penalty, 0.05,
+                                               trace)
                 return {"entities": entities or {},
                         "conf": 1 - penalty,
-                        "name": intent_name}
+                        "name": intent_name}, r
 
-        if self.fuzz:
+    def _entity_penalty(self, entities: dict, penalty: float,
+                        unregistered: float,
+                        trace: Optional[Trace] = None) -> float:
+        """
+        Add the penalties of the entities captured by a template
+        @param entities: captured entity name -> value
+        @param penalty: penalty of the match so far
+        @param unregistered: penalty of each entity that is not registered
+        @param trace: if set, the time spent is recorded in it
+        @return: penalty of the match
+        """
+        start = time.perf_counter() if trace is not None else None
+        for k, v in entities.items():
+            if k not in self.entity_samples:
+                # penalize unregistered entities
+                penalty += unregistered
+            elif str(v) not in self.entity_samples[k]:
+                # penalize parsed entity value not in samples
+                penalty += 0.1
+        if start is not None:
+            trace.add_time("entity_penalty", time.perf_counter() - start)
+            trace.count("entity_checks", len(entities))
+        return penalty
+
+    def warm_up(self, wait: bool = False) -> Optional[threading.Thread]:
+        """
+        Compile the matchers not compiled yet, instead of on first use.
+        Templates of the most matched intents go first, then in registration
+        order. Case insensitive matchers stay lazy, they are only needed when
+        a query does not match the case of a template. With the process
+        backend the workers match queries, so they warm up instead
+        @param wait: compile in the calling thread instead of in the
+            background
+        @return: the background thread, None if `wait` or if the workers
+            warm up
+        """
+        if not self._backend.shares_state:
+            self._backend.start()
+            if wait:
+                self._backend.broadcast("warm_up", True)
+            else:
+                self._backend.sync("warm_up")
+            return None
+        if wait:
+            self._warm_up()
+            return None
+        with self._compile_lock:
+            self._warm_up_pending = True
+            thread = self._warm_up_thread
+            if thread is None or not thread.is_alive():
+                thread = self._warm_up_thread = threading.Thread(
+                    target=self._warm_up_loop, name="padacioso-warm-up",
+                    daemon=True)
+                thread.start()
+        return thread
+
+    def _schedule_warm_up(self):
+        # process workers warm up on their own, see _from_state
+        if self.auto_warm_up and self._backend.shares_state and \
+                not self._warm_up_stop.is_set():
+            self.warm_up()
+
+    def _warm_up_loop(self):
+        while True:
+            with self._compile_lock:
+                if not self._warm_up_pending or self._warm_up_stop.is_set():
+                    # clear the thread under the lock, so a registration
+                    # made now starts a new one
+                    self._warm_up_thread = None
+                    return
+                self._warm_up_pending = False
+            try:
+                self._warm_up()
+            except Exception as e:
+                LOG.error(f"failed to warm up matchers: {e}")
+
+    def _warm_up(self):
+        """
+        Compile the pending matchers once, in priority order
+        """
+        hits = self._hits
+        order = self._intent_order
+        priority = {}
+        for name, regexes in list(self.intent_samples.items()):
+            rank = (-hits.get(name, 0), order.get(name, 0))
             for r in regexes:
-                penalty = 0.25
-                for s in self._get_fuzzed(r):
-                    entities = self._fuzzy_score(query, s, penalty)
-                    if entities:
-                        entities["name"] = intent_name
-                        return entities
+                if r not in priority or rank < priority[r]:
+                    priority[r] = rank
+        for r in sorted(priority, key=priority.get):
+            if self._warm_up_stop.is_set():
+                return
+            template = self._templates.get(r)
+            if template is None:
+                continue
+            if not template.literal:
+                self._matcher(template, True)
+            if r in self._constrained:
+                self._matcher(template, True, constrained=True)
+            if self.fuzz:
+                self._get_fuzzy_matchers(r)
 
-    def _fuzzy_score(self, query, s, penalty=0.25):
-        entities = simplematch.match(s, query, case_sensitive=False)
+    def _get_fuzzy_matchers(self, template: str) -> List[tuple]:
+        """
+        Get the fuzzed variants of a template, compiled once and reused
+        for every query
+        @param template: expanded intent template
+        @return: list of (variant, case insensitive matcher) tuples
+        """
+        fuzzed = self._fuzzy_matchers.get(template)
+        if fuzzed is None:
+            with self._compile_lock:
+                fuzzed = self._fuzzy_matchers.get(template)
+                if fuzzed is None:
+                    if template not in self._templates:
+                        # removed meanwhile, do not leak shared references
+                        return [(s, self._new_matcher(s, False))
+                                for s in self._get_fuzzed(template)]
+                    fuzzed = []
+                    try:
+                        for s in self._get_fuzzed(template):
+                            fuzzed.append((s, self._acquire_matcher(s,
+                                                                    False)))
+                    except Exception as e:
+                        LOG.error(f"failed to compile the fuzzy variants "
+                                  f"of '{template}': {e}")
+                        for s, _ in fuzzed:
+                            self._release_matcher(s, False)
+                        fuzzed = []
+                    self._fuzzy_matchers[template] = fuzzed
+        return fuzzed
 
+    @property
+    def similarity_backend(self) -> str:
+        """
+        Name of the similarity implementation scoring fuzzy matches
+        """
+        return self._similarity.name
+
+    def _match_fuzzy(self, query, intent_name, regexes, candidates=None,
+                     best=0.0):
+        """
+        Match a query against the fuzzed templates of an intent, the first
+        fuzzed variant that matches decides the confidence
+        @param query: input to evaluate for an intent match
+        @param intent_name: name of the intent being evaluated
+        @param regexes: templates of the intent
+        @param candidates: if set, only fuzz templates in here
+        @param best: confidence of the best match found so far, the intent
+            is dropped as soon as it can not score above it
+        @return: dict intent match (or None)
+        """
+        found = self._find_fuzzy(query, regexes, candidates, best)
+        if found is not None:
+            s, entities, base_score = found
+            fuzzy_score = self._similarity(s, query)
+            return {"entities": entities or {},
+                    "conf": (fuzzy_score + base_score) / 2,
+                    "name": intent_name}
+
+    def _find_fuzzy(self, query, regexes, candidates=None, best=0.0,
+                    trace: Optional[Trace] = None):
+        """
+        Find the fuzzed variant deciding the fuzzy confidence of an intent,
+        without scoring its similarity yet
+        @param trace: if set, counters are recorded in it
+        @return: tuple of (variant, entities, base score) or None if there
+            is no fuzzy match able to score above `best`
+        """
+        if not self.fuzz:
+            return None
+        regexes = [r for r in regexes
+                   if candidates is None or r in candidates]
+        if best > 0 and all(
+                self._fuzzy_bound(query, s) < best
+                for r in regexes for s, _ in self._get_fuzzy_matchers(r)):
+            return None
+        for r in regexes:
+            for s, matcher in self._get_fuzzy_matchers(r):
+                entities = matcher.match(query)
+                if trace is not None:
+                    trace.count("fuzzy_variants")
+                if entities is not None:
+                    base_score = self._fuzzy_base_score(query, s)
+                    if (1 + base_score) / 2 < best:
+                        return None  # matched, but can not beat `best`
+                    return s, entities, base_score
+
+    @staticmethod
+    def _fuzzy_base_score(query, s, penalty=0.25):
         fuzzy_penalty = penalty
         if "*" in s:  # very loose regex
             fuzzy_penalty += 0.1
@@ -200,54 +884,414 @@ class IntentContainer:
         # depending on length
         diff = max(len(s) - len(query), 0)
         fuzzy_penalty += diff * 0.01
-        base_score = 1 - max(1 - fuzzy_penalty, 0)
-        fuzzy_score = fuzzy_match(s, query)
-        score = (fuzzy_score + base_score) / 2
+        return 1 - max(1 - fuzzy_penalty, 0)
 
-        if entities is not None:
-            return {"entities": entities or {},
-                    "conf": (fuzzy_score + base_score) / 2}
+    def _fuzzy_bound(self, query, s, penalty=0.25):
+        """
+        Upper bound of the confidence of a fuzzed variant, reached if the
+        similarity is perfect
+        """
+        return (1 + self._fuzzy_base_score(query, s, penalty)) / 2
 
-    def calc_intents(self, query: str) -> Iterator[dict]:
+    def calc_intents(self, query: str, top_k: Optional[int] = None,
+                     exclude_intents: Optional[Iterable[str]] = None) -> \
+            Iterator[dict]:
         """
         Determine possible intents for a given query
         @param query: input to evaluate for an intent match
+        @param top_k: if set, only yield the `top_k` best matches, best
+            first (see `calc_intent` for the ranking). Matching stops as soon
+            as the remaining intents can not rank above the ones found
+        @param exclude_intents: names of intents that must not match, on top
+            of the ones excluded by context and keywords
         @return: yields dict intent matches
         """
         # filter intents based on context/excluded keywords
         excluded_intents = self._filter(query)
+        if exclude_intents:
+            excluded_intents.update(exclude_intents)
+        yield from self._map("_match_query",
+                             [(query, excluded_intents, top_k)])[0]
 
-        # do the work in parallel instead of sequentially
-        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
-            future_to_source = {
-                executor.submit(self._match, query, intent_name, regexes): intent_name
-                for intent_name, regexes in self.intent_samples.items() if intent_name not in excluded_intents
-            }
-            for future in concurrent.futures.as_completed(future_to_source):
-                res = future.result()
-                if res is not None:
-                    yield res
+    def _match_query(self, query: str, excluded_intents,
+                     top_k: Optional[int] = None, exact: bool = True,
+                     fuzzy: bool = True,
+                     trace: Optional[Trace] = None,
+                     prefiltered: Optional[tuple] = None) -> List[dict]:
+        """
+        Match a query against all registered intents
+        @param query: input to evaluate for an intent match
+        @param excluded_intents: names of intents that must not match
+        @param top_k: if set, return only the `top_k` best matches and skip
+            work that can not change them
+        @param exact: run the exact matching stage
+        @param fuzzy: run the fuzzy matching stage, if fuzz is enabled
+        @param trace: if set, stage timings and counters are recorded in it
+        @param prefiltered: (tokens, candidates, automaton candidates) of the
+            query, computed for a whole batch, see `_prefilter_batch`
+        @return: list of dict intent matches, in registration order, or
+            best first if `top_k` is set
+        """
+        excluded_intents = set(excluded_intents)
+        counts = self._prefilter_counts
+        n_templates = len(self._token_index)
+        tokens = query_tokens(query) if prefiltered is None \
+            else prefiltered[0]
+        if trace is not None:
+            trace.count("queries")
+            start = time.perf_counter()
+
+        # intent name -> (dict intent match, stage, matched template)
+        found = {}
+        if exact:
+            self._match_exact_stage(query, tokens, excluded_intents,
+                                    top_k, found, trace, prefiltered)
+            if trace is not None:
+                now = time.perf_counter()
+                trace.add_time("exact", now - start)
+                start = now
+
+        best = self._kth_conf(found, top_k) if top_k else 0.0
+        # fuzzy matches never score above 1.0 and lose ties to exact ones
+        if fuzzy and self.fuzz and best < 1:
+            fuzzy_candidates = self._token_index.candidates(tokens, fuzzy=True)
+            counts["fuzzy_hits"] += len(fuzzy_candidates)
+            counts["fuzzy_skips"] += n_templates - len(fuzzy_candidates)
+            fuzzy_candidates.update(self._bracketed)
+            pending = []
+            profile = trace is not None and trace.intents is not None
+            for intent_name in self._owners_of(fuzzy_candidates):
+                if intent_name in excluded_intents or intent_name in found:
+                    continue
+                if profile:
+                    intent_start = time.perf_counter()
+                    variants = trace.counts.get("fuzzy_variants", 0)
+                hit = self._find_fuzzy(query,
+                                       self.intent_samples[intent_name],
+                                       fuzzy_candidates, best, trace)
+                if profile:
+                    trace.add_intent(
+                        intent_name, time.perf_counter() - intent_start,
+                        trace.counts.get("fuzzy_variants", 0) - variants)
+                if hit is not None:
+                    pending.append((intent_name, hit))
+            if trace is not None:
+                now = time.perf_counter()
+                trace.add_time("fuzzy", now - start)
+                trace.count("fuzzy_scored", len(pending))
+                start = now
+            # score all fuzzy matches in a single batched call
+            scores = self._similarity.score(query,
+                                            [f[0] for _, f in pending])
+            if trace is not None:
+                trace.add_time("similarity", time.perf_counter() - start)
+            for (intent_name, (s, entities, base_score)), fuzzy_score \
+                    in zip(pending, scores):
+                found[intent_name] = ({"entities": entities or {},
+                                       "conf": (fuzzy_score + base_score) / 2,
+                                       "name": intent_name}, _FUZZY, s)
+
+        if top_k:
+            matches = self._top_k(found, top_k)
+        else:
+            matches = [found[intent_name][0]
+                       for intent_name in self.intent_samples
+                       if intent_name in found]
+        self._hits.update(m["name"] for m in matches)
+        return matches
+
+    def calc_intents_batch(self, queries: List[str],
+                           top_k: Optional[int] = None,
+                           exclude_intents: Optional[Iterable[str]] = None) \
+            -> List[List[dict]]:
+        """
+        Determine possible intents for many queries at once. Duplicated
+        queries are matched once and the queries are sent to the backend
+        workers in one chunk per worker. Each chunk selects the candidate
+        templates of all its queries in a single prefilter and automaton
+        pass, see `_prefilter_batch`
+        @param queries: inputs to evaluate for an intent match
+        @param top_k: if set, only return the `top_k` best matches of each
+            query, best first
+        @param exclude_intents: names of intents that must not match
+        @return: list with the dict intent matches of each query, in the
+            same order as `queries`
+        """
+        exclude_intents = set(exclude_intents or [])
+        unique = list(dict.fromkeys(queries))
+        calls = [(query, self._filter(query) | exclude_intents)
+                 for query in unique]
+        matches = {}
+        chunks = self._backend.split(calls)
+        for chunk, results in zip(chunks, self._map(
+                "_match_queries", [(chunk, top_k) for chunk in chunks])):
+            for (query, _), res in zip(chunk, results):
+                matches[query] = res
+        # duplicated queries get their own copy of the results
+        return [[dict(m, entities=dict(m["entities"])) for m in matches[q]]
+                for q in queries]
+
+    def _match_queries(self, calls: List[tuple],
+                       top_k: Optional[int] = None,
+                       trace: Optional[Trace] = None) -> List[List[dict]]:
+        """
+        Run `_match_query` for a chunk of queries, sharing the prefilter
+        work between them
+        @param calls: list of (query, excluded intents) tuples
+        @return: list of intent matches for each query
+        """
+        if trace is not None:
+            start = time.perf_counter()
+        prefiltered = self._prefilter_batch([query for query, _ in calls])
+        if trace is not None:
+            trace.add_time("prefilter", time.perf_counter() - start)
+        return [self._match_query(query, excluded_intents, top_k,
+                                  trace=trace, prefiltered=entry)
+                for (query, excluded_intents), entry
+                in zip(calls, prefiltered)]
+
+    def _prefilter_batch(self, queries: List[str]) -> List[tuple]:
+        """
+        Select the candidate templates of many queries at once: the token
+        index is looked up once per distinct set of words and a single
+        automaton pass covers all the queries, see
+        `TemplateAutomaton.match_many`
+        @param queries: input utterances
+        @return: (tokens, candidates, automaton candidates) of each query
+        """
+        tokens = [query_tokens(query) for query in queries]
+        candidates = {}
+        for words in tokens:
+            key = frozenset(words)
+            if key not in candidates:
+                candidates[key] = self._token_index.candidates(words)
+        selected = [candidates[frozenset(words)] for words in tokens]
+        # the automaton only needs to run where the index found candidates
+        todo = [idx for idx, c in enumerate(selected) if c]
+        matched = [set()] * len(queries)
+        for idx, found in zip(todo, self._automaton.match_many(
+                [queries[idx] for idx in todo])):
+            matched[idx] = found
+        return [(words, c, m)
+                for words, c, m in zip(tokens, selected, matched)]
 
-    def calc_intent(self, query: str) -> Optional[dict]:
+    def _match_exact_stage(self, query: str, tokens: set, excluded_intents,
+                           top_k: Optional[int], found: dict,
+                           trace: Optional[Trace] = None,
+                           prefiltered: Optional[tuple] = None):
         """
-        Determine the best intent match for a given query
+        Exact match a query against all registered intents
+        @param tokens: words of the query, see `query_tokens`
+        @param found: intent name -> (match, stage, template), updated
+        @param trace: if set, counters are recorded in it
+        @param prefiltered: see `_match_query`
+        """
+        counts = self._prefilter_counts
+        counts["queries"] += 1
+        # skip templates missing required literal words
+        if prefiltered is None:
+            candidates = self._token_index.candidates(tokens)
+        else:
+            candidates = set(prefiltered[1])
+        counts["exact_hits"] += len(candidates)
+        counts["exact_skips"] += len(self._token_index) - len(candidates)
+        # templates without slots or wildcards are a dict lookup away
+        literals = self._literals.get(_fold(query), set())
+        # bracketed templates are not indexed, always verify them
+        candidates.update(self._bracketed)
+
+        if top_k:
+            # a cased literal hit scores a perfect 1.0 and ranks above
+            # anything else, done if there are enough of them
+            self._collect_exact(query, literals, candidates | literals,
+                                excluded_intents, found, trace)
+            perfect = [f for f in found.values()
+                       if f[1] == _LITERAL and f[0]["conf"] >= 1]
+            if len(perfect) >= top_k:
+                return
+
+        # a single pass of the automaton finds every template that can match
+        if candidates:
+            candidates = candidates.intersection(
+                self._automaton.match(query) if prefiltered is None
+                else prefiltered[2])
+        candidates.update(literals)
+        candidates.update(self._bracketed)
+        self._collect_exact(query, candidates, candidates,
+                            excluded_intents, found, trace)
+
+    def _collect_exact(self, query, templates, candidates, excluded_intents,
+                       found: dict, trace: Optional[Trace] = None):
+        """
+        Exact match the intents using any of `templates`, skipping the ones
+        excluded or already in `found`
+        @param candidates: templates that can match the query
+        @param found: intent name -> (match, stage, template), updated
+        """
+        profile = trace is not None and trace.intents is not None
+        for intent_name in self._owners_of(templates):
+            if intent_name in excluded_intents or intent_name in found:
+                continue
+            if profile:
+                start = time.perf_counter()
+                regexes = trace.counts.get("regex_executions", 0)
+            hit = self._find_exact(query, intent_name,
+                                   self.intent_samples[intent_name],
+                                   candidates, trace)
+            if profile:
+                trace.add_intent(
+                    intent_name, time.perf_counter() - start,
+                    trace.counts.get("regex_executions", 0) - regexes)
+            if hit is not None:
+                res, template = hit
+                stage = _LITERAL if self._templates[template].literal \
+                    else _REGEX
+                found[intent_name] = (res, stage, template)
+
+    @staticmethod
+    def _kth_conf(found: dict, k: int) -> float:
+        """
+        @return: confidence of the k-th best match, 0.0 if there are less
+        """
+        confs = heapq.nlargest(k, (f[0]["conf"] for f in found.values()))
+        return confs[-1] if len(confs) == k else 0.0
+
+    def _rank_key(self, intent_name: str, entry: tuple) -> tuple:
+        """
+        Sort key ranking intent matches, best first: higher confidence,
+        then literal over regex over fuzzy matches, then the template with
+        the most literal characters, then the intent registered first
+        @param entry: tuple of (dict intent match, stage, matched template)
+        """
+        res, stage, template = entry
+        return (-res["conf"], stage, -_specificity(template),
+                self._intent_order.get(intent_name, 0))
+
+    def _top_k(self, found: dict, k: int) -> List[dict]:
+        """
+        @param found: intent name -> (match, stage, template)
+        @return: the k best matches, best first
+        """
+        ranked = heapq.nsmallest(k, found.items(),
+                                 key=lambda i: self._rank_key(*i))
+        return [res for _, (res, _, _) in ranked]
+
+    def _owners_of(self, templates) -> set:
+        """
+        @param templates: iterable of templates
+        @return: names of the intents using any of the templates
+        """
+        owners = set()
+        for r in templates:
+            owners.update(self._templates[r].owners)
+        return owners
+
+    @property
+    def prefilter_stats(self) -> dict:
+        """
+        Counters of templates kept (hits) and pruned (skips) by the literal
+        word prefilter, summed over all backend workers
+        """
+        stats = dict.fromkeys(self._prefilter_counts, 0)
+        for counts in self._backend.broadcast("_get_prefilter_counts"):
+            for k, v in counts.items():
+                stats[k] += v
+        return stats
+
+    def _get_prefilter_counts(self) -> dict:
+        return dict(self._prefilter_counts)
+
+    def reset_prefilter_stats(self):
+        self._backend.broadcast("_reset_prefilter_counts")
+
+    def _reset_prefilter_counts(self):
+        for k in self._prefilter_counts:
+            self._prefilter_counts[k] = 0
+
+    def add_observer(self, observer: Observer):
+        """
+        Report the timings and counters of every matching stage, see
+        padacioso.instrumentation. Matching is not instrumented while there
+        are no observers
+        @param observer: receives the events of every query
+        """
+        self._observers.append(observer)
+
+    def remove_observer(self, observer: Observer):
+        """
+        Stop reporting events to an observer
+        """
+        if observer in self._observers:
+            self._observers.remove(observer)
+
+    def _emit_timing(self, stage: str, seconds: float):
+        for observer in self._observers:
+            observer.on_timing(stage, seconds)
+
+    def _emit(self, trace: Trace):
+        for observer in self._observers:
+            for stage, seconds in trace.timings.items():
+                observer.on_timing(stage, seconds)
+            for counter, value in trace.counts.items():
+                observer.on_count(counter, value)
+            if trace.intents and observer.profile_intents:
+                for intent_name, (seconds, regexes) in trace.intents.items():
+                    observer.on_intent(intent_name, seconds, regexes)
+
+    def _map(self, method: str, calls: List[tuple]) -> List:
+        """
+        Run `method` in the backend for every call, recording the timings of
+        the calls and of the stages they run when there are observers
+        @param method: name of the matching method, accepting a `trace`
+        @param calls: list of argument tuples
+        @return: list with the return value of each call
+        """
+        if not self._observers:
+            return self._backend.map(method, calls)
+        profile = any(o.profile_intents for o in self._observers)
+        start = time.perf_counter()
+        outputs = self._backend.map("_call_traced",
+                                    [(method, profile) + tuple(args)
+                                     for args in calls])
+        trace = Trace()
+        trace.add_time("backend", time.perf_counter() - start)
+        results = []
+        for result, call_trace in outputs:
+            results.append(result)
+            trace.merge(call_trace)
+        self._emit(trace)
+        return results
+
+    def _call_traced(self, method: str, profile_intents: bool,
+                     *args) -> tuple:
+        """
+        Run a matching method recording its stages, called by the backend
+        @param profile_intents: also record the cost of every intent
+        @return: tuple of (method return value, Trace)
+        """
+        trace = Trace(profile_intents)
+        return getattr(self, method)(*args, trace=trace), trace
+
+    def calc_intent(self, query: str,
+                    exclude_intents: Optional[Iterable[str]] = None) -> \
+            Optional[dict]:
+        """
+        Determine the best intent match for a given query. Ties in
+        confidence are broken in favour of literal over regex over fuzzy
+        matches, then the most specific template (most literal characters),
+        then the intent registered first
         @param query: input to evaluate for an intent
+        @param exclude_intents: names of intents that must not match
         @return: dict matched intent (or None)
         """
         match = {'name': None, 'entities': {}}
-        intents = [i for i in self.calc_intents(query) if i is not None and i.get("name")]
+        intents = list(self.calc_intents(query, top_k=1,
+                                         exclude_intents=exclude_intents))
         if len(intents) == 0:
             LOG.info("No match")
             return match
 
-        best_conf = max(x.get("conf", 0) for x in intents if x.get("name"))
-        ties = [i for i in intents if i.get("conf", 0) == best_conf]
-
-        if len(ties) > 1:
-            # TODO - how to untie?
-            LOG.info(f"tied intents: {ties}")
-
-        match = ties[0]
+        match = intents[0]
 
         for entity in set(match['entities'].keys()):
             entities = match['entities'].pop(entity)
@@ -255,43 +1299,290 @@ class IntentContainer:
         LOG.debug(match)
         return match
 
+    async def acalc_intents(self, query: str, top_k: Optional[int] = None,
+                            exclude_intents: Optional[Iterable[str]] = None,
+                            key: Optional[Hashable] = None) -> List[dict]:
+        """
+        asyncio version of `calc_intents`, matching runs in the backend
+        without blocking the event loop
+        @param query: input to evaluate for an intent match
+        @param top_k: if set, only return the `top_k` best matches
+        @param exclude_intents: names of intents that must not match
+        @param key: if set, a newer call with the same key (eg. a session
+            id) supersedes this one, which raises asyncio.CancelledError
+        @return: list of dict intent matches
+        """
+        excluded_intents = self._filter(query)
+        excluded_intents.update(exclude_intents or [])
+        return await self._asubmit(key, "_match_query", query,
+                                   excluded_intents, top_k)
+
+    async def acalc_intents_batch(
+            self, queries: List[str], top_k: Optional[int] = None,
+            exclude_intents: Optional[Iterable[str]] = None,
+            key: Optional[Hashable] = None) -> List[List[dict]]:
+        """
+        asyncio version of `calc_intents_batch`, see `acalc_intents`
+        """
+        future = self._backend.dispatch(self.calc_intents_batch, queries,
+                                        top_k, exclude_intents)
+        return await self._track(key, asyncio.wrap_future(future))
+
+    async def acalc_intent(self, query: str,
+                           exclude_intents: Optional[Iterable[str]] = None,
+                           key: Optional[Hashable] = None) -> Optional[dict]:
+        """
+        asyncio version of `calc_intent`, see `acalc_intents`
+        @return: dict matched intent
+        """
+        intents = await self.acalc_intents(query, top_k=1,
+                                           exclude_intents=exclude_intents,
+                                           key=key)
+        if not intents:
+            LOG.info("No match")
+            return {'name': None, 'entities': {}}
+        match = intents[0]
+        match['entities'] = {k.lower(): v
+                             for k, v in match['entities'].items()}
+        return match
+
+    async def acalc_intents_stream(
+            self, query: str,
+            exclude_intents: Optional[Iterable[str]] = None) -> \
+            AsyncIterator[dict]:
+        """
+        Stream the possible intents for a given query as they are found,
+        exact matches first, then fuzzy matches
+        @param query: input to evaluate for an intent match
+        @param exclude_intents: names of intents that must not match
+        @return: yields dict intent matches
+        """
+        excluded_intents = self._filter(query)
+        excluded_intents.update(exclude_intents or [])
+        matches = await self._asubmit(None, "_match_query", query,
+                                      excluded_intents, None, True, False)
+        for match in matches:
+            yield match
+        if self.fuzz:
+            # intents matched exactly never get a fuzzy match
+            excluded_intents.update(m["name"] for m in matches)
+            matches = await self._asubmit(None, "_match_query", query,
+                                          excluded_intents, None, False, True)
+            for match in matches:
+                yield match
+
+    async def _asubmit(self, key: Optional[Hashable], method: str, *args):
+        """
+        Run `method(*args)` in the backend and await its result
+        """
+        if self._observers:
+            future = self._backend.dispatch(self._map, method, [args])
+        else:
+            future = self._backend.submit(method, [args])
+        return (await self._track(key, asyncio.wrap_future(future)))[0]
+
+    async def _track(self, key: Optional[Hashable], future: asyncio.Future):
+        """
+        Await a future, cancelling the previous pending one with the same
+        key. Work that did not start yet is dropped, running work finishes
+        in the background and its result is discarded
+        """
+        if key is not None:
+            previous = self._pending.get(key)
+            if previous is not None and not previous.done():
+                previous.cancel()
+            self._pending[key] = future
+        try:
+            return await future
+        finally:
+            if key is not None and self._pending.get(key) is future:
+                del self._pending[key]
+
+    def _get_state(self) -> dict:
+        """
+        Get the registered intent and entity tables, used to initialize
+        backend worker processes and to write snapshots
+        """
+        return {"fuzz": self.fuzz,
+                "expansion_budget": self.expansion_budget,
+                "similarity": self._similarity.name,
+                "constrain_entities": self.constrain_entities,
+                "warm_up": self.auto_warm_up,
+                "intents": dict(self.intent_samples),
+                "entities": {name: list(samples) for name, samples
+                             in self.entity_samples.items()},
+                "sources": dict(self._intent_sources)}
+
+    @classmethod
+    def _from_state(cls, state: dict) -> 'IntentContainer':
+        """
+        Build an inline container from the output of `_get_state`
+        """
+        container = cls(fuzz=state["fuzz"], n_workers=1, backend="inline",
+                        expansion_budget=state["expansion_budget"],
+                        similarity=state["similarity"],
+                        constrain_entities=state.get("constrain_entities",
+                                                     False),
+                        warm_up=state.get("warm_up", False))
+        for name, regexes in state["intents"].items():
+            container._add_expanded_intent(name, regexes)
+        for name, samples in state["entities"].items():
+            container.entity_samples[name] = EntitySamples(samples)
+        container._entity_changed(*state["entities"])
+        container._intent_sources.update(state.get("sources", {}))
+        container._schedule_warm_up()
+        return container
+
+    def save(self, path: str):
+        """
+        Save the registered intents and entities to a snapshot file
+        @param path: file to write, see padacioso.snapshot
+        """
+        write_snapshot(path, self._get_state())
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> 'IntentContainer':
+        """
+        Create a container from a snapshot file, without expanding any
+        intent line again
+        @param path: file written by `save`
+        @param kwargs: IntentContainer arguments overriding the ones stored
+            in the snapshot, eg. `backend`
+        @return: IntentContainer with the snapshot intents and entities
+        @raises ValueError: if the snapshot is invalid or was written with a
+            different expansion budget
+        """
+        state = read_snapshot(path)
+        budget = kwargs.pop("expansion_budget", state["expansion_budget"])
+        if budget != state["expansion_budget"]:
+            raise ValueError(f"Snapshot was expanded with a budget of "
+                             f"{state['expansion_budget']}, not {budget}")
+        settings = {"fuzz": state["fuzz"], "similarity": state["similarity"],
+                    "expansion_budget": budget,
+                    "constrain_entities": state.get("constrain_entities",
+                                                    False),
+                    "warm_up": state.get("warm_up", False)}
+        settings.update(kwargs)
+        container = cls(**settings)
+        for name, regexes in state["intents"].items():
+            container._restore_intent(name, regexes,
+                                      state["sources"].get(name))
+        for name, samples in state["entities"].items():
+            container.entity_samples[name] = EntitySamples(samples)
+        container._entity_changed(*state["entities"])
+        container.generation += 1
+        return container
+
+    def close(self):
+        """
+        Shutdown the execution backend, releasing any workers, and stop
+        warming up
+        """
+        self._warm_up_stop.set()
+        self._backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def exclude_keywords(self, intent_name, samples):
+        self.generation += 1
         if intent_name not in self.excluded_keywords:
             self.excluded_keywords[intent_name] = samples
         else:
             self.excluded_keywords[intent_name] += samples
+        self._keyword_filter.add(intent_name, samples)
 
     def set_context(self, intent_name, context_name, context_val=None):
+        self.generation += 1
         if intent_name not in self.available_contexts:
             self.available_contexts[intent_name] = {}
         self.available_contexts[intent_name][context_name] = context_val
+        self._context_filter.set_context(intent_name, context_name)
 
     def exclude_context(self, intent_name, context_name):
+        self.generation += 1
         if intent_name not in self.excluded_contexts:
             self.excluded_contexts[intent_name] = [context_name]
         else:
             self.excluded_contexts[intent_name].append(context_name)
+        self._context_filter.exclude_context(intent_name, context_name)
 
     def unexclude_context(self, intent_name, context_name):
+        self.generation += 1
         if intent_name in self.excluded_contexts:
             self.excluded_contexts[intent_name] = [c for c in self.excluded_contexts[intent_name]
                                                    if context_name != c]
+        self._context_filter.unexclude_context(intent_name, context_name)
 
     def unset_context(self, intent_name, context_name):
+        self.generation += 1
         if intent_name in self.available_contexts:
             if context_name in self.available_contexts[intent_name]:
                 self.available_contexts[intent_name].pop(context_name)
+        self._context_filter.unset_context(intent_name, context_name)
 
     def require_context(self, intent_name, context_name):
+        self.generation += 1
         if intent_name not in self.required_contexts:
             self.required_contexts[intent_name] = [context_name]
         else:
             self.required_contexts[intent_name].append(context_name)
+        self._context_filter.require_context(intent_name, context_name)
 
     def unrequire_context(self, intent_name, context_name):
+        self.generation += 1
         if intent_name in self.required_contexts:
             self.required_contexts[intent_name] = [c for c in self.required_contexts[intent_name]
                                                    if context_name != c]
+        self._context_filter.unrequire_context(intent_name, context_name)
+
+
+class _MatcherView(Mapping):
+    """
+    Read only template -> matcher mapping of a container, compiling the
+    matchers on access
+    """
+
+    def __init__(self, container: IntentContainer, case_sensitive: bool):
+        self._container = container
+        self._case_sensitive = case_sensitive
+
+    def __getitem__(self, template: str) -> simplematch.Matcher:
+        return self._container._matcher(self._container._templates[template],
+                                        self._case_sensitive)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._container._templates)
+
+    def __len__(self) -> int:
+        return len(self._container._templates)
+
+
+def _is_literal(template: str) -> bool:
+    """
+    Check if a template is a plain sentence, without entity slots,
+    wildcards or (one|of) groups
+    """
+    return not any(c in template for c in "{}*") and \
+        not is_bracketed(template)
+
+
+def _slot_names(template: str) -> List[str]:
+    """
+    Names of the untyped `{entity}` slots of a template
+    """
+    return re.findall(r"\{(\w+)\}", template)
+
+
+def _specificity(template: str) -> int:
+    """
+    Number of literal characters in a template, slots and wildcards
+    excluded
+    """
+    return sum(1 for tok in tokenize_template(template) if tok is not GAP)
 
 
 def _init_sm_word_type():
@@ -0,0 +1,240 @@
+"""
+Combined matching automaton for all registered intent templates.
+
+Every template is inserted into a single character trie where `*` wildcards
+and `{entity}` slots become "gap" states that may consume any text. Running
+the automaton over an utterance visits the shared prefixes of all templates
+at once and returns every template that could match it, so the per-template
+regexes only need to run on real candidates (to extract typed entity values
+exactly as simplematch does).
+
+Matching is case-insensitive, so the candidates are a superset of both the
+cased and the uncased simplematch matches.
+"""
+import sys
+from typing import Iterator, List, Optional, Set
+
+
+class _Node:
+    __slots__ = ("children", "gap", "is_gap", "templates")
+
+    def __init__(self, is_gap: bool = False):
+        self.children = {}
+        self.gap: Optional['_Node'] = None
+        self.is_gap = is_gap
+        self.templates: Set[str] = set()
+
+    def is_empty(self) -> bool:
+        return not (self.children or self.gap or self.templates)
+
+
+# marker for a wildcard/entity slot in a tokenized template
+GAP = None
+
+
+# lower cased characters `re.IGNORECASE` also considers equal to another
+# lower cased character (eg. ς/σ), mapped to the smallest of them
+_EXTRA_FOLDS = {
+    "\u0131": "i", "\u017f": "s", "\u03b9": "\u0345", "\u1fbe": "\u0345",
+    "\u03bc": "\u00b5", "\u03c3": "\u03c2", "\u03d0": "\u03b2",
+    "\u03d1": "\u03b8", "\u03d5": "\u03c6", "\u03d6": "\u03c0",
+    "\u03f0": "\u03ba", "\u03f1": "\u03c1", "\u03f5": "\u03b5",
+    "\u1fd3": "\u0390", "\u1fe3": "\u03b0", "\u1e9b": "\u1e61",
+    "\u1c80": "\u0432", "\u1c81": "\u0434", "\u1c82": "\u043e",
+    "\u1c83": "\u0441", "\u1c84": "\u0442", "\u1c85": "\u0442",
+    "\u1c86": "\u044a", "\u1c87": "\u0463", "\ua64b": "\u1c88",
+    "\ufb06": "\ufb05"
+}
+
+
+class _FoldTable(dict):
+    """
+    str.translate table mapping every character to the representative of
+    the characters `re.IGNORECASE` considers equal to it, filled on demand
+    """
+
+    def __missing__(self, code: int) -> int:
+        # İ is the only character lower casing to several (i + dot above),
+        # re folds it to i
+        lower = chr(code).lower()[0]
+        self[code] = folded = ord(_EXTRA_FOLDS.get(lower, lower))
+        return folded
+
+
+_FOLD_TABLE = _FoldTable()
+
+
+def _fold(text: str) -> str:
+    """
+    Case fold text like `re.IGNORECASE` compares it, keeping a 1:1
+    character mapping with the input
+    """
+    if text.isascii():
+        return text.lower()
+    return text.translate(_FOLD_TABLE)
+
+
+def tokenize_template(template: str) -> Iterator[Optional[str]]:
+    """
+    Split a simplematch template in literal characters and gaps
+    @param template: expanded intent template
+    @return: yields lower cased characters, or GAP for `*` and `{slots}`
+    """
+    template = _fold(template)
+    idx = 0
+    while idx < len(template):
+        char = template[idx]
+        if char == "*":
+            yield GAP
+        elif char == "{" and "}" in template[idx:]:
+            # {entity}, {entity:type} or {}
+            idx = template.index("}", idx)
+            yield GAP
+        else:
+            yield char
+        idx += 1
+
+
+class TemplateAutomaton:
+    """
+    Trie of templates with wildcard gaps, simulated as an NFA
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _path(self, template: str) -> List[_Node]:
+        node, path = self._root, [self._root]
+        for token in tokenize_template(template):
+            if token is GAP:
+                if node.is_gap:
+                    continue  # consecutive gaps collapse
+                if node.gap is None:
+                    node.gap = _Node(is_gap=True)
+                node = node.gap
+            else:
+                if token not in node.children:
+                    node.children[token] = _Node()
+                node = node.children[token]
+            path.append(node)
+        return path
+
+    def add(self, template: str):
+        """
+        Insert a template in the automaton
+        @param template: expanded intent template
+        """
+        terminal = self._path(template)[-1]
+        if template not in terminal.templates:
+            terminal.templates.add(template)
+            self._size += 1
+
+    def remove(self, template: str):
+        """
+        Remove a template from the automaton, pruning unused states
+        @param template: expanded intent template
+        """
+        path = self._path(template)
+        if template in path[-1].templates:
+            path[-1].templates.discard(template)
+            self._size -= 1
+        # prune empty states bottom up
+        for idx in range(len(path) - 1, 0, -1):
+            node, parent = path[idx], path[idx - 1]
+            if not node.is_empty():
+                break
+            if parent.gap is node:
+                parent.gap = None
+            else:
+                for k, v in list(parent.children.items()):
+                    if v is node:
+                        del parent.children[k]
+                        break
+
+    def memory_usage(self) -> int:
+        """
+        Approximate memory used by the trie states, in bytes. Templates are
+        shared with the container and not counted
+        """
+        size, stack = 0, [self._root]
+        while stack:
+            node = stack.pop()
+            size += sys.getsizeof(node) + sys.getsizeof(node.children) + \
+                sys.getsizeof(node.templates)
+            stack.extend(node.children.values())
+            if node.gap is not None:
+                stack.append(node.gap)
+        return size
+
+    @staticmethod
+    def _closure(nodes) -> Set[_Node]:
+        states = set(nodes)
+        for node in nodes:
+            if node.gap is not None:
+                states.add(node.gap)
+        return states
+
+    def match(self, query: str) -> Set[str]:
+        """
+        Find all templates that may match a query in a single pass
+        @param query: input utterance
+        @return: set of candidate templates
+        """
+        active = self._closure([self._root])
+        for char in _fold(query):
+            active = self._step(active, char)
+            if not active:
+                return set()
+        return self._templates(active)
+
+    def match_many(self, queries: List[str]) -> List[Set[str]]:
+        """
+        Same as `match` for many queries, in a single pass: queries are
+        walked in sorted order so a prefix shared with the previous query is
+        only run once
+        @param queries: input utterances
+        @return: set of candidate templates of each query, in order
+        """
+        folded = [_fold(q) for q in queries]
+        results: List[Set[str]] = [set() for _ in queries]
+        # states[i]: active states after the first i chars of `previous`
+        states = [self._closure([self._root])]
+        previous = ""
+        for idx in sorted(range(len(queries)), key=folded.__getitem__):
+            text = folded[idx]
+            common = 0
+            limit = min(len(previous), len(text), len(states) - 1)
+            while common < limit and previous[common] == text[common]:
+                common += 1
+            del states[common + 1:]
+            previous = text
+            active = states[-1]
+            for char in text[common:]:
+                active = self._step(active, char)
+                if not active:
+                    break
+                states.append(active)
+            else:
+                results[idx] = self._templates(active)
+        return results
+
+    def _step(self, active: Set[_Node], char: str) -> Set[_Node]:
+        step = []
+        for node in active:
+            child = node.children.get(char)
+            if child is not None:
+                step.append(child)
+            if node.is_gap:
+                step.append(node)
+        return self._closure(step) if step else set()
+
+    @staticmethod
+    def _templates(active: Set[_Node]) -> Set[str]:
+        templates = set()
+        for node in active:
+            templates.update(node.templates)
+        return templates
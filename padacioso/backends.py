@@ -0,0 +1,336 @@
+"""
+Execution backends used by IntentContainer to run intent matching.
+
+A backend is owned by a single container and lives as long as it does, so
+worker threads/processes are started once instead of once per query.
+"""
+import multiprocessing
+import threading
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Sequence, Tuple
+
+try:
+    from ovos_utils.log import LOG
+except ImportError:
+    import logging
+
+    LOG = logging.getLogger('padacioso')
+
+
+class InlineBackend:
+    """
+    Runs every task sequentially in the calling thread
+    """
+    name = "inline"
+    # matching runs on the container itself, not on a replica
+    shares_state = True
+
+    def __init__(self, container, n_workers: int = 1):
+        self.container = container
+        self.n_workers = max(int(n_workers or 1), 1)
+        # dispatches `submit` calls, separate from any worker pool so a
+        # submitted `map` never waits on its own pool
+        self._dispatcher = None
+        self._dispatcher_lock = threading.Lock()
+        # futures not finished yet, cancelled on close
+        self._pending = set()
+
+    def split(self, items: Sequence) -> List[list]:
+        """
+        Split `items` in (at most) one contiguous chunk per worker
+        @param items: sequence of work items
+        @return: list of non-empty chunks
+        """
+        items = list(items)
+        if not items:
+            return []
+        n = min(self.n_workers, len(items))
+        size, extra = divmod(len(items), n)
+        chunks, start = [], 0
+        for idx in range(n):
+            end = start + size + (1 if idx < extra else 0)
+            chunks.append(items[start:end])
+            start = end
+        return chunks
+
+    def map(self, method: str, calls: List[Tuple]) -> List[Any]:
+        """
+        Run `container.<method>(*args)` for every args tuple in `calls`
+        @param method: name of the IntentContainer method to call
+        @param calls: list of argument tuples
+        @return: list of return values, in the same order as `calls`
+        """
+        func = getattr(self.container, method)
+        return [func(*args) for args in calls]
+
+    def submit(self, method: str, calls: List[Tuple]) -> Future:
+        """
+        Same as `map`, without blocking the caller
+        @param method: name of the IntentContainer method to call
+        @param calls: list of argument tuples
+        @return: future resolving to the list of return values
+        """
+        return self.dispatch(self.map, method, calls)
+
+    def dispatch(self, func: Callable, *args) -> Future:
+        """
+        Run `func(*args)` in a background thread of this backend
+        @param func: callable to run, usually a container method
+        @return: future resolving to the return value of `func`
+        """
+        with self._dispatcher_lock:
+            if self._dispatcher is None:
+                self._dispatcher = ThreadPoolExecutor(
+                    max_workers=self.n_workers,
+                    thread_name_prefix="padacioso-dispatch")
+            future = self._dispatcher.submit(func, *args)
+            self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    def _close_dispatcher(self):
+        with self._dispatcher_lock:
+            if self._dispatcher is not None:
+                # shutdown(cancel_futures=True) needs python 3.9
+                for future in list(self._pending):
+                    future.cancel()
+                self._dispatcher.shutdown(wait=True)
+                self._dispatcher = None
+
+    def broadcast(self, method: str, *args) -> List[Any]:
+        """
+        Run `container.<method>(*args)` once everywhere matching happens,
+        used to collect per-worker state such as statistics
+        @param method: name of the IntentContainer method to call
+        @return: list with one return value per worker
+        """
+        return [getattr(self.container, method)(*args)]
+
+    def start(self):
+        """
+        Start the workers, if not running already; a no-op for backends
+        that share memory with the container
+        """
+
+    def sync(self, method: str, *args):
+        """
+        Replicate a registration change to the workers; a no-op for backends
+        that share memory with the container
+        @param method: name of the IntentContainer method that was called
+        @param args: arguments the method was called with
+        """
+
+    def close(self):
+        """
+        Release any resources held by this backend
+        """
+        self._close_dispatcher()
+
+
+class ThreadBackend(InlineBackend):
+    """
+    Runs tasks in a persistent thread pool sharing the container state
+    """
+    name = "thread"
+
+    def __init__(self, container, n_workers: int = 4):
+        super().__init__(container, n_workers)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.n_workers,
+                    thread_name_prefix="padacioso")
+            return self._executor
+
+    def map(self, method: str, calls: List[Tuple]) -> List[Any]:
+        if len(calls) < 2:
+            return super().map(method, calls)
+        func = getattr(self.container, method)
+        futures = [self.executor.submit(func, *args) for args in calls]
+        return [f.result() for f in futures]
+
+    def close(self):
+        self._close_dispatcher()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+class _Worker:
+    """
+    Handle for a worker process holding a replica of the container
+    """
+
+    def __init__(self, ctx, state: dict):
+        self.conn, child_conn = ctx.Pipe()
+        self.lock = threading.Lock()
+        self.process = ctx.Process(target=_worker_loop,
+                                   args=(child_conn, state),
+                                   name="padacioso-worker", daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def send(self, msg: tuple):
+        with self.lock:
+            self.conn.send(msg)
+
+    def close(self, timeout: float = 2.0):
+        try:
+            self.send(("close",))
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+def _close_workers(workers: List[_Worker]):
+    while workers:
+        workers.pop().close()
+
+
+class ProcessBackend(InlineBackend):
+    """
+    Runs tasks in persistent worker processes. Each worker receives a snapshot
+    of the intent and entity tables once when the pool starts and is kept up
+    to date with incremental registration changes afterwards.
+    """
+    name = "process"
+    shares_state = False
+
+    def __init__(self, container, n_workers: int = 4):
+        super().__init__(container, n_workers)
+        self._workers: List[_Worker] = []
+        self._lock = threading.Lock()
+        self._next = 0
+        # terminate worker processes if the backend is garbage collected
+        self._finalizer = weakref.finalize(self, _close_workers,
+                                           self._workers)
+
+    @property
+    def started(self) -> bool:
+        return bool(self._workers)
+
+    def start(self):
+        """
+        Start the worker processes, if not running already
+        """
+        with self._lock:
+            if self._workers:
+                return
+            ctx = multiprocessing.get_context()
+            state = self.container._get_state()
+            for _ in range(self.n_workers):
+                self._workers.append(_Worker(ctx, state))
+            LOG.debug(f"Started {self.n_workers} padacioso worker processes")
+
+    def broadcast(self, method: str, *args) -> List[Any]:
+        if not self.started:
+            return super().broadcast(method, *args)
+        return self.map(method, [args] * len(self._workers))
+
+    def sync(self, method: str, *args):
+        with self._lock:
+            for worker in self._workers:
+                worker.send(("sync", method, args))
+
+    def map(self, method: str, calls: List[Tuple]) -> List[Any]:
+        if not calls:
+            return []
+        self.start()
+        # assign calls round-robin, one message per worker
+        with self._lock:
+            first = self._next
+            self._next = (first + len(calls)) % len(self._workers)
+        assigned, positions = {}, {}
+        for idx, args in enumerate(calls):
+            w = (first + idx) % len(self._workers)
+            assigned.setdefault(w, []).append(args)
+            positions.setdefault(w, []).append(idx)
+        used = sorted(assigned)
+        # lock in a fixed order so concurrent callers can not deadlock
+        for w in used:
+            self._workers[w].lock.acquire()
+        try:
+            for w in used:
+                self._workers[w].conn.send(("call", method, assigned[w]))
+            replies = {w: self._workers[w].conn.recv() for w in used}
+        finally:
+            for w in used:
+                self._workers[w].lock.release()
+
+        results = [None] * len(calls)
+        for w in used:
+            ok, payload = replies[w]
+            if not ok:
+                raise payload
+            for idx, res in zip(positions[w], payload):
+                results[idx] = res
+        return results
+
+    def close(self):
+        self._close_dispatcher()
+        with self._lock:
+            _close_workers(self._workers)
+
+
+def _worker_loop(conn, state: dict):
+    """
+    Main loop of a worker process
+    @param conn: connection to the parent process
+    @param state: container state as returned by IntentContainer._get_state
+    """
+    from padacioso import IntentContainer
+    container = IntentContainer._from_state(state)
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError, KeyboardInterrupt):
+            break
+        if msg[0] == "close":
+            break
+        elif msg[0] == "sync":
+            _, method, args = msg
+            try:
+                getattr(container, method)(*args)
+            except Exception as e:
+                LOG.error(f"worker failed to apply {method}: {e}")
+        elif msg[0] == "call":
+            _, method, calls = msg
+            try:
+                func = getattr(container, method)
+                conn.send((True, [func(*args) for args in calls]))
+            except Exception as e:
+                conn.send((False, e))
+    conn.close()
+
+
+BACKENDS = {
+    InlineBackend.name: InlineBackend,
+    ThreadBackend.name: ThreadBackend,
+    ProcessBackend.name: ProcessBackend
+}
+
+
+def get_backend(name: str, container, n_workers: int = 4) -> InlineBackend:
+    """
+    Create an execution backend for a container
+    @param name: one of "inline", "thread" or "process"
+    @param container: IntentContainer that owns the backend
+    @param n_workers: number of worker threads/processes
+    @return: backend instance
+    """
+    name = (name or InlineBackend.name).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}', "
+                         f"expected one of {list(BACKENDS)}")
+    return BACKENDS[name](container, n_workers)
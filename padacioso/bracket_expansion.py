@@ -1,3 +1,14 @@
+import itertools
+import re
+from typing import Iterator
+
+import simplematch
+
+# placeholders for alternation groups while a template goes through
+# simplematch's escaping, replaced by regex syntax afterwards
+_OPEN, _ALT, _CLOSE = "\ue000", "\ue001", "\ue002"
+
+
 class TreeFragment:
     """(Abstract) empty sentence fragment"""
 
@@ -25,6 +36,28 @@ class TreeFragment:
         """
         return [[]]
 
+    def iter_expand(self) -> Iterator[str]:
+        """
+        Lazily expanded version of the fragment.
+
+        Returns:
+            Iterator<str>: yields every sentence the fragment expands to
+        """
+        yield ""
+
+    def count(self) -> int:
+        """
+        Number of sentences the fragment expands to, without expanding it
+        """
+        return 1
+
+    def to_pattern(self) -> str:
+        """
+        Pattern matching every expansion of the fragment, with alternation
+        groups marked by placeholder characters
+        """
+        return ""
+
     def __str__(self):
         return self._tree.__str__()
 
@@ -49,6 +82,12 @@ class Word(TreeFragment):
         """
         return [[self._tree]]
 
+    def iter_expand(self) -> Iterator[str]:
+        yield self._tree
+
+    def to_pattern(self) -> str:
+        return self._tree
+
 
 class Sentence(TreeFragment):
     """
@@ -76,6 +115,44 @@ class Sentence(TreeFragment):
             old_expanded = new_expanded
         return old_expanded
 
+    def iter_expand(self) -> Iterator[str]:
+        """
+        Lazily creates every combination of the sub-sentences, only the
+        expansions of each sub-sentence are held in memory
+
+        Returns:
+            Iterator<str>: yields every combined sentence
+        """
+        subs = [list(sub.iter_expand()) for sub in self._tree]
+        for combo in itertools.product(*subs):
+            yield "".join(combo)
+
+    def count(self) -> int:
+        total = 1
+        for sub in self._tree:
+            total *= sub.count()
+        return total
+
+    def to_pattern(self) -> str:
+        # an optional group takes over one adjacent space, so that
+        # "a [b] c" matches "a c" instead of "a  c"
+        parts = []
+        tree = list(self._tree)
+        idx = 0
+        while idx < len(tree):
+            sub = tree[idx]
+            nxt = tree[idx + 1] if idx + 1 < len(tree) else None
+            if _is_space(sub) and _is_optional(nxt):
+                parts.append(nxt.to_pattern(prefix=" "))
+                idx += 2
+            elif _is_optional(sub) and _is_space(nxt):
+                parts.append(sub.to_pattern(suffix=" "))
+                idx += 2
+            else:
+                parts.append(sub.to_pattern())
+                idx += 1
+        return "".join(parts)
+
 
 class SentenceTree(TreeFragment):
     """
@@ -97,6 +174,38 @@ class SentenceTree(TreeFragment):
             options.extend(option.expand())
         return options
 
+    def iter_expand(self) -> Iterator[str]:
+        for option in self._tree:
+            yield from option.iter_expand()
+
+    def count(self) -> int:
+        return sum(option.count() for option in self._tree)
+
+    def to_pattern(self, prefix: str = "", suffix: str = "") -> str:
+        """
+        Args:
+            prefix (str): text added in front of every non-empty option
+            suffix (str): text added after every non-empty option
+        """
+        options = []
+        for option in self._tree:
+            pattern = option.to_pattern()
+            if pattern:
+                pattern = prefix + pattern + suffix
+            options.append(pattern)
+        if len(options) == 1:
+            return options[0]
+        return _OPEN + _ALT.join(options) + _CLOSE
+
+
+def _is_space(fragment) -> bool:
+    return isinstance(fragment, Word) and fragment.tree() == " "
+
+
+def _is_optional(fragment) -> bool:
+    return isinstance(fragment, SentenceTree) and \
+        any(not option.tree() for option in fragment.tree())
+
 
 class SentenceTreeParser:
     """
@@ -165,6 +274,18 @@ class SentenceTreeParser:
         tree = self._parse()
         return tree.expand()
 
+    def iter_expand_parentheses(self) -> Iterator[str]:
+        tree = self._parse()
+        return tree.iter_expand()
+
+    def count_expansions(self) -> int:
+        tree = self._parse()
+        return tree.count()
+
+    def to_pattern(self) -> str:
+        tree = self._parse()
+        return tree.to_pattern().strip()
+
 
 def expand_parentheses(sent):
     """
@@ -187,6 +308,123 @@ def expand_parentheses(sent):
     return ["".join(_).strip() for _ in expanded]
 
 
+def iter_expand_parentheses(sent: str) -> Iterator[str]:
+    """
+    Generator version of `expand_parentheses`, sentences are produced one
+    at a time instead of building the full cartesian product in memory.
+    Duplicates are not removed.
+    Args:
+        sent (str): sentence with (one|of) and [optional] syntax
+    Returns:
+        Iterator<str>: yields every possible sentence
+    """
+    for expanded in SentenceTreeParser(sent).iter_expand_parentheses():
+        yield expanded.strip()
+
+
+def count_expansions(sent: str) -> int:
+    """
+    Count the sentences `expand_parentheses` would produce, without
+    expanding them
+    Args:
+        sent (str): sentence with (one|of) and [optional] syntax
+    Returns:
+        int: number of expanded sentences, including duplicates
+    """
+    return SentenceTreeParser(sent).count_expansions()
+
+
+def is_bracketed(template: str) -> bool:
+    """
+    Check if a template still contains (one|of) or [optional] syntax, i.e.
+    was not expanded
+    """
+    return "|" in template or "[" in template
+
+
+class BracketMatcher(simplematch.Matcher):
+    """
+    simplematch Matcher for a template with (one|of) and [optional] syntax,
+    compiled straight into a single regex with alternation groups instead
+    of one matcher per expansion.
+
+    Spaces next to optional groups are normalized, "a [b] c" matches
+    "a b c" and "a c". Entities and wildcards are greedy, like in the
+    expanded templates, so adjacent entities split the query the same way.
+    Only the ones right before a group match lazily, so the words of the
+    group are preferred, like the longest expansion is tried first when
+    templates are expanded.
+    """
+
+    def _create_regex(self, pattern):
+        self._aliases = {}
+        template = SentenceTreeParser(pattern).to_pattern()
+        regex = re.sub(r"\.\*", self._quantifier,
+                       super()._create_regex(template))
+        regex = regex.replace(_OPEN, "(?:").replace(_ALT, "|") \
+            .replace(_CLOSE, ")")
+
+        # the same entity may appear in several alternatives
+        seen = set()
+
+        def _rename(match):
+            name = match.group(1)
+            if name in seen:
+                alias = f"{name}__{len(self._aliases)}"
+                self._aliases[alias] = name
+                name = alias
+            seen.add(name)
+            return f"(?P<{name}>"
+
+        return re.sub(r"\(\?P<(\w+)>", _rename, regex)
+
+    @staticmethod
+    def _quantifier(match) -> str:
+        """
+        Make `.*` lazy if the next thing it can be followed by is a group
+        """
+        regex, idx = match.string, match.end()
+        if regex.startswith(")", idx):
+            idx += 1  # end of the entity group
+        while idx < len(regex):
+            char = regex[idx]
+            if char == _OPEN:
+                return ".*?"
+            if char == _ALT:
+                # end of this alternative, skip to the end of its group
+                depth = 0
+                while idx < len(regex) and \
+                        (regex[idx] != _CLOSE or depth):
+                    if regex[idx] == _OPEN:
+                        depth += 1
+                    elif regex[idx] == _CLOSE:
+                        depth -= 1
+                    idx += 1
+            elif char != _CLOSE:
+                break
+            idx += 1
+        return ".*"
+
+    def match(self, string):
+        match = self._regex_compiled.match(string)
+        if match:
+            # only report entities from the alternatives that matched
+            result = {}
+            for key, value in match.groupdict().items():
+                if value is not None:
+                    result[self._aliases.get(key, key)] = value
+            groups = [g for g in self._grouplist(match) if g is not None]
+            for i, x in enumerate(groups):
+                result[i] = x
+
+            # run converters
+            for key, converter in self.converters.items():
+                if key in result:
+                    result[key] = converter(result[key])
+            return result
+        return None
+
+
 def clean_braces(example: str) -> str:
     """
     Normalizes {{entity}} to {entity}
@@ -0,0 +1,91 @@
+"""
+Bounded LRU cache with time based expiration, used to memoize intent
+matches of repeated utterances.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class ResultCache:
+    """
+    Thread safe LRU cache whose entries expire after `ttl` seconds
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 300):
+        """
+        @param max_size: maximum number of entries, 0 disables the cache
+        @param ttl: seconds an entry stays valid, None to never expire
+        """
+        self.max_size = max(int(max_size or 0), 0)
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expiration time, value)
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(("hits", "misses", "evictions",
+                                      "expirations", "invalidations"), 0)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get a cached value
+        @param key: cache key
+        @param default: returned if the key is not cached or expired
+        @return: cached value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._counts["hits"] += 1
+                    return value
+                del self._entries[key]
+                self._counts["expirations"] += 1
+            self._counts["misses"] += 1
+            return default
+
+    def put(self, key: Hashable, value: Any):
+        """
+        Cache a value, evicting the least recently used entry if full
+        @param key: cache key
+        @param value: value to cache, may be None
+        """
+        if not self.max_size:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counts["evictions"] += 1
+
+    def clear(self):
+        """
+        Drop all cached entries
+        """
+        with self._lock:
+            if self._entries:
+                self._counts["invalidations"] += 1
+            self._entries.clear()
+
+    @property
+    def stats(self) -> dict:
+        """
+        Cache counters and current size
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats["size"] = len(self._entries)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            return stats
+
+    def reset_stats(self):
+        with self._lock:
+            for k in self._counts:
+                self._counts[k] = 0
@@ -0,0 +1,100 @@
+"""
+Hashed storage for entity sample values.
+
+Entity values are checked on every match that captures a slot, and entities
+can have thousands of values (contacts, song titles), so values are kept in
+hash tables instead of lists. A case folded index allows case insensitive
+and prefix lookups.
+"""
+import sys
+from bisect import bisect_left
+from typing import Iterable, Iterator, List, Optional
+
+from padacioso.automaton import _fold
+
+
+class EntitySamples:
+    """
+    Insertion ordered set of the values of an entity
+    """
+    __slots__ = ("_values", "_folded", "_sorted")
+
+    def __init__(self, values: Iterable[str] = ()):
+        # value -> None, a dict keeps insertion order
+        self._values = {}
+        # case folded value -> number of values folding to it
+        self._folded = {}
+        # sorted case folded values, built on the first prefix lookup
+        self._sorted: Optional[List[str]] = None
+        self.update(values)
+
+    def update(self, values: Iterable[str]) -> int:
+        """
+        Merge values into the entity
+        @param values: entity values, already expanded
+        @return: number of new values
+        """
+        added = 0
+        for value in values:
+            if value in self._values:
+                continue
+            self._values[value] = None
+            folded = _fold(value)
+            self._folded[folded] = self._folded.get(folded, 0) + 1
+            added += 1
+        if added:
+            self._sorted = None
+        return added
+
+    def __contains__(self, value: str) -> bool:
+        return value in self._values
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, EntitySamples):
+            return list(self._values) == list(other._values)
+        if isinstance(other, list):
+            return list(self._values) == other
+        return NotImplemented
+
+    def __repr__(self):
+        return f"EntitySamples({list(self._values)!r})"
+
+    def contains_folded(self, value: str) -> bool:
+        """
+        Case insensitive membership test
+        """
+        return _fold(value) in self._folded
+
+    def startswith(self, prefix: str) -> List[str]:
+        """
+        Case insensitive prefix lookup
+        @param prefix: start of a value
+        @return: sorted case folded values starting with `prefix`
+        """
+        if self._sorted is None:
+            self._sorted = sorted(self._folded)
+        prefix = _fold(prefix)
+        found = []
+        for idx in range(bisect_left(self._sorted, prefix),
+                         len(self._sorted)):
+            if not self._sorted[idx].startswith(prefix):
+                break
+            found.append(self._sorted[idx])
+        return found
+
+    def memory_usage(self) -> int:
+        """
+        Approximate memory used by this entity, in bytes
+        """
+        size = sys.getsizeof(self._values) + sys.getsizeof(self._folded)
+        size += sum(sys.getsizeof(v) for v in self._values)
+        size += sum(sys.getsizeof(v) for v in self._folded)
+        if self._sorted is not None:
+            size += sys.getsizeof(self._sorted)
+        return size
@@ -0,0 +1,165 @@
+"""
+Precompiled intent filters, applied to every query before matching.
+
+Excluded keywords of all intents are compiled into a single Aho-Corasick
+automaton, so one scan of the query finds every intent excluded by keywords.
+Context requirements are kept as bitmasks per intent and the set of intents
+excluded by context is updated whenever a context changes, instead of being
+recomputed for every query.
+"""
+import threading
+from collections import deque
+from typing import Dict, Iterable, Set
+
+
+class _Node:
+    __slots__ = ("children", "fail", "intents")
+
+    def __init__(self):
+        self.children = {}
+        self.fail = None
+        # intents excluded when the scan reaches this node
+        self.intents: Set[str] = set()
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton mapping keywords to the intents they exclude
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        # intents excluded by an empty keyword, ie. by every query
+        self._always: Set[str] = set()
+        # failure links are rebuilt on the first scan after an insertion
+        self._stale = False
+        self._lock = threading.Lock()
+
+    def add(self, intent_name: str, keywords: Iterable[str]):
+        """
+        Exclude an intent from queries containing any of `keywords`
+        @param intent_name: intent to exclude
+        @param keywords: case sensitive substrings of the query
+        """
+        with self._lock:
+            for keyword in keywords:
+                if not keyword:
+                    self._always.add(intent_name)
+                    continue
+                node = self._root
+                for char in keyword:
+                    node = node.children.setdefault(char, _Node())
+                node.intents.add(intent_name)
+                self._stale = True
+
+    def _link(self):
+        # breadth first, so the failure node of a child is already linked
+        self._root.fail = self._root
+        queue = deque()
+        for child in self._root.children.values():
+            child.fail = self._root
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for char, child in node.children.items():
+                fail = node.fail
+                while fail is not self._root and char not in fail.children:
+                    fail = fail.fail
+                child.fail = fail.children.get(char, self._root)
+                queue.append(child)
+        # a keyword also matches where any of its suffixes is a keyword
+        queue.extend(self._root.children.values())
+        while queue:
+            node = queue.popleft()
+            node.intents |= node.fail.intents
+            queue.extend(node.children.values())
+        self._stale = False
+
+    def scan(self, query: str) -> Set[str]:
+        """
+        @param query: input to scan
+        @return: intents with a keyword in `query`
+        """
+        if self._stale:
+            with self._lock:
+                if self._stale:
+                    self._link()
+        root = self._root
+        found = set(self._always)
+        if not root.children:
+            return found
+        node = root
+        for char in query:
+            while node is not root and char not in node.children:
+                node = node.fail
+            node = node.children.get(char, root)
+            if node.intents:
+                found |= node.intents
+        return found
+
+
+class ContextFilter:
+    """
+    Per intent context bitmasks and the intents they currently exclude
+    """
+
+    def __init__(self):
+        # context name -> bit
+        self._bits: Dict[str, int] = {}
+        # intent name -> mask, an intent without entry never set a context
+        self._available: Dict[str, int] = {}
+        self._required: Dict[str, int] = {}
+        self._forbidden: Dict[str, int] = {}
+        # intents excluded by the current contexts
+        self.excluded: Set[str] = set()
+
+    def _bit(self, context_name: str) -> int:
+        if context_name not in self._bits:
+            self._bits[context_name] = 1 << len(self._bits)
+        return self._bits[context_name]
+
+    def _update(self, masks: Dict[str, int], intent_name: str, bit: int,
+                enable: bool):
+        if enable:
+            masks[intent_name] = masks.get(intent_name, 0) | bit
+        elif intent_name in masks:
+            masks[intent_name] &= ~bit
+        available = self._available.get(intent_name)
+        required = self._required.get(intent_name)
+        forbidden = self._forbidden.get(intent_name)
+        if available is None:
+            excluded = required is not None
+        else:
+            excluded = bool((required or 0) & ~available) or \
+                bool((forbidden or 0) & available)
+        if excluded:
+            self.excluded.add(intent_name)
+        else:
+            self.excluded.discard(intent_name)
+
+    def set_context(self, intent_name: str, context_name: str):
+        self._update(self._available, intent_name,
+                     self._bit(context_name), True)
+
+    def unset_context(self, intent_name: str, context_name: str):
+        if intent_name in self._available:
+            self._update(self._available, intent_name,
+                         self._bit(context_name), False)
+
+    def require_context(self, intent_name: str, context_name: str):
+        self._update(self._required, intent_name,
+                     self._bit(context_name), True)
+
+    def unrequire_context(self, intent_name: str, context_name: str):
+        if intent_name in self._required:
+            self._update(self._required, intent_name,
+                         self._bit(context_name), False)
+
+    def exclude_context(self, intent_name: str, context_name: str):
+        self._update(self._forbidden, intent_name,
+                     self._bit(context_name), True)
+
+    def unexclude_context(self, intent_name: str, context_name: str):
+        if intent_name in self._forbidden:
+            self._update(self._forbidden, intent_name,
+                         self._bit(context_name), False)
@@ -0,0 +1,181 @@
+"""
+Opt-in timing and counters of the matching stages.
+
+Observers registered with `IntentContainer.add_observer` (or the pipeline)
+receive the time spent in each stage of a query and counters of the work done
+(templates tried, regex executions, fuzzy variants scored, cache hits...).
+Observers setting `profile_intents` also get the cost of every intent, see
+padacioso.profiler. Stages running in backend workers are recorded in a
+`Trace` returned with the results, so observers see them with every backend.
+Nothing is recorded when no observer is registered.
+
+`Aggregator` is a ready made observer that accumulates events, reports a
+summary periodically and renders Prometheus text metrics.
+"""
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+
+class Observer:
+    """
+    Receives instrumentation events, subclasses override what they need.
+    Events may come from several threads
+    """
+    # also time every intent, see on_intent
+    profile_intents = False
+
+    def on_timing(self, stage: str, seconds: float):
+        """
+        @param stage: name of the stage, eg. "filter", "exact", "fuzzy"
+        @param seconds: time spent in the stage
+        """
+
+    def on_count(self, counter: str, value: int):
+        """
+        @param counter: name of the counter, eg. "regex_executions"
+        @param value: increment
+        """
+
+    def on_intent(self, intent_name: str, seconds: float, regexes: int):
+        """
+        Called with the matching cost of each intent, if `profile_intents`
+        @param intent_name: name of the intent
+        @param seconds: time spent matching the intent
+        @param regexes: number of regex executions, fuzzy variants included
+        """
+
+
+class Trace:
+    """
+    Events recorded while matching, sent back from the backend workers
+    """
+    __slots__ = ("timings", "counts", "intents")
+
+    def __init__(self, profile_intents: bool = False):
+        self.timings: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        # intent name -> [seconds, regex executions], if profiling
+        self.intents: Optional[Dict[str, list]] = \
+            {} if profile_intents else None
+
+    def add_time(self, stage: str, seconds: float):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def count(self, counter: str, value: int = 1):
+        self.counts[counter] = self.counts.get(counter, 0) + value
+
+    def add_intent(self, intent_name: str, seconds: float, regexes: int):
+        entry = self.intents.get(intent_name)
+        if entry is None:
+            self.intents[intent_name] = [seconds, regexes]
+        else:
+            entry[0] += seconds
+            entry[1] += regexes
+
+    def merge(self, other: 'Trace'):
+        for stage, seconds in other.timings.items():
+            self.add_time(stage, seconds)
+        for counter, value in other.counts.items():
+            self.count(counter, value)
+        if other.intents:
+            if self.intents is None:
+                self.intents = {}
+            for intent_name, (seconds, regexes) in other.intents.items():
+                self.add_intent(intent_name, seconds, regexes)
+
+    def __getstate__(self):
+        return self.timings, self.counts, self.intents
+
+    def __setstate__(self, state):
+        self.timings, self.counts, self.intents = state
+
+
+class Aggregator(Observer):
+    """
+    Observer accumulating timings (count, total, max) and counters
+    """
+
+    def __init__(self, interval: Optional[float] = None,
+                 report: Optional[Callable[[dict], None]] = None):
+        """
+        @param interval: seconds between calls to `report`, None to never
+            report. Reports are made by the next event after the interval
+        @param report: called with `summary()` every `interval` seconds
+        """
+        self.interval = interval
+        self.report = report
+        self._lock = threading.Lock()
+        self._stages: Dict[str, list] = {}  # stage -> [count, total, max]
+        self._counts: Dict[str, int] = {}
+        self._last_report = time.monotonic()
+
+    def on_timing(self, stage: str, seconds: float):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+        self._maybe_report()
+
+    def on_count(self, counter: str, value: int):
+        with self._lock:
+            self._counts[counter] = self._counts.get(counter, 0) + value
+        self._maybe_report()
+
+    def _maybe_report(self):
+        if self.interval is None or self.report is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_report < self.interval:
+                return
+            self._last_report = now
+        self.report(self.summary())
+
+    def summary(self) -> dict:
+        """
+        @return: dict with "stages" (stage -> count, total, mean and max
+            seconds) and "counters" (counter -> value)
+        """
+        with self._lock:
+            stages = {stage: {"count": c, "total": t, "mean": t / c,
+                              "max": m}
+                      for stage, (c, t, m) in self._stages.items()}
+            return {"stages": stages, "counters": dict(self._counts)}
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counts.clear()
+
+    def prometheus(self, prefix: str = "padacioso") -> str:
+        """
+        Render the aggregated events in the Prometheus text format
+        @param prefix: metric name prefix
+        @return: text exposition of the metrics
+        """
+        summary = self.summary()
+        lines = [f"# HELP {prefix}_stage_seconds Time spent in each "
+                 f"matching stage",
+                 f"# TYPE {prefix}_stage_seconds summary"]
+        for stage, s in sorted(summary["stages"].items()):
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} '
+                         f'{s["total"]:.9g}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} '
+                         f'{s["count"]}')
+        lines += [f"# HELP {prefix}_stage_seconds_max Slowest run of each "
+                  f"matching stage",
+                  f"# TYPE {prefix}_stage_seconds_max gauge"]
+        for stage, s in sorted(summary["stages"].items()):
+            lines.append(f'{prefix}_stage_seconds_max{{stage="{stage}"}} '
+                         f'{s["max"]:.9g}')
+        lines += [f"# HELP {prefix}_events_total Work done while matching",
+                  f"# TYPE {prefix}_events_total counter"]
+        for counter, value in sorted(summary["counters"].items()):
+            lines.append(f'{prefix}_events_total{{event="{counter}"}} '
+                         f'{value}')
+        return "\n".join(lines) + "\n"
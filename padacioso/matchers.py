@@ -0,0 +1,257 @@
+"""
+Process wide store of compiled template matchers.
+
+Matchers are immutable once compiled, so every container (and every intent
+inside a container) registering the same template shares a single instance.
+Each acquisition is reference counted and a matcher is dropped when its last
+owner releases it.
+"""
+import copy
+import re
+import sys
+import threading
+from collections import Counter, deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import simplematch
+
+from padacioso.bracket_expansion import is_bracketed, BracketMatcher
+
+
+def new_matcher(template: str, case_sensitive: bool) -> simplematch.Matcher:
+    """
+    Compile a matcher for an expanded (or bracketed) template
+    """
+    if is_bracketed(template):
+        return BracketMatcher(template, case_sensitive=case_sensitive)
+    return simplematch.Matcher(template, case_sensitive=case_sensitive)
+
+
+def validate_template(template: str):
+    """
+    Check a template for the errors simplematch raises when compiling it,
+    without compiling it. Matchers are compiled on first use, so this keeps
+    bad templates from being registered
+    @param template: expanded intent template
+    @raises re.error: if a slot name is invalid or used twice
+    @raises KeyError: if a slot has an unknown type
+    """
+    # BracketMatcher aliases slots repeated across alternatives
+    unique = not is_bracketed(template)
+    names = set()
+    for name, type_ in re.findall(r"\{(\w+)(?::(\w+))?\}", template):
+        if type_ and type_ not in simplematch.types:
+            raise KeyError(type_)
+        if not name.isidentifier():
+            raise re.error(f"bad character in group name '{name}'")
+        if unique and name in names:
+            raise re.error(f"redefinition of group name '{name}'")
+        names.add(name)
+
+
+class NullMatcher:
+    """
+    Stands in for the matcher of a template that failed to compile
+    """
+
+    def match(self, string):
+        return None
+
+
+def case_insensitive_copy(matcher: simplematch.Matcher) -> \
+        simplematch.Matcher:
+    """
+    Case insensitive variant of a case sensitive matcher, sharing its regex
+    source and converters instead of translating the template again
+    """
+    uncased = copy.copy(matcher)
+    uncased.case_sensitive = False
+    uncased._regex_compiled = re.compile(matcher.regex, re.IGNORECASE)
+    return uncased
+
+
+def matcher_memory_usage(matcher: simplematch.Matcher) -> int:
+    """
+    Approximate memory used by a compiled matcher and its regexes, in bytes
+    """
+    return sys.getsizeof(matcher) + sum(
+        sys.getsizeof(v) for v in vars(matcher).values()
+        if isinstance(v, (str, re.Pattern)))
+
+
+def vocabulary_regex(values: Iterable[str]) -> str:
+    """
+    Compile entity values into a regex matching exactly those values, as a
+    character trie so values sharing a prefix share regex states
+    @param values: entity values
+    @return: regex without anchors or groups
+    """
+    trie = {}
+    for value in values:
+        node = trie
+        for char in value:
+            node = node.setdefault(char, {})
+        node[""] = {}  # end of a value
+    return _trie_regex(trie)
+
+
+def _trie_regex(node: dict) -> str:
+    alternatives = [re.escape(char) + _trie_regex(child)
+                    for char, child in sorted(node.items()) if char]
+    if not alternatives:
+        return ""
+    if len(alternatives) == 1:
+        regex = alternatives[0]
+        if "" not in node:
+            return regex
+        return f"(?:{regex})?"
+    regex = "(?:" + "|".join(alternatives) + ")"
+    return regex + "?" if "" in node else regex
+
+
+class EntityMatcher(simplematch.Matcher):
+    """
+    Matcher whose `{entity}` slots only capture values of registered
+    entities, other slots and wildcards behave as in simplematch
+    """
+
+    def __init__(self, pattern: str, vocabulary: Dict[str, str],
+                 case_sensitive: bool = True):
+        """
+        @param pattern: expanded intent template
+        @param vocabulary: slot name -> regex of its values, see
+            `vocabulary_regex`
+        @param case_sensitive: match case sensitively
+        """
+        self._vocabulary = vocabulary
+        super().__init__(pattern, case_sensitive)
+
+    def _field_repl(self, matchobj):
+        match = re.fullmatch(r"\{(\w+)\}", matchobj.group(0))
+        if match and match.group(1) in self._vocabulary:
+            name = match.group(1)
+            return r"(?P<%s>%s)" % (name, self._vocabulary[name])
+        return super()._field_repl(matchobj)
+
+
+class Template:
+    """
+    A registered template, the intents using it and its matchers, compiled
+    on first use
+    """
+    __slots__ = ("text", "owners", "literal", "cased", "uncased",
+                 "entity_cased", "entity_uncased")
+
+    def __init__(self, text: str, literal: bool):
+        self.text = text
+        self.owners = set()
+        # plain sentence, compared without regexes
+        self.literal = literal
+        self.cased: Optional[simplematch.Matcher] = None
+        self.uncased: Optional[simplematch.Matcher] = None
+        # EntityMatcher restricting the slots to entity values, if any
+        self.entity_cased: Optional[simplematch.Matcher] = None
+        self.entity_uncased: Optional[simplematch.Matcher] = None
+
+
+class MatcherStore:
+    """
+    Reference counted matchers keyed by (template, case_sensitive)
+    """
+
+    def __init__(self):
+        # key -> [matcher, reference count]
+        self._entries: Dict[Tuple[str, bool], list] = {}
+        self._lock = threading.Lock()
+        # references of garbage collected owners, see release_all
+        self._released = deque()
+
+    def __len__(self):
+        with self._lock:
+            self._drain()
+            return len(self._entries)
+
+    def __contains__(self, key: Tuple[str, bool]):
+        return key in self._entries
+
+    def acquire(self, template: str,
+                case_sensitive: bool) -> simplematch.Matcher:
+        """
+        Get the shared matcher of a template, compiling it if needed
+        @param template: expanded intent template
+        @param case_sensitive: match case sensitively
+        @return: compiled matcher, to be released by the caller when done
+        """
+        key = (template, case_sensitive)
+        with self._lock:
+            self._drain()
+            entry = self._entries.get(key)
+            if entry is None:
+                cased = self._entries.get((template, True))
+                if not case_sensitive and cased is not None:
+                    matcher = case_insensitive_copy(cased[0])
+                else:
+                    matcher = new_matcher(template, case_sensitive)
+                entry = self._entries[key] = [matcher, 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, template: str, case_sensitive: bool, count: int = 1):
+        """
+        Drop references to a matcher, freeing it with the last one
+        @param template: expanded intent template
+        @param case_sensitive: match case sensitively
+        @param count: number of references to drop
+        """
+        with self._lock:
+            self._drain()
+            self._release((template, case_sensitive), count)
+
+    def _release(self, key: Tuple[str, bool], count: int):
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry[1] -= count
+        if entry[1] <= 0:
+            del self._entries[key]
+
+    def release_all(self, refs: Counter):
+        """
+        Drop every reference in `refs`, used when an owner goes away. This
+        runs from garbage collection finalizers, possibly while the store
+        lock is held, so references are only queued here and dropped by the
+        next store operation
+        @param refs: (template, case_sensitive) -> reference count
+        """
+        self._released.append(refs)
+
+    def _drain(self):
+        while self._released:
+            refs = self._released.popleft()
+            for key, count in refs.items():
+                self._release(key, count)
+
+    def references(self, template: str, case_sensitive: bool) -> int:
+        """
+        @return: number of owners of a matcher
+        """
+        with self._lock:
+            self._drain()
+            entry = self._entries.get((template, case_sensitive))
+            return entry[1] if entry is not None else 0
+
+    @property
+    def stats(self) -> dict:
+        """
+        Number of stored matchers, references to them, and matchers with
+        more than one owner
+        """
+        with self._lock:
+            self._drain()
+            counts: List[int] = [e[1] for e in self._entries.values()]
+        return {"matchers": len(counts), "references": sum(counts),
+                "shared": sum(1 for c in counts if c > 1)}
+
+
+# store shared by all the containers of this process
+SHARED_MATCHERS = MatcherStore()
@@ -1,7 +1,10 @@
 """Intent service wrapping padacioso."""
 
-from functools import lru_cache
-from os.path import isfile
+import threading
+import time
+import weakref
+from functools import partial
+from os.path import expanduser, isfile, join
 from typing import Optional, Dict, List, Union
 
 from langcodes import closest_match
@@ -16,6 +19,14 @@ from ovos_utils.lang import standardize_lang_tag
 from ovos_utils.log import LOG, log_deprecation
 
 from padacioso import IntentContainer as FallbackIntentContainer
+from padacioso.cache import ResultCache
+from padacioso.instrumentation import Aggregator, Observer
+from padacioso.profiler import IntentProfiler
+from padacioso.registry import SkillRegistry
+from padacioso.snapshot import read_snapshot, source_hash
+
+# cache lookup sentinel, None is a valid cached result
+_MISSING = object()
 
 
 class PadaciosoIntent:
@@ -65,21 +76,73 @@ class PadaciosoPipeline(ConfidenceMatcherPipeline):
         self.conf_med = self.config.get("conf_med") or 0.8
         self.conf_low = self.config.get("conf_low") or 0.5
         self.workers = self.config.get("workers") or 4
+        self.backend = self.config.get("backend") or "inline"
+
+        # match languages by tag and base language only, without computing
+        # language distances
+        self.strict_lang = self.config.get("strict_lang", False)
+        # language tag -> container language, see _get_closest_lang
+        self._lang_table = {}
+        self._lang_keys = ()
+        self._lang_bases = {}
 
         self.containers = {lang: FallbackIntentContainer(
-            self.config.get("fuzz"), n_workers=self.workers)
+            self.config.get("fuzz"), n_workers=self.workers,
+            backend=self.backend,
+            expansion_budget=self.config.get("expansion_budget", 512),
+            similarity=self.config.get("similarity", "difflib"),
+            constrain_entities=self.config.get("constrain_entities", False),
+            warm_up=self.config.get("warm_up", False))
             for lang in langs}
 
+        # templates of previously registered intents, reused when a skill
+        # registers the same intent lines again, see _add_intent
+        self.snapshot_dir = self.config.get("snapshot_dir")
+        self._staged = {lang: self._read_snapshot(lang) for lang in langs}
+
         self.bus.on('padatious:register_intent', self.register_intent)
         self.bus.on('padatious:register_entity', self.register_entity)
+        self.bus.on('padacioso:register_skill', self.register_skill)
+        self.bus.on('padacioso:profile.start', self.handle_profile_start)
+        self.bus.on('padacioso:profile.stop', self.handle_profile_stop)
+        self.bus.on('padacioso:profile.report', self.handle_profile_report)
         self.bus.on('detach_intent', self.handle_detach_intent)
         self.bus.on('detach_skill', self.handle_detach_skill)
 
-        self.registered_intents = []
-        self.registered_entities = []
+        # repeat calls under different conf levels wont re-run code
+        self._cache = ResultCache(self.config.get("cache_size", 1024),
+                                  self.config.get("cache_ttl", 300))
+
+        # id(message) -> (message weakref, utterances, lang, best intent)
+        self._tier_results = {}
+        self._tier_lock = threading.Lock()
+
+        # skill_id -> intents/entities -> languages
+        self._registry = SkillRegistry()
+
+        # opt-in stage timings and counters, see add_observer
+        self._observers: List[Observer] = []
+        self.instrumentation: Optional[Aggregator] = None
+        if self.config.get("instrumentation"):
+            self.instrumentation = Aggregator(
+                self.config.get("instrumentation_interval"),
+                _log_instrumentation)
+            self.add_observer(self.instrumentation)
+        # per intent costs, see start_profiling
+        self.profiler: Optional[IntentProfiler] = None
+        if self.config.get("profile_intents"):
+            self.start_profiling()
         self.max_words = 50  # if an utterance contains more words than this, don't attempt to match
         LOG.debug('Loaded Padacioso intent parser.')
 
+    @property
+    def registered_intents(self) -> List[str]:
+        return self._registry.intents
+
+    @property
+    def registered_entities(self) -> List[dict]:
+        return self._registry.entities
+
     @property
     def padacioso_config(self) -> Dict:
         log_deprecation("self.padacioso_config is deprecated, access self.config directly instead", "1.0.0")
@@ -100,10 +163,7 @@ class PadaciosoPipeline(ConfidenceMatcherPipeline):
             limit (float): required confidence level.
         """
         LOG.debug(f'Padacioso Matching confidence > {limit}')
-        # call flatten in case someone is sending the old style list of tuples
-        utterances = flatten_list(utterances)
-        lang = standardize_lang_tag(lang or self.lang)
-        padacioso_intent = self.calc_intent(utterances, lang, message)
+        padacioso_intent = self._scored_intent(utterances, lang, message)
         if padacioso_intent is not None and padacioso_intent.conf > limit:
             skill_id = padacioso_intent.name.split(':')[0]
             return IntentHandlerMatch(match_type=padacioso_intent.name,
@@ -111,6 +171,46 @@ class PadaciosoPipeline(ConfidenceMatcherPipeline):
                                skill_id=skill_id,
                                utterance=padacioso_intent.sent)
 
+    def _scored_intent(self, utterances, lang=None,
+                       message: Optional[Message] = None) -> Optional[PadaciosoIntent]:
+        """Best intent for a message, computed once and shared by every
+        confidence tier asking for the same message and utterances.
+
+        Args:
+            utterances (list of tuples): Utterances to parse, originals paired
+                                         with optional normalized version.
+            lang (str): language of the utterances
+            message (Message): message being matched
+        """
+        if message is not None:
+            with self._tier_lock:
+                entry = self._tier_results.get(id(message))
+            if entry is not None and entry[0]() is message \
+                    and entry[1] == list(utterances) and entry[2] == lang:
+                self._emit_count("tier_hits")
+                return entry[3]
+
+        # call flatten in case someone is sending the old style list of tuples
+        flat = flatten_list(utterances)
+        padacioso_intent = self.calc_intent(
+            flat, standardize_lang_tag(lang or self.lang), message)
+
+        if message is not None:
+            key = id(message)
+            # Message is unhashable, track it by id until it is collected
+            ref = weakref.ref(message,
+                              lambda r, k=key: self._forget_message(k, r))
+            with self._tier_lock:
+                self._tier_results[key] = (ref, list(utterances), lang,
+                                           padacioso_intent)
+        return padacioso_intent
+
+    def _forget_message(self, key: int, ref: weakref.ref):
+        with self._tier_lock:
+            entry = self._tier_results.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._tier_results[key]
+
     def match_high(self, utterances: List[str], lang: str, message: Message) -> Optional[IntentHandlerMatch]:
         """Intent matcher for high confidence.
 
@@ -144,9 +244,8 @@ class PadaciosoPipeline(ConfidenceMatcherPipeline):
         Args:
             intent_name (str): intent identifier
         """
-        if intent_name in self.registered_intents:
-            self.registered_intents.remove(intent_name)
-            for lang in self.containers:
+        for lang in self._registry.remove_intent(intent_name):
+            if lang in self.containers:
                 self.containers[lang].remove_intent(intent_name)
 
     def handle_detach_intent(self, message):
@@ -155,7 +254,9 @@ class PadaciosoPipeline(ConfidenceMatcherPipeline):
         Args:
             message (Message): message triggering action
         """
-        self.__detach_intent(message.data.get('intent_name'))
+        intent_name = message.data.get('intent_name')
+        if intent_name:
+            self.__detach_intent(intent_name)
 
     def __detach_entity(self, name, lang):
         """ Remove an entity.
@@ -174,13 +275,11 @@ class PadaciosoPipeline(ConfidenceMatcherPipeline):
             message (Message): message triggering action
         """
         skill_id = message.data['skill_id']
-        remove_list = [i for i in self.registered_intents if skill_id in i]
-        for i in remove_list:
-            self.__detach_intent(i)
-        skill_id_colon = skill_id + ":"
-        for en in self.registered_entities:
-            if en["name"].startswith(skill_id_colon):
-                self.__detach_entity(en["name"], en["lang"])
+        for intent_name in self._registry.skill_intents(skill_id):
+            self.__detach_intent(intent_name)
+        for name in self._registry.skill_entities(skill_id):
+            for lang in self._registry.remove_entity(name):
+                self.__detach_entity(name, lang)
 
     def _register_object(self, message, object_name, register_func):
         """Generic method for registering a padacioso object.
@@ -190,21 +289,35 @@ class PadaciosoPipeline(ConfidenceMatcherPipeline):
             object_name (str): type of entry to register
             register_func (callable): function to call for registration
         """
-        file_name = message.data.get('file_name')
-        samples = message.data.get("samples")
-        name = message.data['name']
+        samples = self._load_samples(message.data, object_name)
+        if samples is not None:
+            register_func(message.data['name'], samples)
+
+    @staticmethod
+    def _load_samples(data: dict, object_name: str) -> Optional[List[str]]:
+        """Get the samples of a padacioso object, reading its file if needed.
+
+        Args:
+            data (dict): registration data, with samples or a file_name
+            object_name (str): type of entry to register
+
+        Returns:
+            list of samples, None if the object has none
+        """
+        file_name = data.get('file_name')
+        samples = data.get("samples")
+        name = data['name']
 
         LOG.debug('Registering Padacioso ' + object_name + ': ' + name)
 
         if (not file_name or not isfile(file_name)) and not samples:
             LOG.error('Could not find file ' + file_name)
-            return
+            return None
 
         if not samples and isfile(file_name):
             with open(file_name) as f:
                 samples = [line.strip() for line in f.readlines()]
-
-        register_func(name, samples)
+        return samples
 
     def register_intent(self, message):
         """Messagebus handler for registering intents.
@@ -215,15 +328,105 @@ class PadaciosoPipeline(ConfidenceMatcherPipeline):
         lang = message.data.get('lang', self.lang)
         lang = standardize_lang_tag(lang)
         if lang in self.containers:
-            self.registered_intents.append(message.data['name'])
-            try:
-                self._register_object(message, 'intent',
-                                      self.containers[lang].add_intent)
-            except RuntimeError:
-                name = message.data.get('name', "")
-                # padacioso fails on reloading a skill, just ignore
-                if name not in self.containers[lang].intent_samples:
-                    raise
+            self._registry.add_intent(message.data['name'], lang)
+            self._register_object(message, 'intent',
+                                  partial(self._add_intent, lang))
+
+    def register_skill(self, message):
+        """Messagebus handler registering all intents and entities of a
+        skill in one go.
+
+        Message data holds the `lang` and lists of `intents` and
+        `entities`, each entry formatted as the data of the
+        padatious:register_intent and padatious:register_entity messages.
+        Entities are registered first, so intents are compiled once.
+
+        Args:
+            message (Message): message triggering action
+        """
+        lang = message.data.get('lang', self.lang)
+        lang = standardize_lang_tag(lang)
+        if lang not in self.containers:
+            return
+        entities = {}
+        for data in message.data.get('entities', []):
+            samples = self._load_samples(data, 'entity')
+            if samples is not None:
+                self._registry.add_entity(data['name'], lang, data)
+                entities[data['name']] = samples
+        self.containers[lang].add_entities(entities)
+        intents = {}
+        for data in message.data.get('intents', []):
+            samples = self._load_samples(data, 'intent')
+            if samples is not None:
+                self._registry.add_intent(data['name'], lang)
+                intents[data['name']] = samples
+        self._add_intents(lang, intents)
+
+    def _add_intent(self, lang: str, name: str, samples: List[str]):
+        """
+        Add an intent to a container, see `_add_intents`
+        """
+        self._add_intents(lang, {name: samples})
+
+    def _add_intents(self, lang: str, intents: Dict[str, List[str]]):
+        """
+        Add intents to a container, restoring their templates from the
+        snapshot if the intent lines did not change since it was taken. A
+        reloaded skill registering an intent again replaces it in place
+        @param lang: language of the intents
+        @param intents: intent name -> intent lines
+        """
+        container = self.containers[lang]
+        new = {}
+        for name, samples in intents.items():
+            staged = self._staged.get(lang, {}).pop(name, None)
+            source = source_hash(samples)
+            if name in container.intent_samples:
+                container.replace_intent(name, samples)
+            elif staged is not None and staged[0] == source:
+                container._restore_intent(name, staged[1], source)
+            else:
+                new[name] = samples
+        container.add_intents(new)
+
+    def _snapshot_path(self, lang: str) -> Optional[str]:
+        if self.snapshot_dir:
+            return join(expanduser(self.snapshot_dir), f"{lang}.json")
+        return None
+
+    def _read_snapshot(self, lang: str) -> Dict[str, tuple]:
+        """
+        Read the snapshot of a language, if any
+        @return: intent name -> (source hash, expanded templates)
+        """
+        path = self._snapshot_path(lang)
+        if not path or not isfile(path):
+            return {}
+        try:
+            state = read_snapshot(path)
+        except (OSError, ValueError) as e:
+            LOG.warning(f"Ignoring padacioso snapshot {path}: {e}")
+            return {}
+        if state["expansion_budget"] != self.config.get("expansion_budget",
+                                                        512):
+            return {}
+        return {name: (state["sources"][name], regexes)
+                for name, regexes in state["intents"].items()
+                if name in state["sources"]}
+
+    def save_snapshots(self):
+        """
+        Save the intents of every language, so the next start can skip
+        expanding intents that did not change
+        """
+        for lang, container in self.containers.items():
+            path = self._snapshot_path(lang)
+            if path:
+                try:
+                    container.save(path)
+                except OSError as e:
+                    LOG.error(f"Failed to save padacioso snapshot {path}: {e}")
 
     def register_entity(self, message):
         """Messagebus handler for registering entities.
@@ -234,7 +437,8 @@ class PadaciosoPipeline(ConfidenceMatcherPipeline):
         lang = message.data.get('lang', self.lang)
         lang = standardize_lang_tag(lang)
         if lang in self.containers:
-            self.registered_entities.append(message.data)
+            self._registry.add_entity(message.data['name'], lang,
+                                      message.data)
             self._register_object(message, 'entity',
                                   self.containers[lang].add_entity)
 
@@ -257,40 +461,307 @@ class PadaciosoPipeline(ConfidenceMatcherPipeline):
 
         lang = lang or self.lang
 
+        start = time.perf_counter() if self._observers else None
         lang = self._get_closest_lang(lang)
+        if start is not None:
+            self._emit_timing("lang_resolution", time.perf_counter() - start)
         if lang is None:  # no intents registered for this lang
             return None
 
         sess = SessionManager.get(message)
 
         intent_container = self.containers.get(lang)
-        intents = [_calc_padacioso_intent(utt, intent_container, sess)
+        intents = [self._cached_intent(lang, utt, intent_container, sess)
                    for utt in utterances]
         intents = [i for i in intents if i is not None]
+        if start is not None:
+            self._emit_timing("pipeline", time.perf_counter() - start)
         # select best
         if intents:
             return max(intents, key=lambda k: k.conf)
 
+    def _cached_intent(self, lang: str, utt: str,
+                       intent_container: FallbackIntentContainer,
+                       sess: Session) -> Optional[PadaciosoIntent]:
+        """
+        Get the best intent match for an utterance, from the result cache
+        if possible
+        """
+        key = _cache_key(lang, utt, intent_container, sess)
+        intent = self._cache.get(key, _MISSING)
+        if intent is _MISSING:
+            self._emit_count("cache_misses")
+            intent = _calc_padacioso_intent(utt, intent_container, sess)
+            self._cache.put(key, intent)
+        else:
+            self._emit_count("cache_hits")
+        return intent
+
+    def add_observer(self, observer: Observer):
+        """
+        Report the timings and counters of the pipeline and of the intent
+        containers of every language, see padacioso.instrumentation
+        @param observer: receives the events of every utterance
+        """
+        self._observers.append(observer)
+        for container in self.containers.values():
+            container.add_observer(observer)
+
+    def remove_observer(self, observer: Observer):
+        """
+        Stop reporting events to an observer
+        """
+        if observer in self._observers:
+            self._observers.remove(observer)
+        for container in self.containers.values():
+            container.remove_observer(observer)
+
+    def start_profiling(self):
+        """
+        Start recording the matching cost of every intent, see
+        `profile_report`
+        """
+        if self.profiler is None:
+            self.profiler = IntentProfiler()
+            self.add_observer(self.profiler)
+
+    def stop_profiling(self):
+        """
+        Stop recording intent costs, discarding the ones recorded
+        """
+        if self.profiler is not None:
+            self.remove_observer(self.profiler)
+            self.profiler = None
+
+    def profile_report(self, by: str = "time", top: Optional[int] = None,
+                       skills: bool = False) -> List[dict]:
+        """
+        Rank the intents, or skills, by matching cost and memory used
+        @param by: ranking key, one of "time", "regexes", "memory", "calls"
+        @param top: only return the `top` most expensive entries
+        @param skills: aggregate intents by skill_id
+        @return: list of dicts, see `IntentProfiler.report`
+        """
+        memory = {}
+        for container in self.containers.values():
+            for name, size in container.intent_memory_usage().items():
+                memory[name] = memory.get(name, 0) + size
+        profiler = self.profiler or IntentProfiler()
+        return profiler.report(memory, by=by, top=top, skills=skills)
+
+    def handle_profile_start(self, message):
+        """Messagebus handler starting the intent profiler.
+
+        Args:
+            message (Message): message triggering action
+        """
+        self.start_profiling()
+
+    def handle_profile_stop(self, message):
+        """Messagebus handler stopping the intent profiler.
+
+        Args:
+            message (Message): message triggering action
+        """
+        self.stop_profiling()
+
+    def handle_profile_report(self, message):
+        """Messagebus handler replying with the intents, or skills, ranked
+        by matching cost.
+
+        Args:
+            message (Message): message with optional `by`, `top` and
+                               `skills` data, see profile_report
+        """
+        by = message.data.get("by", "time")
+        skills = message.data.get("skills", False)
+        try:
+            report = self.profile_report(by, message.data.get("top"), skills)
+        except ValueError as e:
+            self.bus.emit(message.reply("padacioso:profile.report.response",
+                                        {"error": str(e)}))
+            return
+        self.bus.emit(message.reply("padacioso:profile.report.response",
+                                    {"by": by, "skills": skills,
+                                     "profiling": self.profiler is not None,
+                                     "report": report}))
+
+    def _emit_timing(self, stage: str, seconds: float):
+        for observer in self._observers:
+            observer.on_timing(stage, seconds)
+
+    def _emit_count(self, counter: str, value: int = 1):
+        for observer in self._observers:
+            observer.on_count(counter, value)
+
+    @property
+    def cache_stats(self) -> dict:
+        """
+        Hit/miss counters of the intent result cache
+        """
+        return self._cache.stats
+
+    def calc_intent_batch(self, utterances: List[str], lang: str = None,
+                          message: Optional[Message] = None) -> \
+            List[Optional[PadaciosoIntent]]:
+        """
+        Get the best intent match for each of many utterances, matched in a
+        single batch by the intent container
+        @param utterances: list of string utterances to get an intent for
+        @param lang: language of utterances
+        @param message: message used to get the session
+        @return: list of matched intents (or None), in the same order as
+            `utterances`
+        """
+        batch = self._prepare_batch(utterances, lang, message)
+        if batch is None:
+            return [None] * len(utterances)
+        intent_container, sess, intents, keys = batch
+        if keys:
+            results = intent_container.calc_intents_batch(
+                list(keys), top_k=1,
+                exclude_intents=_blacklisted_intents(intent_container, sess))
+            self._store_batch(keys, results, intents)
+        return [intents.get(utt) for utt in utterances]
+
+    async def acalc_intent(self, utterances: List[str], lang: str = None,
+                           message: Optional[Message] = None) -> \
+            Optional[PadaciosoIntent]:
+        """
+        asyncio version of `calc_intent`, matching does not block the event
+        loop. A newer call for the same session supersedes a pending one,
+        which raises asyncio.CancelledError
+        @param utterances: list of string utterances to get an intent for
+        @param lang: language of utterances
+        @param message: message used to get the session
+        @return: best matched intent (or None)
+        """
+        if isinstance(utterances, str):
+            utterances = [utterances]
+        batch = self._prepare_batch(utterances, lang, message)
+        if batch is None:
+            return None
+        intent_container, sess, intents, keys = batch
+        if keys:
+            results = await intent_container.acalc_intents_batch(
+                list(keys), top_k=1,
+                exclude_intents=_blacklisted_intents(intent_container, sess),
+                key=sess.session_id)
+            self._store_batch(keys, results, intents)
+        intents = [i for i in intents.values() if i is not None]
+        if intents:
+            return max(intents, key=lambda k: k.conf)
+
+    def _prepare_batch(self, utterances: List[str], lang: Optional[str],
+                       message: Optional[Message]) -> Optional[tuple]:
+        """
+        Resolve the container and session used to match a batch of
+        utterances, and look them up in the result cache
+        @return: tuple of (container, session, utterance -> cached intent,
+            utterance -> cache key of the ones to match), or None if no
+            intents are registered for `lang`
+        """
+        lang = self._get_closest_lang(lang or self.lang)
+        if lang is None:  # no intents registered for this lang
+            return None
+        sess = SessionManager.get(message)
+        intent_container = self.containers.get(lang)
+        intents, keys = {}, {}
+        for utt in utterances:
+            if utt in intents or utt in keys \
+                    or len(utt.split()) >= self.max_words:
+                continue
+            key = _cache_key(lang, utt, intent_container, sess)
+            intent = self._cache.get(key, _MISSING)
+            if intent is _MISSING:
+                keys[utt] = key
+            else:
+                intents[utt] = intent
+        self._emit_count("cache_hits", len(intents))
+        self._emit_count("cache_misses", len(keys))
+        return intent_container, sess, intents, keys
+
+    def _store_batch(self, keys: Dict[str, tuple], results: List[List[dict]],
+                     intents: Dict[str, Optional[PadaciosoIntent]]):
+        """
+        Convert the top match of each utterance and cache it
+        @param keys: utterance -> cache key, in the order they were matched
+        @param results: matches of each utterance
+        @param intents: utterance -> intent, updated
+        """
+        for (utt, key), res in zip(keys.items(), results):
+            intent = _to_padacioso_intent(res[0], utt) if res else None
+            self._cache.put(key, intent)
+            intents[utt] = intent
+
     def _get_closest_lang(self, lang: str) -> Optional[str]:
-        if self.containers:
-            lang = standardize_lang_tag(lang)
-            closest, score = closest_match(lang, list(self.containers.keys()))
-            # https://langcodes-hickford.readthedocs.io/en/sphinx/index.html#distance-values
-            # 0 -> These codes represent the same language, possibly after filling in values and normalizing.
-            # 1- 3 -> These codes indicate a minor regional difference.
-            # 4 - 10 -> These codes indicate a significant but unproblematic regional difference.
-            if score < 10:
-                return closest
+        """
+        Get the container language used to match utterances in `lang`,
+        resolved once per language tag and memoized
+        @param lang: language tag of the utterances
+        @return: container language, None if no container can be used
+        """
+        if self._lang_keys != tuple(self.containers):
+            self._build_lang_table()
+        table = self._lang_table
+        if lang in table:
+            return table[lang]
+        closest = self._resolve_lang(lang)
+        if len(table) < 512:  # bound the table if fed arbitrary tags
+            table[lang] = closest
+        return closest
+
+    def _build_lang_table(self):
+        """
+        Precompute the language resolution table, the container tags and
+        their base languages resolve without any distance computation
+        """
+        self._lang_keys = tuple(self.containers)
+        self._lang_bases = {}
+        for lang in self._lang_keys:
+            self._lang_bases.setdefault(_base_lang(lang), []).append(lang)
+        table = {lang: lang for lang in self._lang_keys}
+        for base in self._lang_bases:
+            if base not in table:
+                table[base] = self._resolve_lang(base)
+        self._lang_table = table
+
+    def _resolve_lang(self, lang: str) -> Optional[str]:
+        if not self.containers:
+            return None
+        lang = standardize_lang_tag(lang)
+        if lang in self.containers:
+            return lang
+        if self.strict_lang:
+            # only the base language may differ, prefer the primary language
+            candidates = self._lang_bases.get(_base_lang(lang))
+            if not candidates:
+                return None
+            return self.lang if self.lang in candidates else candidates[0]
+        closest, score = closest_match(lang, list(self.containers.keys()))
+        # https://langcodes-hickford.readthedocs.io/en/sphinx/index.html#distance-values
+        # 0 -> These codes represent the same language, possibly after filling in values and normalizing.
+        # 1- 3 -> These codes indicate a minor regional difference.
+        # 4 - 10 -> These codes indicate a significant but unproblematic regional difference.
+        if score < 10:
+            return closest
         return None
 
     def shutdown(self):
         self.bus.remove('padatious:register_intent', self.register_intent)
         self.bus.remove('padatious:register_entity', self.register_entity)
+        self.bus.remove('padacioso:register_skill', self.register_skill)
+        self.bus.remove('padacioso:profile.start', self.handle_profile_start)
+        self.bus.remove('padacioso:profile.stop', self.handle_profile_stop)
+        self.bus.remove('padacioso:profile.report',
+                        self.handle_profile_report)
         self.bus.remove('detach_intent', self.handle_detach_intent)
         self.bus.remove('detach_skill', self.handle_detach_skill)
+        self.save_snapshots()
+        for container in self.containers.values():
+            container.close()
 
 
-@lru_cache(maxsize=3)  # repeat calls under different conf levels wont re-run code
 def _calc_padacioso_intent(utt: str,
                            intent_container: FallbackIntentContainer,
                            sess: Session) -> \
@@ -301,23 +772,60 @@ def _calc_padacioso_intent(utt: str,
     @return: matched PadaciosoIntent
     """
     try:
-        intents = [i for i in intent_container.calc_intents(utt)
-                   if i is not None
-                   and i["name"] not in sess.blacklisted_intents
-                   and i["name"].split(":")[0] not in sess.blacklisted_skills]
+        # ties are broken by the container, see IntentContainer.calc_intent
+        intents = list(intent_container.calc_intents(
+            utt, top_k=1,
+            exclude_intents=_blacklisted_intents(intent_container, sess)))
         if len(intents) == 0:
             return None
-        best_conf = max(x.get("conf", 0) for x in intents if x.get("name"))
-        ties = [i for i in intents if i.get("conf", 0) == best_conf]
-        if not ties:
-            return None
-        # TODO - how to disambiguate ?
-        intent = ties[0]
-        if "entities" in intent:
-            intent["matches"] = intent.pop("entities")
-        intent["sent"] = utt
-        intent = PadaciosoIntent(**intent)
-        intent.sent = utt
-        return intent
+        return _to_padacioso_intent(intents[0], utt)
     except Exception as e:
         LOG.error(e)
+
+
+def _blacklisted_intents(intent_container: FallbackIntentContainer,
+                         sess: Session) -> List[str]:
+    """
+    Get the intents of a container blacklisted by the session
+    """
+    if not sess.blacklisted_intents and not sess.blacklisted_skills:
+        return []
+    return [name for name in intent_container.intent_samples
+            if name in sess.blacklisted_intents
+            or name.split(":")[0] in sess.blacklisted_skills]
+
+
+def _to_padacioso_intent(intent: dict, utt: str) -> PadaciosoIntent:
+    """
+    Convert a dict intent match from IntentContainer into a PadaciosoIntent
+    """
+    intent = dict(intent)
+    if "entities" in intent:
+        intent["matches"] = intent.pop("entities")
+    intent["sent"] = utt
+    return PadaciosoIntent(**intent)
+
+
+def _cache_key(lang: str, utt: str,
+               intent_container: FallbackIntentContainer,
+               sess: Session) -> tuple:
+    """
+    Result cache key, sessions with the same blacklists share entries and
+    any change to the container makes its old entries unreachable
+    """
+    return (lang, utt, intent_container.generation,
+            frozenset(sess.blacklisted_intents),
+            frozenset(sess.blacklisted_skills))
+
+
+def _log_instrumentation(summary: dict):
+    stages = ", ".join(f"{stage} {s['mean'] * 1000:.2f}ms x{s['count']}"
+                       for stage, s in summary["stages"].items())
+    LOG.info(f"padacioso stages: {stages} counters: {summary['counters']}")
+
+
+def _base_lang(lang: str) -> str:
+    """
+    Base language subtag of a language tag, eg. "en" for "en-US"
+    """
+    return lang.replace("_", "-").split("-")[0].lower()
@@ -0,0 +1,119 @@
+"""
+Inverted index from required literal words to intent templates.
+
+A word of a template that contains no wildcard or entity slot must appear,
+delimited by spaces, in every utterance the template matches. Looking up the
+words of an utterance in the index gives the templates that can possibly
+match it before any regex runs.
+"""
+import sys
+from collections import Counter
+from typing import Dict, FrozenSet, Set
+
+from padacioso.automaton import _fold
+
+
+def required_tokens(template: str) -> FrozenSet[str]:
+    """
+    Get the literal words a query must contain to match a template
+    @param template: expanded intent template
+    @return: set of lower cased words
+    """
+    # words repeat across templates, the postings share one copy of each
+    return frozenset(sys.intern(_fold(w)) for w in template.split(" ")
+                     if w and not any(c in w for c in "*{}"))
+
+
+def query_tokens(query: str) -> Set[str]:
+    """
+    @param query: input utterance
+    @return: set of lower cased words in the utterance
+    """
+    return set(_fold(query).split(" "))
+
+
+class TokenIndex:
+    """
+    Prefilter selecting the templates a query can match
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Set[str]] = {}
+        self._required: Dict[str, int] = {}
+        # templates with none/one required words are always (fuzzy) candidates
+        self._free: Set[str] = set()
+        self._single: Set[str] = set()
+
+    def __len__(self):
+        return len(self._required)
+
+    def __contains__(self, template: str):
+        return template in self._required
+
+    def add(self, template: str):
+        """
+        Index a template
+        @param template: expanded intent template
+        """
+        if template in self._required:
+            return
+        tokens = required_tokens(template)
+        self._required[template] = len(tokens)
+        if not tokens:
+            self._free.add(template)
+        elif len(tokens) == 1:
+            self._single.add(template)
+        for tok in tokens:
+            self._postings.setdefault(tok, set()).add(template)
+
+    def remove(self, template: str):
+        """
+        Remove a template from the index
+        @param template: expanded intent template
+        """
+        if self._required.pop(template, None) is None:
+            return
+        self._free.discard(template)
+        self._single.discard(template)
+        for tok in required_tokens(template):
+            posting = self._postings.get(tok)
+            if posting is not None:
+                posting.discard(template)
+                if not posting:
+                    del self._postings[tok]
+
+    def memory_usage(self) -> int:
+        """
+        Approximate memory used by the index, in bytes. Templates and words
+        are shared with the container and not counted
+        """
+        size = sys.getsizeof(self._postings) + sys.getsizeof(self._required)
+        size += sys.getsizeof(self._free) + sys.getsizeof(self._single)
+        size += sum(sys.getsizeof(p) for p in self._postings.values())
+        return size
+
+    def _counts(self, tokens: Set[str]) -> Counter:
+        counts = Counter()
+        for tok in tokens:
+            posting = self._postings.get(tok)
+            if posting:
+                counts.update(posting)
+        return counts
+
+    def candidates(self, tokens: Set[str], fuzzy: bool = False) -> Set[str]:
+        """
+        Select the templates whose required words are present in a query
+        @param tokens: words of the query, see `query_tokens`
+        @param fuzzy: allow one required word to be missing, fuzzed
+            templates replace one word with a wildcard
+        @return: set of candidate templates
+        """
+        found = set(self._free)
+        missing = 0
+        if fuzzy:
+            missing = 1
+            found.update(self._single)
+        for template, count in self._counts(tokens).items():
+            if count >= self._required[template] - missing:
+                found.add(template)
+        return found
@@ -0,0 +1,87 @@
+"""
+Per intent matching cost, to find the skills slowing down matching for
+everyone (huge bracket expansions, leading wildcards...).
+
+    profiler = IntentProfiler()
+    container.add_observer(profiler)
+    ...
+    profiler.report(container.intent_memory_usage(), by="time", top=10)
+"""
+import threading
+from typing import Dict, List, Optional
+
+from padacioso.instrumentation import Observer
+from padacioso.registry import skill_of
+
+REPORT_KEYS = ("time", "regexes", "memory", "calls")
+
+
+class IntentProfiler(Observer):
+    """
+    Observer accumulating the matching time and regex executions of every
+    intent
+    """
+    profile_intents = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # intent name -> [calls, seconds, regex executions]
+        self._intents: Dict[str, list] = {}
+
+    def on_intent(self, intent_name: str, seconds: float, regexes: int):
+        with self._lock:
+            entry = self._intents.get(intent_name)
+            if entry is None:
+                entry = self._intents[intent_name] = [0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += regexes
+
+    def reset(self):
+        with self._lock:
+            self._intents.clear()
+
+    def report(self, memory: Optional[Dict[str, int]] = None,
+               by: str = "time", top: Optional[int] = None,
+               skills: bool = False) -> List[dict]:
+        """
+        Rank intents, or skills, by cost
+        @param memory: intent name -> bytes, see
+            `IntentContainer.intent_memory_usage`
+        @param by: ranking key, one of "time", "regexes", "memory", "calls"
+        @param top: only return the `top` most expensive entries
+        @param skills: aggregate intents by skill_id (the `skill_id:` prefix
+            of their names) instead of ranking intents
+        @return: list of dicts with name, calls, time (seconds), mean_time,
+            regexes and memory (bytes), most expensive first
+        """
+        if by not in REPORT_KEYS:
+            raise ValueError(f"Unknown ranking key {by}, expected one of "
+                             f"{REPORT_KEYS}")
+        memory = memory or {}
+        with self._lock:
+            costs = {name: list(entry)
+                     for name, entry in self._intents.items()}
+        rows = {}
+        for name in set(costs).union(memory):
+            calls, seconds, regexes = costs.get(name, (0, 0.0, 0))
+            key = name
+            if skills:
+                key = skill_of(name) or name
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = {"name": key, "calls": 0, "time": 0.0,
+                                   "regexes": 0, "memory": 0}
+                if skills:
+                    row["intents"] = 0
+            row["calls"] += calls
+            row["time"] += seconds
+            row["regexes"] += regexes
+            row["memory"] += memory.get(name, 0)
+            if skills:
+                row["intents"] += 1
+        for row in rows.values():
+            row["mean_time"] = row["time"] / row["calls"] \
+                if row["calls"] else 0.0
+        ranked = sorted(rows.values(), key=lambda r: (-r[by], r["name"]))
+        return ranked[:top] if top else ranked
@@ -0,0 +1,112 @@
+"""
+Index of the intents and entities registered in the pipeline.
+
+Intents and entities are named `skill_id:name`, the registry keeps them
+indexed by skill and by name, with the languages each one was registered in,
+so detaching an intent, an entity or a whole skill only touches the affected
+containers.
+"""
+from typing import Dict, List, Optional, Set
+
+
+def skill_of(name: str) -> Optional[str]:
+    """
+    @param name: intent or entity name, `skill_id:name`
+    @return: skill_id, None if the name has no skill prefix
+    """
+    if isinstance(name, str) and ":" in name:
+        return name.split(":")[0]
+    return None
+
+
+class SkillRegistry:
+    """
+    Registered intents and entities, indexed by skill, name and language
+    """
+
+    def __init__(self):
+        # intent name -> languages
+        self._intents: Dict[str, Set[str]] = {}
+        # entity name -> language -> registration message data
+        self._entities: Dict[str, Dict[str, dict]] = {}
+        # skill_id -> intent names, entity names
+        self._skill_intents: Dict[str, Set[str]] = {}
+        self._skill_entities: Dict[str, Set[str]] = {}
+
+    @property
+    def intents(self) -> List[str]:
+        return list(self._intents)
+
+    @property
+    def entities(self) -> List[dict]:
+        return [data for langs in self._entities.values()
+                for data in langs.values()]
+
+    def add_intent(self, name: str, lang: str) -> bool:
+        """
+        Record an intent registration
+        @param name: intent name
+        @param lang: language the intent was registered in
+        @return: False if the intent was already registered in `lang`
+        """
+        langs = self._intents.setdefault(name, set())
+        if lang in langs:
+            return False
+        langs.add(lang)
+        skill_id = skill_of(name)
+        if skill_id is not None:
+            self._skill_intents.setdefault(skill_id, set()).add(name)
+        return True
+
+    def remove_intent(self, name: str) -> Set[str]:
+        """
+        Forget an intent
+        @param name: intent name
+        @return: languages the intent was registered in
+        """
+        langs = self._intents.pop(name, set())
+        self._unindex(self._skill_intents, name)
+        return langs
+
+    def add_entity(self, name: str, lang: str, data: dict):
+        """
+        Record an entity registration, replacing a previous one
+        @param name: entity name
+        @param lang: language the entity was registered in
+        @param data: registration message data
+        """
+        self._entities.setdefault(name, {})[lang] = data
+        skill_id = skill_of(name)
+        if skill_id is not None:
+            self._skill_entities.setdefault(skill_id, set()).add(name)
+
+    def remove_entity(self, name: str) -> Dict[str, dict]:
+        """
+        Forget an entity
+        @param name: entity name
+        @return: language -> registration message data
+        """
+        langs = self._entities.pop(name, {})
+        self._unindex(self._skill_entities, name)
+        return langs
+
+    def skill_intents(self, skill_id: str) -> List[str]:
+        """
+        @return: names of the intents of a skill
+        """
+        return list(self._skill_intents.get(skill_id, ()))
+
+    def skill_entities(self, skill_id: str) -> List[str]:
+        """
+        @return: names of the entities of a skill
+        """
+        return list(self._skill_entities.get(skill_id, ()))
+
+    @staticmethod
+    def _unindex(index: Dict[str, Set[str]], name: str):
+        skill_id = skill_of(name)
+        names = index.get(skill_id)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del index[skill_id]
@@ -0,0 +1,135 @@
+"""
+String similarity backends used to score fuzzy intent matches.
+
+Each backend scores one query against many fuzzed templates in a single
+call. Backends implementing the same metric return identical scores, so the
+implementation picked at runtime never changes matching results:
+
+- "difflib": difflib.SequenceMatcher ratio, the historical padacioso metric
+- "indel": normalized Indel (LCS based) similarity, computed by rapidfuzz
+  when installed and by a pure python bit-parallel LCS otherwise
+"""
+from difflib import SequenceMatcher
+from typing import List
+
+try:
+    from rapidfuzz import process as _rf_process
+    from rapidfuzz.distance import Indel as _rf_indel
+except ImportError:
+    _rf_process = _rf_indel = None
+
+
+class SimilarityBackend:
+    """
+    Base class for similarity backends
+    """
+    name = "base"
+
+    def score(self, query: str, choices: List[str]) -> List[float]:
+        """
+        Score a query against a list of strings
+        @param query: input utterance
+        @param choices: strings to compare the query with
+        @return: similarity for each choice, 1.0 for identical strings,
+            down to 0.0 for no similarity at all
+        """
+        raise NotImplementedError
+
+    def __call__(self, x: str, against: str) -> float:
+        return self.score(against, [x])[0]
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}({self.name})>"
+
+
+class DifflibSimilarity(SimilarityBackend):
+    """
+    difflib.SequenceMatcher ratio, the query side of the matcher is
+    indexed once and reused for every choice
+    """
+    name = "difflib"
+
+    def score(self, query: str, choices: List[str]) -> List[float]:
+        matcher = SequenceMatcher(None, "", query)
+        scores = []
+        for choice in choices:
+            matcher.set_seq1(choice)
+            scores.append(matcher.ratio())
+        return scores
+
+
+def _indel_similarity(len_a: int, len_b: int, distance: int) -> float:
+    lensum = len_a + len_b
+    if not lensum:
+        return 1.0
+    return 1 - distance / lensum
+
+
+class PythonIndelSimilarity(SimilarityBackend):
+    """
+    Normalized Indel similarity using a bit-parallel LCS, the character
+    bitmasks of the query are built once and shared by all choices
+    """
+    name = "indel/python"
+
+    @staticmethod
+    def _lcs(masks: dict, length: int, choice: str) -> int:
+        full = (1 << length) - 1
+        v = full
+        for char in choice:
+            u = v & masks.get(char, 0)
+            v = ((v + u) | (v - u)) & full
+        return length - bin(v).count("1")
+
+    def score(self, query: str, choices: List[str]) -> List[float]:
+        masks = {}
+        for idx, char in enumerate(query):
+            masks[char] = masks.get(char, 0) | (1 << idx)
+        scores = []
+        for choice in choices:
+            lcs = self._lcs(masks, len(query), choice) if query else 0
+            distance = len(query) + len(choice) - 2 * lcs
+            scores.append(_indel_similarity(len(query), len(choice),
+                                            distance))
+        return scores
+
+
+class RapidfuzzIndelSimilarity(SimilarityBackend):
+    """
+    Normalized Indel similarity computed by rapidfuzz in a single call
+    """
+    name = "indel/rapidfuzz"
+
+    def __init__(self):
+        if _rf_process is None:
+            raise ImportError("rapidfuzz is not installed")
+
+    def score(self, query: str, choices: List[str]) -> List[float]:
+        distances = [0] * len(choices)
+        for _, distance, idx in _rf_process.extract(
+                query, choices, scorer=_rf_indel.distance, limit=None):
+            distances[idx] = distance
+        # normalize in python so results are identical to the fallback
+        return [_indel_similarity(len(query), len(choice), distance)
+                for choice, distance in zip(choices, distances)]
+
+
+def get_similarity_backend(name: str = "difflib") -> SimilarityBackend:
+    """
+    Get a similarity backend by metric or implementation name
+    @param name: "difflib", "indel" (best available implementation),
+        "indel/rapidfuzz" or "indel/python"
+    @return: similarity backend instance
+    """
+    name = (name or DifflibSimilarity.name).lower()
+    if name == DifflibSimilarity.name:
+        return DifflibSimilarity()
+    if name == "indel":
+        if _rf_process is not None:
+            return RapidfuzzIndelSimilarity()
+        return PythonIndelSimilarity()
+    if name == RapidfuzzIndelSimilarity.name:
+        return RapidfuzzIndelSimilarity()
+    if name == PythonIndelSimilarity.name:
+        return PythonIndelSimilarity()
+    raise ValueError(f"Unknown similarity backend '{name}'")
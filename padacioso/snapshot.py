@@ -0,0 +1,71 @@
+"""
+Versioned on-disk snapshots of an IntentContainer.
+
+A snapshot is a JSON document holding the expanded templates of every intent,
+the entity tables and a hash of the source lines each intent was registered
+from. Loading it skips bracket expansion entirely, and lets callers tell which
+intents changed since the snapshot was taken.
+"""
+import hashlib
+import json
+import os
+from typing import List
+
+from padacioso.version import VERSION_MAJOR, VERSION_MINOR, VERSION_BUILD, \
+    VERSION_ALPHA
+
+SNAPSHOT_FORMAT = "padacioso.snapshot"
+SNAPSHOT_VERSION = 1
+# templates are only valid for the expansion logic that produced them
+PADACIOSO_VERSION = f"{VERSION_MAJOR}.{VERSION_MINOR}.{VERSION_BUILD}" \
+                    f"a{VERSION_ALPHA}"
+
+
+def source_hash(lines: List[str]) -> str:
+    """
+    Hash of the source lines of an intent
+    @param lines: intent lines, as passed to `IntentContainer.add_intent`
+    @return: hex digest
+    """
+    return hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+
+
+def write_snapshot(path: str, state: dict):
+    """
+    Atomically write a snapshot to disk
+    @param path: file to write
+    @param state: container state, see `IntentContainer._get_state`
+    """
+    data = {"format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "padacioso": PADACIOSO_VERSION}
+    data.update(state)
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: str) -> dict:
+    """
+    Read a snapshot from disk
+    @param path: file to read
+    @return: container state, see `IntentContainer._get_state`
+    @raises ValueError: if the file is not a snapshot compatible with this
+        version of padacioso
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or data.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"{path} is not a padacioso snapshot")
+    if data.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version "
+                         f"{data.get('version')}, expected {SNAPSHOT_VERSION}")
+    if data.get("padacioso") != PADACIOSO_VERSION:
+        raise ValueError(f"Snapshot created by padacioso "
+                         f"{data.get('padacioso')}, this is "
+                         f"{PADACIOSO_VERSION}")
+    data.setdefault("sources", {})
+    return data
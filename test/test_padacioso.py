@@ -1,5 +1,6 @@
 from padacioso import IntentContainer
 import unittest
+from unittest.mock import patch
 
 
 class TestIntentContainer(unittest.TestCase):
@@ -68,6 +69,30 @@ class TestIntentContainer(unittest.TestCase):
         self.assertEqual(
             container.calc_intent('teStiNg CapitalIzation')['conf'], 0.95)
 
+    def test_literal_lookup(self):
+        container = IntentContainer()
+        container.add_intent('test', ['Testing cAPitalizAtion', 'say *'])
+        container.add_intent('other', ['testing capitalization {thing}'])
+        self.assertEqual(container._literals,
+                         {'testing capitalization': {'Testing cAPitalizAtion'}})
+        with patch("simplematch.Matcher.match") as regex_match:
+            self.assertEqual(
+                container.calc_intent('Testing cAPitalizAtion')['conf'], 1.0)
+            self.assertEqual(
+                container.calc_intent('teStiNg CapitalIzation')['conf'],
+                0.95)
+            regex_match.assert_not_called()
+        container.remove_intent('test')
+        self.assertEqual(container._literals, {})
+
+        # case equivalences of re.IGNORECASE beyond str.lower
+        container.add_intent('sigma', ['ς {thing}', 'ς'])
+        self.assertEqual(container.calc_intent('Σ')['conf'], 0.95)
+        self.assertEqual(container.calc_intent('Σ x')['name'], 'sigma')
+        # İ lower cases to two characters, re folds it to i
+        container.add_intent('city', ['İzmir {thing}'])
+        self.assertEqual(container.calc_intent('izmir x')['name'], 'city')
+
     def test_multiple_entities(self):
         container = IntentContainer()
         container.add_intent('test3', ['I see {Thing} (in|on) {place}'])
@@ -167,6 +192,106 @@ class TestIntentContainer(unittest.TestCase):
         self.assertEqual(intent["name"], "test2")
         self.assertEqual(intent["entities"], {'thing': 'Mycroft'})
 
+    def test_fuzzy_matchers_compiled_once(self):
+        container = IntentContainer(fuzz=True)
+        container.add_intent('test', ['this is a test', 'execute test'])
+        # compiled on first use, or ahead of it by warm_up
+        self.assertEqual(container._fuzzy_matchers, {})
+        container.warm_up(wait=True)
+        self.assertEqual(sorted(container._fuzzy_matchers),
+                         ['execute test', 'this is a test'])
+        with patch("simplematch.Matcher._create_regex") as compile_regex:
+            intent = container.calc_intent("this is test")
+            compile_regex.assert_not_called()
+        self.assertEqual(intent["name"], "test")
+        container.remove_intent('test')
+        self.assertEqual(container._fuzzy_matchers, {})
+
+    def test_fuzzy_early_stop(self):
+        container = IntentContainer(fuzz=True)
+        container.add_intent('test', ['execute test'])
+        # a fuzzy match that can not beat an exact match is not scored
+        self.assertEqual(container._match_fuzzy(
+            "this is test", "test", ["execute test"], best=0.95), None)
+        match = container._match_fuzzy("this is test", "test",
+                                       ["execute test"])
+        self.assertEqual(match["name"], "test")
+        self.assertLess(match["conf"], 0.95)
+
+    def test_top_k(self):
+        container = IntentContainer(fuzz=True)
+        container.add_intent('slot', ['play {song}'])
+        container.add_intent('wildcard', ['play *'])
+        container.add_intent('literal', ['play music'])
+        intents = list(container.calc_intents("play music", top_k=2))
+        self.assertEqual([i["name"] for i in intents], ["literal", "slot"])
+        # a perfect literal hit stops the search before any regex runs
+        with patch.object(container._automaton, "match") as match:
+            intents = list(container.calc_intents("play music", top_k=1))
+            match.assert_not_called()
+        self.assertEqual([i["name"] for i in intents], ["literal"])
+        intent = container.calc_intent("play music",
+                                       exclude_intents=["literal"])
+        self.assertEqual(intent["name"], "slot")
+
+    def test_tie_break(self):
+        container = IntentContainer()
+        container.add_intent('first', ['turn {x} on'])
+        container.add_intent('short', ['turn {x}'])
+        container.add_intent('second', ['turn {y} on'])
+        container.add_intent('specific', ['turn the {x} on'])
+        # same confidence, the most specific template wins
+        self.assertEqual(container.calc_intent("turn the light on")["name"],
+                         "specific")
+        container.remove_intent('specific')
+        # then the intent registered first
+        self.assertEqual(container.calc_intent("turn the light on")["name"],
+                         "first")
+
+    def test_calc_intents_batch(self):
+        container = IntentContainer(fuzz=True)
+        container.add_intent('test', ['this is a test', 'execute test'])
+        container.add_intent('test2', ['tell me about {thing}'])
+        queries = ["tell me about Mycroft", "this is test", "nothing",
+                   "tell me about Mycroft"]
+        results = container.calc_intents_batch(queries)
+        self.assertEqual(results, [list(container.calc_intents(q))
+                                   for q in queries])
+        # duplicated queries do not share result dicts
+        self.assertIsNot(results[0][0], results[3][0])
+        results = container.calc_intents_batch(queries, top_k=1,
+                                               exclude_intents=["test"])
+        self.assertEqual([[i["name"] for i in r] for r in results],
+                         [["test2"], [], [], ["test2"]])
+
+    def test_async(self):
+        import asyncio
+        container = IntentContainer(fuzz=True, n_workers=1)
+        container.add_intent('test', ['this is a test', 'execute test'])
+        container.add_intent('test2', ['tell me about {thing}'])
+
+        async def stream(query):
+            return [i async for i in container.acalc_intents_stream(query)]
+
+        async def supersede():
+            old = asyncio.ensure_future(
+                container.acalc_intent("this is a test", key="session"))
+            await asyncio.sleep(0)
+            new = await container.acalc_intent("tell me about it",
+                                               key="session")
+            with self.assertRaises(asyncio.CancelledError):
+                await old
+            return new
+
+        intent = asyncio.run(container.acalc_intent("tell me about Mycroft"))
+        self.assertEqual(intent, container.calc_intent("tell me about Mycroft"))
+        intents = asyncio.run(container.acalc_intents("this is test"))
+        self.assertEqual(intents, list(container.calc_intents("this is test")))
+        self.assertEqual(asyncio.run(stream("this is test")), intents)
+        self.assertEqual(asyncio.run(supersede())["name"], "test2")
+        self.assertEqual(container._pending, {})
+        container.close()
+
     def test_add_remove_intent(self):
         container = IntentContainer()
         # Add intent valid
@@ -192,14 +317,320 @@ class TestIntentContainer(unittest.TestCase):
         self.assertEqual(len(container._cased_matchers),
                          len(container._uncased_matchers))
 
+    def test_shared_matchers(self):
+        import gc
+        from padacioso.matchers import SHARED_MATCHERS
+        template = 'shared {thing} template'
+        container = IntentContainer()
+        container.add_intent('a', [template])
+        container.add_intent('b', [template])
+        other = IntentContainer()
+        other.add_intent('c', [template])
+        # one compiled matcher for every container and intent
+        self.assertIs(container._cased_matchers[template],
+                      other._cased_matchers[template])
+        self.assertEqual(SHARED_MATCHERS.references(template, True), 2)
+
+        # removing an intent keeps the matchers other intents still use
+        container.remove_intent('a')
+        with patch("padacioso.LOG") as log:
+            self.assertEqual(
+                container.calc_intent('shared matcher template')['name'], 'b')
+            log.warning.assert_not_called()
+        container.remove_intent('b')
+        self.assertEqual(SHARED_MATCHERS.references(template, True), 1)
+        del other
+        gc.collect()
+        self.assertEqual(SHARED_MATCHERS.references(template, True), 0)
+
+    def test_lazy_matchers(self):
+        from padacioso.matchers import SHARED_MATCHERS
+        template = 'play {song} lazily'
+        container = IntentContainer()
+        container.add_intent('play', [template, 'stop lazily'])
+        self.assertIsNone(container._templates['stop lazily'].cased)
+        self.assertTrue(container._templates['stop lazily'].literal)
+        self.assertEqual(SHARED_MATCHERS.references(template, False), 0)
+
+        # the case insensitive variant is only compiled when needed
+        self.assertEqual(container.calc_intent('play thunder lazily')
+                         ['conf'], 0.96)
+        self.assertIsNone(container._templates[template].uncased)
+        self.assertEqual(container.calc_intent('Play thunder lazily')
+                         ['conf'], 0.9)
+        self.assertEqual(SHARED_MATCHERS.references(template, False), 1)
+        container.remove_intent('play')
+        self.assertEqual(SHARED_MATCHERS.references(template, False), 0)
+
+    def test_invalid_template(self):
+        import re
+        container = IntentContainer()
+        container.add_intent('light', ['turn on the {thing}'])
+        # checked at registration, although compiled on first use
+        with self.assertRaises(re.error):
+            container.add_intent('bad', ['{a} and {a}'])
+        self.assertNotIn('bad', container.intent_samples)
+
+        # slots repeated across alternatives are fine, expanded or not
+        for budget in (4, 100):
+            bracketed = IntentContainer(expansion_budget=budget)
+            bracketed.add_intent('play', ['(play {song}|put on {song}) '
+                                          '[a] [b] [c]'])
+            self.assertEqual(bracketed.calc_intent('put on help'), {
+                'name': 'play', 'entities': {'song': 'help'}, 'conf': 0.96})
+
+        # a template failing to compile only stops matching itself
+        container._add_expanded_intent('bad', ['{a} and {a}'])
+        with patch("padacioso.LOG") as log:
+            self.assertEqual(
+                container.calc_intent('turn on the light and stuff')['name'],
+                'light')
+            log.error.assert_called()
+
+    def test_warm_up(self):
+        container = IntentContainer()
+        container.add_intent('first', ['first {thing}'])
+        container.add_intent('second', ['second {thing}'])
+        # registering compiles nothing
+        self.assertIsNone(container._templates['first {thing}'].cased)
+        self.assertEqual(container.calc_intent('second time')['name'],
+                         'second')
+
+        # the most matched intents are compiled first
+        container.remove_intent('second')
+        container.add_intent('second', ['second {thing}', 'other {thing}'])
+        container.calc_intent('other one')
+        compiled = []
+        matcher = IntentContainer._matcher
+        with patch.object(IntentContainer, "_matcher", autospec=True,
+                          side_effect=lambda c, t, cased: (
+                              compiled.append(t.text),
+                              matcher(c, t, cased))[1]):
+            container.warm_up(wait=True)
+        self.assertEqual(compiled, ['second {thing}', 'other {thing}',
+                                    'first {thing}'])
+
+        container = IntentContainer(warm_up=True)
+        container.add_intent('test', ['test {thing}'])
+        container.warm_up().join(5)
+        self.assertIsNotNone(container._templates['test {thing}'].cased)
+        container.close()
+
+        # process workers warm up instead of the container
+        lazy = IntentContainer()
+        lazy.add_intent('test', ['test {thing}'])
+        with IntentContainer(n_workers=1, backend="process",
+                             warm_up=True) as container:
+            container.add_intent('test', ['test {thing}'])
+            self.assertIsNone(container._warm_up_thread)
+            self.assertIsNone(container.warm_up(wait=True))
+            self.assertIsNone(container._templates['test {thing}'].cased)
+            usage = container._backend.broadcast("memory_usage")[0]
+            self.assertGreater(usage["templates"],
+                               lazy.memory_usage()["templates"])
+
+    def test_memory_usage(self):
+        container = IntentContainer()
+        container.add_intent('hello', ['hello (world|there)', 'hi {name}'])
+        container.add_entity('name', ['bob'])
+        usage = container.memory_usage()
+        self.assertEqual(set(usage), {"templates", "intents", "indexes",
+                                      "entities", "total"})
+        self.assertEqual(usage["total"], sum(v for k, v in usage.items()
+                                             if k != "total"))
+        self.assertGreater(usage["templates"], 0)
+        container.remove_intent('hello')
+        self.assertLess(container.memory_usage()["templates"],
+                        usage["templates"])
+
+    def test_constrain_entities(self):
+        query = 'play yesterday by sly by night'
+        for constrain in (False, True):
+            container = IntentContainer(constrain_entities=constrain)
+            container.add_intent('play', ['play {song} by {artist}'])
+            container.add_entity('song', ['stand by me', 'yesterday'])
+            container.add_entity('artist', ['sly by night'])
+            result = container.calc_intent(query)
+            if constrain:
+                self.assertEqual(result['entities'],
+                                 {'song': 'yesterday',
+                                  'artist': 'sly by night'})
+                self.assertEqual(result['conf'], 1.0)
+            else:
+                self.assertEqual(result['entities']['song'],
+                                 'yesterday by sly')
+                self.assertLess(result['conf'], 1.0)
+
+        # compiled on first use, sharing the regex of each entity
+        container.add_intent('hear', ['hear {song}'])
+        self.assertIsNone(container._templates['hear {song}'].entity_cased)
+        self.assertIs(container._constrained['hear {song}']['song'],
+                      container._constrained['play {song} by {artist}'][
+                          'song'])
+        container.calc_intent('hear yesterday')
+        self.assertIsNotNone(
+            container._templates['hear {song}'].entity_cased)
+        container.remove_intent('hear')
+
+        # unknown values fall back to the unconstrained slots
+        result = container.calc_intent('play help by the beatles')
+        self.assertEqual(result['entities'],
+                         {'song': 'help', 'artist': 'the beatles'})
+        self.assertAlmostEqual(result['conf'], 0.8)
+        # new entity values are picked up
+        container.add_entity('artist', ['the beatles'])
+        container.add_entity('song', ['help'])
+        self.assertEqual(container.calc_intent(
+            'play help by the beatles')['conf'], 1.0)
+        # the remaining entity still constrains its slot
+        container.remove_entity('song')
+        result = container.calc_intent(query)
+        self.assertEqual(result['entities']['song'], 'yesterday')
+        self.assertAlmostEqual(result['conf'], 0.96)
+        container.remove_intent('play')
+        self.assertEqual(container._constrained, {})
+        self.assertEqual(container._slot_templates, {})
+
+    def test_filter(self):
+        import random
+        container = IntentContainer()
+        container.exclude_keywords('a', ['foo', 'oba'])
+        container.exclude_keywords('b', ['bar'])
+        container.exclude_keywords('c', ['foobar'])
+        self.assertEqual(container._filter('xfoobarx'), {'a', 'b', 'c'})
+        self.assertEqual(container._filter('fbar'), {'b'})
+        self.assertEqual(container._filter('Foo'), set())
+
+        def reference(query):
+            # per intent scan of the context/keyword tables
+            excluded = set()
+            for intent_name, samples in container.excluded_keywords.items():
+                if any(s in query for s in samples):
+                    excluded.add(intent_name)
+            for intent_name, contexts in container.required_contexts.items():
+                available = container.available_contexts.get(intent_name)
+                if available is None or \
+                        any(c not in available for c in contexts):
+                    excluded.add(intent_name)
+            for intent_name, contexts in container.excluded_contexts.items():
+                available = container.available_contexts.get(intent_name)
+                if available is not None and \
+                        any(c in available for c in contexts):
+                    excluded.add(intent_name)
+            return excluded
+
+        rng = random.Random(0)
+        methods = [container.set_context, container.unset_context,
+                   container.require_context, container.unrequire_context,
+                   container.exclude_context, container.unexclude_context]
+        for _ in range(500):
+            rng.choice(methods)(rng.choice('abcdef'), rng.choice('xyz'))
+            self.assertEqual(container._filter('foo'), reference('foo'))
+
+    def test_bulk_registration(self):
+        container = IntentContainer(constrain_entities=True)
+        with patch.object(container, "_compile_constrained",
+                          wraps=container._compile_constrained) as compile:
+            container.add_intents({'play': ['play {song} by {artist}'],
+                                   'hello': ['hello (world|there)']})
+            compile.reset_mock()
+            container.add_entities({'song': ['yesterday'],
+                                    'artist': ['sly by night']})
+            # one recompilation for both entities
+            compile.assert_called_once_with('play {song} by {artist}')
+        self.assertEqual(container.generation, 2)
+        self.assertEqual(container.calc_intent('hello there')['name'],
+                         'hello')
+        self.assertEqual(
+            container.calc_intent('play yesterday by sly by night')['conf'],
+            1.0)
+        with self.assertRaises(RuntimeError):
+            container.add_intents({'new': ['new'], 'hello': ['hi']})
+        self.assertNotIn('new', container.intent_samples)
+
+    def test_instrumentation(self):
+        import asyncio
+        from padacioso.instrumentation import Aggregator
+        for backend in ("inline", "process"):
+            container = IntentContainer(fuzz=True, backend=backend,
+                                        n_workers=1)
+            container.add_intent('hello', ['hello {name}'])
+            container.add_entity('name', ['world'])
+            container.calc_intent('hello world')  # not recorded
+            aggregator = Aggregator()
+            container.add_observer(aggregator)
+            container.calc_intent('hello world')
+            container.calc_intents_batch(['hello there', 'bye'])
+            asyncio.run(container.acalc_intent('hello world'))
+            summary = aggregator.summary()
+            self.assertEqual(summary["counters"]["queries"], 4)
+            self.assertGreater(summary["counters"]["regex_executions"], 0)
+            self.assertGreater(summary["counters"]["fuzzy_variants"], 0)
+            self.assertEqual(summary["counters"]["entity_checks"], 3)
+            for stage in ("filter", "backend", "exact", "fuzzy",
+                          "entity_penalty"):
+                self.assertIn(stage, summary["stages"])
+            self.assertEqual(summary["stages"]["backend"]["count"], 3)
+            container.remove_observer(aggregator)
+            container.calc_intent('hello world')
+            self.assertEqual(aggregator.summary(), summary)
+            container.close()
+
+        text = aggregator.prometheus()
+        self.assertIn('padacioso_stage_seconds_count{stage="backend"} 3',
+                      text)
+        self.assertIn('padacioso_events_total{event="queries"} 4', text)
+
+        reports = []
+        aggregator = Aggregator(interval=0, report=reports.append)
+        aggregator.on_count("queries", 1)
+        self.assertEqual(reports, [{"stages": {},
+                                    "counters": {"queries": 1}}])
+
+    def test_intent_profiler(self):
+        from padacioso.profiler import IntentProfiler
+        for backend in ("inline", "process"):
+            container = IntentContainer(fuzz=True, backend=backend,
+                                        n_workers=1)
+            container.add_intent('cheap:hello', ['hello world'])
+            container.add_intent('pricey:say', ['* (a|b|c) [say] {thing}'])
+            container.add_intent('pricey:tell', ['tell me {thing}'])
+            profiler = IntentProfiler()
+            container.add_observer(profiler)
+            for _ in range(3):
+                container.calc_intent('a say something')
+            container.close()
+
+            memory = container.intent_memory_usage()
+            self.assertGreater(memory['pricey:say'], memory['cheap:hello'])
+            report = profiler.report(memory, by="regexes")
+            self.assertEqual(report[0]['name'], 'pricey:say')
+            self.assertEqual(report[0]['calls'], 3)
+            self.assertGreater(report[0]['regexes'], 0)
+            self.assertEqual(profiler.report(memory, by="memory",
+                                             top=1)[0]['name'], 'pricey:say')
+            skills = profiler.report(memory, skills=True)
+            self.assertEqual([s['name'] for s in skills],
+                             ['pricey', 'cheap'])
+            self.assertEqual(skills[0]['intents'], 2)
+        with self.assertRaises(ValueError):
+            profiler.report(by="size")
+
     def test_add_remove_entity(self):
         container = IntentContainer()
         # Add entity valid
         container.add_entity("entity", ["test(ing|)", "another test"])
         self.assertEqual(len(container.entity_samples["entity"]), 3)
-        # Add entity already defined
-        with self.assertRaises(RuntimeError):
-            container.add_entity("entity", ["invalid"])
+        # Add entity already defined, samples are merged
+        container.add_entity("Entity", ["another test", "more"])
+        self.assertEqual(list(container.entity_samples["entity"]),
+                         ["testing", "test", "another test", "more"])
+        self.assertIn("more", container.entity_samples["entity"])
+        self.assertTrue(
+            container.entity_samples["entity"].contains_folded("MORE"))
+        self.assertEqual(container.entity_samples["entity"].startswith("Te"),
+                         ["test", "testing"])
+        self.assertGreater(container.entity_memory_usage()["entity"], 0)
         # Remove entity
         container.remove_entity("entity")
         self.assertNotIn("entity", container.entity_samples.keys())
@@ -229,3 +660,306 @@ class TestIntentContainer(unittest.TestCase):
         self.assertEqual(match['entities']['word0'], 'neon')
         self.assertEqual(match['entities']['word1'], 'neon')
 
+
+class TestBackends(unittest.TestCase):
+    def _populate(self, container):
+        container.add_intent('hello', ['hello', 'hi', 'how are you'])
+        container.add_intent('buy', ['buy {item}', 'get {item} for me'])
+        container.add_entity('item', ['milk', 'cheese'])
+
+    def _check_backend(self, backend):
+        with IntentContainer(n_workers=2, backend=backend) as container:
+            self._populate(container)
+            self.assertEqual(container.calc_intent('hello')['name'], 'hello')
+            self.assertEqual(container.calc_intent('buy milk'), {
+                'name': 'buy', 'entities': {'item': 'milk'}, "conf": 1
+            })
+            # registration changes after the workers started
+            container.add_intent('eat', ['eat {fruit}'])
+            container.add_entity('fruit', ['apple'])
+            self.assertEqual(container.calc_intent('eat apple'), {
+                'name': 'eat', 'entities': {'fruit': 'apple'}, "conf": 1
+            })
+            container.remove_intent('hello')
+            self.assertIsNone(container.calc_intent('hello')['name'])
+            container.remove_entity('fruit')
+            self.assertEqual(container.calc_intent('eat apple')['conf'],
+                             0.96)
+
+    def test_inline(self):
+        self._check_backend("inline")
+
+    def test_thread(self):
+        self._check_backend("thread")
+
+    def test_process(self):
+        self._check_backend("process")
+
+    def test_process_lifecycle(self):
+        container = IntentContainer(n_workers=2, backend="process")
+        self._populate(container)
+        self.assertFalse(container._backend.started)
+        container.calc_intent('hello')
+        self.assertTrue(container._backend.started)
+        processes = [w.process for w in container._backend._workers]
+        container.close()
+        self.assertFalse(container._backend.started)
+        self.assertFalse(any(p.is_alive() for p in processes))
+
+    def test_close_cancels_queued(self):
+        import threading
+        import time
+        container = IntentContainer(n_workers=1)
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        running = container._backend.dispatch(block)
+        queued = container._backend.dispatch(container.calc_intent, 'hi')
+        started.wait(5)
+        closer = threading.Thread(target=container.close)
+        closer.start()
+        # close waits for the running task, the queued one never starts
+        for _ in range(500):
+            if queued.cancelled():
+                break
+            time.sleep(0.01)
+        release.set()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
+        self.assertTrue(running.done())
+        self.assertTrue(queued.cancelled())
+        self.assertEqual(container._backend._pending, set())
+
+    def test_invalid_backend(self):
+        with self.assertRaises(ValueError):
+            IntentContainer(backend="gpu")
+
+
+class TestTemplateAutomaton(unittest.TestCase):
+    def test_candidates(self):
+        from padacioso.automaton import TemplateAutomaton
+        automaton = TemplateAutomaton()
+        for t in ['hello world', 'hello {name}', 'say *', '* number {n:int}',
+                  'Testing cAPitalizAtion']:
+            automaton.add(t)
+        self.assertEqual(automaton.match('hello world'),
+                         {'hello world', 'hello {name}'})
+        self.assertEqual(automaton.match('hello there'), {'hello {name}'})
+        self.assertEqual(automaton.match('say'), set())
+        self.assertEqual(automaton.match('say '), {'say *'})
+        self.assertEqual(automaton.match('i want number 3'),
+                         {'* number {n:int}'})
+        # case insensitive superset of the simplematch matchers
+        self.assertEqual(automaton.match('testing capitalization'),
+                         {'Testing cAPitalizAtion'})
+
+        automaton.remove('hello {name}')
+        self.assertEqual(automaton.match('hello there'), set())
+        self.assertEqual(automaton.match('hello world'), {'hello world'})
+        self.assertEqual(len(automaton), 4)
+
+        # one pass for a batch, same candidates as one query at a time
+        queries = ['hello world', 'say', 'say hi', 'hello', 'hel',
+                   'i want number 3', 'Testing capitalization', '']
+        self.assertEqual(automaton.match_many(queries),
+                         [automaton.match(q) for q in queries])
+
+    def test_container_shared_templates(self):
+        container = IntentContainer()
+        container.add_intent('a', ['play {song}'])
+        container.add_intent('b', ['play {song}', 'pause'])
+        self.assertEqual(container._automaton.match('play it'),
+                         {'play {song}'})
+        container.remove_intent('b')
+        self.assertEqual(container._automaton.match('play it'),
+                         {'play {song}'})
+        self.assertEqual(container._automaton.match('pause'), set())
+
+
+class TestPrefilter(unittest.TestCase):
+    def test_required_tokens(self):
+        from padacioso.prefilter import required_tokens
+        self.assertEqual(required_tokens("what is {thing}"), {"what", "is"})
+        self.assertEqual(required_tokens("* Number {n:int}"), {"number"})
+        self.assertEqual(required_tokens("say*"), set())
+
+    def test_candidates(self):
+        from padacioso.prefilter import TokenIndex, query_tokens
+        index = TokenIndex()
+        for t in ["this is a test", "tell me about {thing}", "{thing}"]:
+            index.add(t)
+        tokens = query_tokens("tell me about Mycroft")
+        self.assertEqual(index.candidates(tokens),
+                         {"tell me about {thing}", "{thing}"})
+        tokens = query_tokens("this is test")
+        self.assertEqual(index.candidates(tokens), {"{thing}"})
+        self.assertEqual(index.candidates(tokens, fuzzy=True),
+                         {"this is a test", "{thing}"})
+        index.remove("{thing}")
+        self.assertEqual(index.candidates(tokens), set())
+
+    def test_stats(self):
+        container = IntentContainer(fuzz=True)
+        container.add_intent('test', ['this is a test', 'execute test'])
+        container.add_intent('test2', ['tell me about {thing}'])
+        self.assertEqual(container.calc_intent("this is test")["name"],
+                         "test")
+        stats = container.prefilter_stats
+        self.assertEqual(stats["queries"], 1)
+        self.assertEqual(stats["exact_hits"], 0)
+        self.assertEqual(stats["exact_skips"], 3)
+        self.assertEqual(stats["fuzzy_hits"], 2)
+        self.assertEqual(stats["fuzzy_skips"], 1)
+        container.reset_prefilter_stats()
+        self.assertEqual(container.prefilter_stats["queries"], 0)
+
+
+class TestBracketExpansion(unittest.TestCase):
+    def test_iter_expand(self):
+        from padacioso.bracket_expansion import expand_parentheses, \
+            iter_expand_parentheses, count_expansions
+        template = "(a|b|c) [x] (d|e|f|g) [y] [z]"
+        expanded = iter_expand_parentheses(template)
+        self.assertEqual(next(expanded), "a x d y z")
+        self.assertEqual(sorted(iter_expand_parentheses(template)),
+                         sorted(expand_parentheses(template)))
+        self.assertEqual(count_expansions(template), 96)
+        self.assertEqual(count_expansions("hello world"), 1)
+
+    def test_bracket_matcher(self):
+        from padacioso.bracket_expansion import BracketMatcher, \
+            expand_parentheses
+        template = "[hey] [mycroft] (what|which) time is it [in {place}]"
+        matcher = BracketMatcher(template)
+        for sample in expand_parentheses(template):
+            self.assertIsNotNone(matcher.match(" ".join(sample.split())))
+        self.assertEqual(matcher.match("which time is it in lisbon"),
+                         {"place": "lisbon"})
+        self.assertEqual(matcher.match("hey what time is it"), {})
+        self.assertIsNone(matcher.match("hey hey what time is it"))
+
+        matcher = BracketMatcher("(play {song}|put on {song}) "
+                                 "[{n:int} times]")
+        self.assertEqual(matcher.match("put on x 3 times"),
+                         {"song": "x", "n": 3})
+
+        # adjacent entities split the query like the expanded templates
+        matcher = BracketMatcher("{x} {y} [the]", case_sensitive=False)
+        self.assertEqual(matcher.match("Light 3 light"),
+                         {"x": "Light 3", "y": "light"})
+
+    def test_expansion_budget(self):
+        container = IntentContainer(expansion_budget=10)
+        with patch("padacioso.LOG") as log:
+            container.add_intent("test", ["(a|b|c) [x] (d|e|f|g) {thing}",
+                                          "hello world"])
+            log.warning.assert_called_once()
+        self.assertEqual(sorted(container.intent_samples["test"]),
+                         ["(a|b|c) [x] (d|e|f|g) {thing}", "hello world"])
+        self.assertEqual(container.calc_intent("c x f stuff"),
+                         {"name": "test", "conf": 0.96,
+                          "entities": {"thing": "stuff"}})
+        self.assertEqual(container.calc_intent("b g stuff")["name"], "test")
+        self.assertEqual(container.calc_intent("hello world")["conf"], 1.0)
+        container.remove_intent("test")
+        self.assertEqual(container._bracketed, set())
+
+
+class TestSimilarity(unittest.TestCase):
+    def test_difflib(self):
+        from difflib import SequenceMatcher
+        from padacioso.similarity import get_similarity_backend
+        backend = get_similarity_backend("difflib")
+        choices = ["* is a test", "this * a test", "{thing} *"]
+        self.assertEqual(
+            backend.score("this is test", choices),
+            [SequenceMatcher(None, c, "this is test").ratio()
+             for c in choices])
+
+    def test_indel_backends_identical(self):
+        from padacioso.similarity import PythonIndelSimilarity, \
+            get_similarity_backend
+        python_backend = PythonIndelSimilarity()
+        self.assertEqual(python_backend("abcd", "abd"), 1 - 1 / 7)
+        self.assertEqual(python_backend("", ""), 1.0)
+        self.assertEqual(python_backend("abc", "xyz"), 0.0)
+        try:
+            rf_backend = get_similarity_backend("indel/rapidfuzz")
+        except ImportError:
+            self.skipTest("rapidfuzz not installed")
+        choices = ["* is a test", "this * a test", "{thing} *", ""]
+        for query in ["this is test", "", "tell me everything about it"]:
+            self.assertEqual(python_backend.score(query, choices),
+                             rf_backend.score(query, choices))
+
+    def test_container_backend(self):
+        container = IntentContainer(fuzz=True)
+        self.assertEqual(container.similarity_backend, "difflib")
+        container = IntentContainer(fuzz=True, similarity="indel")
+        self.assertIn(container.similarity_backend,
+                      ["indel/python", "indel/rapidfuzz"])
+        container.add_intent('test', ['execute test'])
+        self.assertEqual(container.calc_intent("this is test")["name"],
+                         "test")
+        with self.assertRaises(ValueError):
+            IntentContainer(similarity="soundex")
+
+
+class TestResultCache(unittest.TestCase):
+    def test_lru_ttl(self):
+        from padacioso.cache import ResultCache
+        cache = ResultCache(max_size=2, ttl=10)
+        cache.put("a", None)
+        cache.put("b", 2)
+        self.assertIsNone(cache.get("a", "missing"))
+        cache.put("c", 3)  # evicts "b", the least recently used
+        self.assertEqual(cache.get("b", "missing"), "missing")
+        with patch("padacioso.cache.time.monotonic",
+                   return_value=10 ** 9):
+            self.assertEqual(cache.get("c", "missing"), "missing")
+        stats = cache.stats
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"],
+                          stats["expirations"], stats["size"]),
+                         (1, 2, 1, 1, 1))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_save_load(self):
+        import json
+        import tempfile
+        from os.path import join
+        container = IntentContainer(fuzz=True)
+        container.add_intent('test', ['(this|that) is a test', 'say *'])
+        container.add_intent('buy', ['buy {item}'])
+        container.add_entity('item', ['milk', '(cheese|bread)'])
+        queries = ["that is a test", "say hello", "buy bread", "buy a car",
+                   "this is test"]
+        with tempfile.TemporaryDirectory() as folder:
+            path = join(folder, "en-US.json")
+            container.save(path)
+            with patch.object(IntentContainer, "_expand") as expand:
+                loaded = IntentContainer.load(path, backend="thread")
+                expand.assert_not_called()
+            self.assertTrue(loaded.fuzz)
+            self.assertEqual(loaded.intent_samples, container.intent_samples)
+            self.assertEqual(loaded._intent_sources,
+                             container._intent_sources)
+            for query in queries:
+                self.assertEqual(loaded.calc_intent(query),
+                                 container.calc_intent(query))
+            loaded.close()
+
+            with self.assertRaises(ValueError):
+                IntentContainer.load(path, expansion_budget=1)
+            with open(path) as f:
+                data = json.load(f)
+            data["version"] = 0
+            with open(path, "w") as f:
+                json.dump(data, f)
+            with self.assertRaises(ValueError):
+                IntentContainer.load(path)
@@ -1,4 +1,7 @@
 import unittest
+from unittest.mock import patch
+
+from langcodes import closest_match
 
 from ovos_utils.messagebus import FakeBus
 
@@ -62,3 +65,257 @@ class UtteranceIntentMatchingTest(unittest.TestCase):
         self.assertEqual(intent.matches, {'thing': 'Mycroft'})
         self.assertEqual(intent.sent, utterance)
         self.assertTrue(intent.conf <= 0.8)
+
+    def test_calc_intent_batch(self):
+        intent_service = self.get_service(fuzz=False)
+        utterances = ["this is a test", "nothing to see",
+                      "tell me about Mycroft"]
+        intents = intent_service.calc_intent_batch(utterances, "en-US")
+        self.assertEqual(intents[0].name, "test")
+        self.assertIsNone(intents[1])
+        self.assertEqual(intents[2].name, "test2")
+        self.assertEqual(intents[2].matches, {'thing': 'Mycroft'})
+        self.assertEqual(intents[2].sent, "tell me about Mycroft")
+
+    def test_acalc_intent(self):
+        import asyncio
+        intent_service = self.get_service(fuzz=True)
+        intent = asyncio.run(intent_service.acalc_intent(
+            ["tell me everything about Mycroft"], "en-US"))
+        self.assertEqual(intent.name, "test2")
+        self.assertEqual(intent.matches, {'thing': 'Mycroft'})
+
+    def test_result_cache(self):
+        intent_service = self.get_service(fuzz=False)
+        for _ in range(3):  # match_high, match_medium, match_low
+            intent = intent_service.calc_intent("this is a test", "en-US")
+            self.assertEqual(intent.name, "test")
+        stats = intent_service.cache_stats
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+        # registration changes invalidate cached results
+        data = {'samples': ['this is a test'], 'lang': 'en-US',
+                'name': 'other'}
+        intent_service.register_intent(Message("padatious:register_intent",
+                                               data))
+        intent_service.calc_intent("this is a test", "en-US")
+        self.assertEqual(intent_service.cache_stats["misses"], 2)
+        intent_service.calc_intent_batch(["this is a test", "execute test"],
+                                         "en-US")
+        stats = intent_service.cache_stats
+        self.assertEqual((stats["hits"], stats["misses"]), (3, 3))
+
+    def test_single_pass_tiers(self):
+        import gc
+        intent_service = self.get_service(fuzz=True)
+        intent_service.conf_low = 0.4
+        message = Message("recognizer_loop:utterance")
+        utterances = ["this is test"]
+        with patch.object(intent_service, "calc_intent",
+                          wraps=intent_service.calc_intent) as calc:
+            self.assertIsNone(intent_service.match_high(utterances, "en-US",
+                                                        message))
+            self.assertIsNone(intent_service.match_medium(utterances, "en-US",
+                                                          message))
+            match = intent_service.match_low(utterances, "en-US", message)
+            self.assertEqual(calc.call_count, 1)
+            self.assertEqual(match.match_type, "test")
+            # a new message is matched again
+            intent_service.match_low(utterances, "en-US",
+                                     Message("recognizer_loop:utterance"))
+            self.assertEqual(calc.call_count, 2)
+        del message, match, calc
+        gc.collect()
+        self.assertEqual(intent_service._tier_results, {})
+
+    def test_lang_resolution(self):
+        intent_service = PadaciosoPipeline(FakeBus(), {})
+        intent_service.containers = {"en-US": IntentContainer(),
+                                     "pt-PT": IntentContainer()}
+        with patch("padacioso.opm.closest_match",
+                   wraps=closest_match) as distance:
+            self.assertEqual(intent_service._get_closest_lang("en-US"),
+                             "en-US")
+            self.assertEqual(intent_service._get_closest_lang("pt"),
+                             "pt-PT")
+            calls = distance.call_count
+            for _ in range(3):
+                self.assertEqual(intent_service._get_closest_lang("pt-BR"),
+                                 "pt-PT")
+                self.assertIsNone(intent_service._get_closest_lang("zh-CN"))
+            self.assertEqual(distance.call_count, calls + 2)
+
+        # changing the containers rebuilds the table
+        intent_service.containers["pt-BR"] = IntentContainer()
+        self.assertEqual(intent_service._get_closest_lang("pt-BR"), "pt-BR")
+
+        intent_service.strict_lang = True
+        intent_service.containers.pop("pt-BR")
+        with patch("padacioso.opm.closest_match") as distance:
+            self.assertEqual(intent_service._get_closest_lang("pt-BR"),
+                             "pt-PT")
+            self.assertIsNone(intent_service._get_closest_lang("de-DE"))
+            distance.assert_not_called()
+
+    def test_snapshot_warm_start(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder:
+            config = {"snapshot_dir": folder}
+            intent_service = PadaciosoPipeline(FakeBus(), config)
+            for name, samples in [("test", ["(this|that) is a test"]),
+                                  ("test2", ["tell me about {thing}"])]:
+                data = {'samples': samples, 'lang': 'en-US', 'name': name}
+                intent_service.register_intent(
+                    Message("padatious:register_intent", data))
+            intent_service.shutdown()
+
+            intent_service = PadaciosoPipeline(FakeBus(), config)
+            container = intent_service.containers["en-US"]
+            # snapshot intents are only used once a skill registers them
+            self.assertEqual(container.intent_samples, {})
+            with patch.object(IntentContainer, "_expand",
+                              wraps=container._expand) as expand:
+                for name, samples in [("test", ["(this|that) is a test"]),
+                                      ("test2", ["what is {thing}"])]:
+                    data = {'samples': samples, 'lang': 'en-US',
+                            'name': name}
+                    intent_service.register_intent(
+                        Message("padatious:register_intent", data))
+                # only the intent with changed lines is expanded
+                expand.assert_called_once_with("what is {thing}")
+            intent = intent_service.calc_intent("that is a test", "en-US")
+            self.assertEqual(intent.name, "test")
+            intent = intent_service.calc_intent("what is padacioso", "en-US")
+            self.assertEqual(intent.name, "test2")
+            intent_service.shutdown()
+
+    def test_skill_registry(self):
+        intent_service = PadaciosoPipeline(FakeBus(), {})
+        for name, samples in [("skill.a:test", ["this is a test"]),
+                              ("skill.a:other", ["another test"]),
+                              ("skill.ab:test", ["this is not a test"])]:
+            data = {'samples': samples, 'lang': 'en-US', 'name': name}
+            intent_service.register_intent(
+                Message("padatious:register_intent", data))
+        data = {'samples': ['thing'], 'lang': 'en-US', 'name': 'skill.a:thing'}
+        intent_service.register_entity(
+            Message("padatious:register_entity", data))
+        container = intent_service.containers["en-US"]
+
+        # reloading a skill replaces its intents in place
+        order = dict(container._intent_order)
+        data = {'samples': ['this is a new test'], 'lang': 'en-US',
+                'name': 'skill.a:test'}
+        intent_service.register_intent(
+            Message("padatious:register_intent", data))
+        self.assertEqual(container.intent_samples["skill.a:test"],
+                         ['this is a new test'])
+        self.assertEqual(container._intent_order, order)
+        self.assertEqual(intent_service.registered_intents,
+                         ["skill.a:test", "skill.a:other", "skill.ab:test"])
+
+        # detaching without a name is ignored
+        intent_service.handle_detach_intent(Message("detach_intent", {}))
+        self.assertEqual(intent_service.registered_intents,
+                         ["skill.a:test", "skill.a:other", "skill.ab:test"])
+
+        # detaching a skill leaves skills with the same prefix alone
+        intent_service.handle_detach_skill(
+            Message("detach_skill", {"skill_id": "skill.a"}))
+        self.assertEqual(list(container.intent_samples), ["skill.ab:test"])
+        self.assertEqual(intent_service.registered_intents, ["skill.ab:test"])
+        self.assertEqual(container.entity_samples, {})
+        self.assertEqual(intent_service.registered_entities, [])
+
+    def test_register_skill(self):
+        bus = FakeBus()
+        intent_service = PadaciosoPipeline(bus, {})
+        container = intent_service.containers["en-US"]
+        data = {'lang': 'en-US',
+                'intents': [{'name': 'skill:weather',
+                             'samples': ['weather in {location}']},
+                            {'name': 'skill:hello',
+                             'samples': ['hello world']}],
+                'entities': [{'name': 'skill:location',
+                              'samples': ['lisbon']}]}
+        bus.emit(Message("padacioso:register_skill", data))
+        self.assertEqual(container.generation, 2)
+        self.assertEqual(intent_service.registered_intents,
+                         ['skill:weather', 'skill:hello'])
+        intent = intent_service.calc_intent("hello world", "en-US")
+        self.assertEqual(intent.name, "skill:hello")
+
+        # reloading the skill replaces its intents
+        data['intents'][1]['samples'] = ['hi world']
+        bus.emit(Message("padacioso:register_skill", data))
+        intent = intent_service.calc_intent("hi world", "en-US")
+        self.assertEqual(intent.name, "skill:hello")
+        intent_service.handle_detach_skill(
+            Message("detach_skill", {"skill_id": "skill"}))
+        self.assertEqual(container.intent_samples, {})
+        self.assertEqual(container.entity_samples, {})
+
+        # no registrations into closed containers
+        intent_service.shutdown()
+        bus.emit(Message("padacioso:register_skill", data))
+        self.assertEqual(container.intent_samples, {})
+
+    def test_instrumentation(self):
+        intent_service = PadaciosoPipeline(FakeBus(), {"instrumentation": True})
+        data = {'samples': ['this is a test'], 'lang': 'en-US',
+                'name': 'test'}
+        intent_service.register_intent(Message("padatious:register_intent",
+                                               data))
+        for _ in range(2):
+            intent_service.calc_intent("this is a test", "en-US")
+        summary = intent_service.instrumentation.summary()
+        self.assertEqual(summary["counters"]["cache_misses"], 1)
+        self.assertEqual(summary["counters"]["cache_hits"], 1)
+        self.assertEqual(summary["counters"]["queries"], 1)
+        self.assertEqual(summary["stages"]["pipeline"]["count"], 2)
+        self.assertIsNone(PadaciosoPipeline(FakeBus(), {}).instrumentation)
+
+    def test_profile_report(self):
+        bus = FakeBus()
+        intent_service = PadaciosoPipeline(bus, {})
+        for name, samples in [("skill:test", ["this is a (test|trial)"]),
+                              ("skill:other", ["* (some|any) {thing}"])]:
+            data = {'samples': samples, 'lang': 'en-US', 'name': name}
+            intent_service.register_intent(
+                Message("padatious:register_intent", data))
+        replies = []
+        bus.on("padacioso:profile.report.response",
+               lambda m: replies.append(m.data))
+        bus.emit(Message("padacioso:profile.start"))
+        intent_service.calc_intent("this is a test", "en-US")
+        bus.emit(Message("padacioso:profile.report", {"by": "calls"}))
+        report = replies[-1]["report"]
+        self.assertTrue(replies[-1]["profiling"])
+        self.assertEqual(report[0]["name"], "skill:test")
+        self.assertEqual(report[0]["calls"], 1)
+        self.assertGreater(report[0]["memory"], 0)
+
+        bus.emit(Message("padacioso:profile.stop"))
+        self.assertIsNone(intent_service.profiler)
+        bus.emit(Message("padacioso:profile.report", {"by": "size"}))
+        self.assertIn("error", replies[-1])
+
+        intent_service.shutdown()
+        bus.emit(Message("padacioso:profile.start"))
+        self.assertIsNone(intent_service.profiler)
+        bus.emit(Message("padacioso:profile.report"))
+        self.assertEqual(len(replies), 2)
+
+    def test_process_backend_shutdown(self):
+        intent_service = PadaciosoPipeline(FakeBus(), {"backend": "process",
+                                                       "workers": 2})
+        data = {'samples': ['this is a test'], 'lang': 'en-US',
+                'name': 'test'}
+        intent_service.register_intent(Message("padatious:register_intent",
+                                               data))
+        intent = intent_service.calc_intent("this is a test", "en-US")
+        self.assertEqual(intent.name, "test")
+        container = intent_service.containers["en-US"]
+        self.assertTrue(container._backend.started)
+        intent_service.shutdown()
+        self.assertFalse(container._backend.started)